@@ -0,0 +1,27 @@
+"""Add Output.updated_date
+
+Revision ID: d3a1f2b7c9e4
+Revises: 44c55bb36f57
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a1f2b7c9e4'
+down_revision = '44c55bb36f57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.add_column('outputs', sa.Column('updated_date', sa.DateTime()))
+  op.execute("UPDATE outputs SET updated_date = created_date")
+  op.create_index('idx_outputs_batch_updated_date', 'outputs', ['batch_id', 'updated_date'])
+
+
+def downgrade():
+  op.drop_index('idx_outputs_batch_updated_date', table_name='outputs')
+  op.drop_column('outputs', 'updated_date')
@@ -1,10 +1,14 @@
 import json
+import datetime
 
-from flask import request, jsonify
+import ujson
+from flask import request, jsonify, make_response
+from sqlalchemy import func
+from sqlalchemy.orm import load_only, noload
 from sqlalchemy.orm.attributes import flag_modified
 
 from backend import app, db_session
-from ..models import CiCommit, Batch
+from ..models import CiCommit, Batch, Output
 from .export_to_folder import filter_outputs
 
 
@@ -88,6 +92,89 @@ def update_batch():
   return jsonify({"status": "OK", "id": batch.id})
 
 
+# What `qa batch` needs to know whether its runs are done
+default_status_fields = ['id', 'is_pending', 'is_running', 'is_failed', 'output_dir_url']
+# Computed fields, and the columns/relationships needed to compute them
+computed_fields_columns = {
+  'created_date': ['created_date'],
+  'updated_date': ['updated_date'],
+  'output_dir_url': ['output_dir_override', 'output_type', 'platform', 'configurations', 'extra_parameters', 'test_input_id', 'batch_id'],
+  'test_input_database': ['test_input_id'],
+  'test_input_path': ['test_input_id'],
+  'test_input_metadata': ['test_input_id'],
+}
+
+@app.route('/api/v1/batch/status', methods=['GET'])
+@app.route('/api/v1/batch/status/', methods=['GET'])
+def batch_status():
+  """
+  Lightweight status of the outputs in a batch, meant for polling. Query parameters:
+  - project, commit, batch (default: "default")
+  - fields: comma-separated output fields, e.g. "id,is_pending,is_failed" (default: status fields and output_dir_url)
+  - updated_since: ISO date from a previous response's "updated_at", to get only the outputs that changed
+  """
+  project_id = request.args['project']
+  commit_id = request.args['commit']
+  label = request.args.get('batch', 'default')
+  fields = request.args['fields'].split(',') if request.args.get('fields') else default_status_fields
+  # we return the time *before* querying, so that clients don't miss updates happening meanwhile
+  updated_at = datetime.datetime.utcnow()
+
+  batch = (db_session
+           .query(Batch)
+           .join(CiCommit)
+           .filter(
+             CiCommit.project_id == project_id,
+             CiCommit.hexsha.startswith(commit_id),
+             Batch.label == label,
+           )
+           .first()
+          )
+  if not batch:
+    # the batch may not have been created yet
+    return jsonify({"outputs": {}, "counts": {}, "updated_at": updated_at.isoformat(), "batch": None})
+
+  # we only load the columns we need, in particular not metrics/data that can be large
+  columns = {'id', 'is_pending', 'is_running', 'is_failed', 'deleted'}
+  for field in fields:
+    columns.update(computed_fields_columns.get(field, [field]))
+  columns = [c for c in columns if c in Output.__table__.columns]
+  query = (db_session
+           .query(Output)
+           .options(load_only(*columns))
+           .filter(Output.batch_id == batch.id)
+          )
+  if not any(f.startswith('test_input') or f == 'output_dir_url' for f in fields):
+    query = query.options(noload(Output.test_input))
+  if request.args.get('updated_since'):
+    try:
+      updated_since = datetime.datetime.fromisoformat(request.args['updated_since'])
+    except ValueError:
+      return jsonify({"error": f"Could not parse updated_since={request.args['updated_since']}, expected an ISO date"}), 400
+    query = query.filter(Output.updated_date >= updated_since)
+  outputs = {o.id: o.to_dict(fields=fields) for o in query}
+
+  # counts are always over the whole batch
+  counts = (db_session
+            .query(
+              func.count(Output.id),
+              func.count(Output.id).filter(Output.is_pending),
+              func.count(Output.id).filter(Output.is_running),
+              func.count(Output.id).filter(Output.is_failed),
+              func.count(Output.id).filter(Output.deleted),
+            )
+            .filter(Output.batch_id == batch.id)
+            .one()
+           )
+  response = make_response(ujson.dumps({
+    "batch": batch.id,
+    "outputs": outputs,
+    "counts": dict(zip(['total', 'pending', 'running', 'failed', 'deleted'], counts)),
+    "updated_at": updated_at.isoformat(),
+  }))
+  response.headers['Content-Type'] = 'application/json'
+  return response
+
 
 @app.route('/api/v1/batch/stop', methods=['POST'])
 @app.route('/api/v1/batch/stop/', methods=['POST'])
@@ -1,7 +1,8 @@
 import json
 import datetime
 
-from flask import request, jsonify, redirect, make_response
+import ujson
+from flask import request, jsonify, redirect, make_response, Response
 from sqlalchemy.orm.attributes import flag_modified
 
 from qaboard.conventions import deserialize_config
@@ -9,6 +10,7 @@ from qaboard.api import dir_to_url
 
 from backend import app, db_session
 from ..models import TestInput, CiCommit, Output
+from ..output_events import watch_outputs, output_statuses, is_done, TooManyWaiters, waiters_retry_after
 
 
 @app.route("/api/v1/output/<output_id>", methods=['GET', 'PUT', 'DELETE'])
@@ -47,6 +49,84 @@ def crud_output(output_id):
     return {"status": "OK"}
 
 
+# below uwsgi's harakiri timeout
+max_wait_timeout = 240 # seconds
+
+@app.route('/api/v1/outputs/wait', methods=['GET', 'POST'])
+@app.route('/api/v1/outputs/wait/', methods=['GET', 'POST'])
+def wait_outputs():
+  """
+  Waits until outputs are not pending anymore. The server is notified by the database, it does not poll.
+  Parameters, as a JSON body (POST), or as query parameters (GET):
+  - ids: output IDs, e.g. [1, 2, 3], or "1,2,3" in the query. Prefer POST if you wait for many outputs.
+  - mode: "all" (default) to wait until all outputs are done, or "any"
+  - timeout: in seconds, at most 240. If the response has `"done": false`, ask again.
+  - stream: if true, streams the status changes as server-sent events until done
+  If too many requests are already waiting, we answer right away with `"retry_after"` seconds.
+  """
+  if request.method == 'POST':
+    params = request.get_json(silent=True) or {}
+    ids = params.get('ids', [])
+  else:
+    params = request.args
+    ids = request.args.get('ids', '').split(',')
+  try:
+    ids = [int(id) for id in ids if id]
+  except (TypeError, ValueError):
+    ids = []
+  if not ids:
+    return jsonify({"error": "Please provide the output IDs, e.g. {\"ids\": [1, 2, 3]}"}), 400
+  mode = params.get('mode', 'all')
+  if mode not in ('all', 'any'):
+    return jsonify({"error": f"Unknown mode {mode}, expected 'all' or 'any'"}), 400
+  timeout = min(float(params.get('timeout', max_wait_timeout)), max_wait_timeout)
+  stream = str(params.get('stream')).lower() == 'true'
+
+  try:
+    watcher = watch_outputs(ids, timeout)
+    statuses = next(watcher)
+  except TooManyWaiters:
+    if stream:
+      return jsonify({"error": "Too many clients are waiting for outputs"}), 503, {'Retry-After': str(waiters_retry_after)}
+    statuses = output_statuses(ids)
+    return jsonify({"outputs": statuses, "done": is_done(statuses, ids, mode), "retry_after": waiters_retry_after})
+
+  if stream:
+    def events():
+      all_statuses = dict(statuses)
+      yield f"event: status\ndata: {ujson.dumps(statuses)}\n\n"
+      try:
+        while not is_done(all_statuses, ids, mode):
+          updates = next(watcher, None)
+          if updates is None:
+            yield "event: timeout\ndata: {}\n\n"
+            return
+          if not updates:
+            yield ": keep-alive\n\n"
+            continue
+          all_statuses.update(updates)
+          all_statuses = {id: s for id, s in all_statuses.items() if s}
+          yield f"event: status\ndata: {ujson.dumps(updates)}\n\n"
+        yield "event: done\ndata: {}\n\n"
+      finally:
+        watcher.close()
+    # the headers avoid buffering by reverse-proxies
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+  try:
+    done = is_done(statuses, ids, mode)
+    while not done:
+      updates = next(watcher, None)
+      if updates is None: # timeout
+        break
+      statuses.update(updates)
+      statuses = {id: s for id, s in statuses.items() if s}
+      done = is_done(statuses, ids, mode)
+  finally:
+    watcher.close()
+  return jsonify({"outputs": statuses, "done": done})
+
+
 @app.route('/api/v1/output/redo/<output_id>', methods=['POST'])
 @app.route('/api/v1/output/redo/<output_id>/', methods=['POST'])
 def output_redo(output_id):
@@ -117,19 +197,7 @@ def new_output_webhook():
 
   # We save the basic information about our result
   batch = ci_commit.get_or_create_batch(data['batch_label'])
-  if not batch.data:
-    batch.data = {}
-  batch.data.update({"type": data['job_type']})
-  if data.get('input_metadata'):
-    test_input.data['metadata'] = data['input_metadata']
-    flag_modified(test_input, "data")
-
-  platform = data['platform']
-  # for backward-compat with old clients
-  if platform == 'lsf':
-    platform = 'linux'
-
-  configurations = deserialize_config(data['configuration']) if 'configuration' in data else data['configurations']
+  platform, configurations = output_key_fields(data)
   output = Output.get_or_create(db_session,
                                          batch=batch,
                                          platform=platform,
@@ -137,6 +205,136 @@ def new_output_webhook():
                                          extra_parameters=data['extra_parameters'],
                                          test_input=test_input,
                                         )
+  update_output(output, test_input, batch, ci_commit, data)
+  db_session.add(ci_commit)
+  db_session.add(output)
+  db_session.commit()
+  return jsonify(output.to_dict())
+
+
+
+@app.route('/api/v1/outputs', methods=['POST'])
+@app.route('/api/v1/outputs/', methods=['POST'])
+def new_outputs_webhook():
+  """
+  Creates or updates many outputs at once, in a single transaction.
+  It is used by `qa batch` to mark all its runs as pending.
+
+  The payload has the same fields as /api/v1/output/, shared by all outputs,
+  plus a list of `outputs`, each with the fields that differ between outputs.
+  """
+  data = request.get_json()
+  outputs_data = [{**data, **output_data} for output_data in data.pop('outputs', [])]
+  # We check all outputs before writing anything
+  for index, output_data in enumerate(outputs_data):
+    missing_fields = missing_output_fields(output_data)
+    if missing_fields:
+      return jsonify({"error": f"Missing fields for output #{index}: {', '.join(missing_fields)}"}), 400
+
+  hexsha = data.get('commit_sha', data['git_commit_sha'])
+  try:
+    ci_commit = CiCommit.get_or_create(
+      session=db_session,
+      hexsha=hexsha,
+      project_id=data['project'],
+      data=data,
+    )
+  except Exception as e:
+    # Not a 404: clients understand it as "this server doesn't support bulk updates"
+    return jsonify({"error": f"Could not find your commit ({data['git_commit_sha']}). {e}", "commit_not_found": True}), 422
+
+  ci_commit.project.latest_output_datetime = datetime.datetime.utcnow()
+  ci_commit.latest_output_datetime = datetime.datetime.utcnow()
+
+  # To avoid 1 query per output, we look up existing inputs and outputs only once per batch
+  test_inputs = {}
+  batches_outputs = {}
+  outputs = []
+  try:
+    for output_data in outputs_data:
+      test_input_path = output_data.get('rel_input_path', output_data.get('input_path'))
+      test_input_key = (str(output_data['database']), str(test_input_path))
+      if test_input_key not in test_inputs:
+        test_inputs[test_input_key] = TestInput.get_or_create(
+          db_session,
+          path=test_input_path,
+          database=output_data['database'],
+        )
+      test_input = test_inputs[test_input_key]
+
+      batch = ci_commit.get_or_create_batch(output_data['batch_label'])
+      if batch.label not in batches_outputs:
+        batches_outputs[batch.label] = {output_key(o.test_input, o.platform, o.configurations, o.extra_parameters): o for o in batch.outputs}
+      batch_outputs = batches_outputs[batch.label]
+
+      platform, configurations = output_key_fields(output_data)
+      key = output_key(test_input, platform, configurations, output_data['extra_parameters'])
+      if key not in batch_outputs:
+        batch_outputs[key] = Output(
+          batch=batch,
+          test_input=test_input,
+          platform=platform,
+          configurations=configurations,
+          extra_parameters=output_data['extra_parameters'],
+        )
+      output = batch_outputs[key]
+      update_output(output, test_input, batch, ci_commit, output_data)
+      db_session.add(output)
+      outputs.append(output)
+
+    db_session.add(ci_commit)
+    db_session.commit()
+  except Exception as e:
+    # all outputs are saved, or none
+    db_session.rollback()
+    return jsonify({"error": f"Could not save the outputs. {e}"}), 500
+  return jsonify([{"id": o.id, "output_dir_url": o.output_dir_url} for o in outputs])
+
+
+
+# Fields needed to create an output, besides the commit/project information
+required_output_fields = ('database', 'batch_label', 'platform', 'extra_parameters', 'output_directory', 'job_type', 'user')
+
+def missing_output_fields(data):
+  missing = [f for f in required_output_fields if f not in data]
+  if not data.get('rel_input_path', data.get('input_path')):
+    missing.append('input_path')
+  if 'configuration' not in data and 'configurations' not in data:
+    missing.append('configurations')
+  return missing
+
+
+
+def output_key_fields(data):
+  platform = data['platform']
+  # for backward-compat with old clients
+  if platform == 'lsf':
+    platform = 'linux'
+  configurations = deserialize_config(data['configuration']) if 'configuration' in data else data['configurations']
+  return platform, configurations
+
+
+def output_key(test_input, platform, configurations, extra_parameters):
+  """Identifies outputs within a batch, like the unique constraint on the outputs table."""
+  # we can't use the test_input id since it may not be created yet
+  return (
+    test_input.database,
+    test_input.path,
+    platform,
+    json.dumps(configurations, sort_keys=True),
+    json.dumps(extra_parameters, sort_keys=True),
+  )
+
+
+def update_output(output, test_input, batch, ci_commit, data):
+  """Updates an output with the data sent by `qa run` or `qa batch`."""
+  if not batch.data:
+    batch.data = {}
+  batch.data.update({"type": data['job_type']})
+  if data.get('input_metadata'):
+    test_input.data['metadata'] = data['input_metadata']
+    flag_modified(test_input, "data")
+
   output.output_type = data.get('input_type', '')
 
   output.data = data.get('data', {}) # e.g. storage, job_options
@@ -164,12 +362,3 @@ def new_output_webhook():
     metrics = data.get('metrics', {})
     output.metrics = metrics
     output.is_failed = data.get('is_failed', False) or metrics.get('is_failed')
-
-  db_session.add(ci_commit)
-  db_session.add(output)
-  db_session.commit()
-  return jsonify(output.to_dict())
-
-
-
-
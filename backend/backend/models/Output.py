@@ -32,6 +32,8 @@ class Output(Base):
   batch_id = Column(Integer(), ForeignKey('batches.id'), index=True)
   batch = relationship("Batch", back_populates="outputs",)
   created_date = Column(DateTime, default=datetime.datetime.utcnow, index=True) # TODO make it desc
+  # lets clients poll only the outputs that changed
+  updated_date = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
   # when we delete an output we still keep the metadata and manifest
   # to *really* delete it, feel free to delete Output.output_dir and remove the row
   deleted = Column(Boolean(), default=False)
@@ -64,6 +66,7 @@ class Output(Base):
     # https://sqlalche.me/e/14/f405
     Index('idx_outputs_data_user', text("(data->>'user')")),#, postgresql_ops={'user': 'text_pattern_ops'}),
     Index('idx_outputs_filter', "batch_id", "test_input_id", "platform"),
+    Index('idx_outputs_batch_updated_date', "batch_id", "updated_date"),
     # we can't create an btree index on everything because JSON values can be big
     # https://github.com/doorkeeper-gem/doorkeeper/wiki/How-to-fix-PostgreSQL-error-on-index-row-size
     # https://dba.stackexchange.com/questions/162820/values-larger-than-1-3-of-a-buffer-page-cannot-be-indexed
@@ -130,7 +133,8 @@ class Output(Base):
            f"config='{self.configuration}' "
            f"filename='{self.test_input.filename}' /]")
 
-  def to_dict(self):
+  def to_dict(self, fields=None):
+    """Serializes the output. To send less data, you can ask only for some `fields`."""
     cols = [
      'id',
      'output_type',
@@ -144,14 +148,20 @@ class Output(Base):
      'data',
      'deleted',
     ]
-    as_dict = {c: getattr(self, c) for c in cols}
+    computed = {
+        'created_date': lambda: self.created_date.isoformat(),
+        'updated_date': lambda: self.updated_date.isoformat() if self.updated_date else None,
+        'output_dir_url': lambda: self.output_dir_url,
+        'test_input_database': lambda: str(self.test_input.database),
+        'test_input_path': lambda: str(self.test_input.path),
+        'test_input_metadata': lambda: self.test_input.data['metadata'] if (self.test_input.data and 'metadata' in self.test_input.data) else {},
+    }
+    if fields is None:
+      fields = [*cols, *computed]
     return {
-        **as_dict,
-        'created_date': self.created_date.isoformat(),
-        'output_dir_url': self.output_dir_url,
-        'test_input_database': str(self.test_input.database),
-        'test_input_path': str(self.test_input.path),
-        'test_input_metadata': self.test_input.data['metadata'] if (self.test_input.data and 'metadata' in self.test_input.data) else {},
+        f: computed[f]() if f in computed else getattr(self, f)
+        for f in fields
+        if f in computed or f in cols
     }
 
   @staticmethod
@@ -324,7 +334,8 @@ class Output(Base):
   def update_manifest(self, compute_hashes=True):
     qatools_config = self.batch.ci_commit.project.data.get('qatools_config', {})
     os.umask(0)
-    return save_outputs_manifest(self.output_dir, config=qatools_config, compute_hashes=compute_hashes)
+    # only files that changed since the last update are hashed again
+    return save_outputs_manifest(self.output_dir, config=qatools_config, compute_hashes=compute_hashes, incremental=True)
 
   def update_metrics(self, filepath=None):
     """Updates the metrics from a file"""
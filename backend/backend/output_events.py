@@ -0,0 +1,129 @@
+"""
+Lets clients wait for outputs to finish without polling.
+
+When the status of an output changes, we send a PostgreSQL notification (NOTIFY) with its ID.
+Requests waiting for outputs LISTEN for those notifications, and only query the database when
+one of the outputs they wait for changed. Notifications are delivered when transactions commit.
+
+Each waiting request holds a uwsgi worker and a database connection. To keep workers available for
+other requests, at most QABOARD_MAX_OUTPUT_WAITERS requests wait at the same time, across all workers.
+Each one holds a slot, implemented as a PostgreSQL advisory lock on its listening connection.
+"""
+import os
+import time
+import select
+from typing import List, Dict, Any, Iterator
+
+from sqlalchemy import event, inspect, select as sql_select
+
+from backend.database import engine
+from backend.models import Output
+
+
+channel = 'qaboard_outputs'
+status_columns = ('is_pending', 'is_running', 'is_failed', 'deleted')
+# we still check statuses regularly, e.g. if a notification was missed when the database restarted
+fallback_poll_interval = 30 # seconds
+
+# by default, a quarter of uwsgi's workers
+max_waiters = int(os.environ.get('QABOARD_MAX_OUTPUT_WAITERS', max(1, int(os.environ.get('UWSGI_PROCESSES', 4)) // 4)))
+# advisory locks are identified by two integers: this arbitrary key, and the slot
+waiters_lock_key = 8173
+# when there are too many waiters, how long clients should wait before asking again
+waiters_retry_after = 10 # seconds
+
+
+class TooManyWaiters(Exception):
+  pass
+
+
+def notify(connection, output_id: int):
+  connection.exec_driver_sql(f"SELECT pg_notify('{channel}', '{int(output_id)}')")
+
+
+@event.listens_for(Output, 'after_insert')
+def notify_insert(mapper, connection, target):
+  notify(connection, target.id)
+
+
+@event.listens_for(Output, 'after_update')
+def notify_update(mapper, connection, target):
+  state = inspect(target)
+  if any(state.attrs[c].history.has_changes() for c in status_columns):
+    notify(connection, target.id)
+
+
+def output_statuses(ids: List[int]) -> Dict[int, Dict[str, Any]]:
+  query = sql_select(Output.id, Output.is_pending, Output.is_running, Output.is_failed).where(Output.id.in_(ids))
+  with engine.connect() as connection:
+    return {row.id: dict(row._mapping) for row in connection.execute(query)}
+
+
+def is_done(statuses: Dict[int, Dict[str, Any]], ids: List[int], mode: str) -> bool:
+  # outputs that were deleted are not pending anymore
+  finished = [not statuses[id]['is_pending'] if id in statuses else True for id in ids]
+  return all(finished) if mode == 'all' else any(finished)
+
+
+def watch_outputs(ids: List[int], timeout: float) -> Iterator[Dict[int, Dict[str, Any]]]:
+  """
+  Yields the statuses of the outputs, then the statuses of the outputs that changed (None if deleted), until the timeout.
+  Yields an empty dict when nothing changed for a while, which can be used to send keep-alives.
+  Raises TooManyWaiters if too many requests are already waiting.
+  """
+  deadline = time.time() + timeout
+  wanted = set(ids)
+  # we need a dedicated connection, outside of any transaction, to receive notifications
+  connection = engine.raw_connection()
+  dbapi_connection = connection.connection
+  slot = None
+  try:
+    dbapi_connection.autocommit = True
+    with dbapi_connection.cursor() as cursor:
+      for candidate in range(max_waiters):
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (waiters_lock_key, candidate))
+        if cursor.fetchone()[0]:
+          slot = candidate
+          break
+      if slot is None:
+        raise TooManyWaiters()
+      cursor.execute(f"LISTEN {channel}")
+    # we listen before reading the statuses so that we can't miss a change
+    statuses = output_statuses(ids)
+    yield statuses
+    while time.time() < deadline:
+      wait = min(deadline - time.time(), fallback_poll_interval)
+      ready, _, _ = select.select([dbapi_connection], [], [], max(0, wait))
+      if ready:
+        dbapi_connection.poll()
+        changed = set()
+        while dbapi_connection.notifies:
+          notification = dbapi_connection.notifies.pop(0)
+          try:
+            changed.add(int(notification.payload))
+          except ValueError:
+            continue
+        changed &= wanted
+        if not changed:
+          continue
+      else:
+        changed = wanted
+      new_statuses = output_statuses(list(changed))
+      updates = {id: s for id, s in new_statuses.items() if statuses.get(id) != s}
+      for id in changed - set(new_statuses):
+        if id in statuses: # deleted
+          updates[id] = None
+          del statuses[id]
+      statuses.update({id: s for id, s in updates.items() if s is not None})
+      if updates or not ready:
+        yield updates
+  finally:
+    try:
+      with dbapi_connection.cursor() as cursor:
+        cursor.execute(f"UNLISTEN {channel}")
+        if slot is not None:
+          cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (waiters_lock_key, slot))
+      dbapi_connection.autocommit = False
+    finally:
+      # back to the pool
+      connection.close()
@@ -0,0 +1,59 @@
+import unittest
+from urllib.parse import urlencode
+
+from .utils import BackendTestCase
+
+
+class TestBatchStatus(BackendTestCase):
+  def batch_status(self, **params):
+    query = urlencode({"project": self.project, "commit": self.commit, **params})
+    r = self.client.get(f'/api/v1/batch/status?{query}')
+    self.assertEqual(r.status_code, 200, r.get_data(as_text=True))
+    return r.get_json()
+
+  def test_to_dict_fields(self):
+    from backend.models import Output
+    output_id = self.new_outputs(1)[0]
+    output = Output.query.filter(Output.id == output_id).one()
+    # unknown fields are ignored
+    self.assertEqual(set(output.to_dict(fields=['id', 'is_pending', 'test_input_path', 'unknown'])), {'id', 'is_pending', 'test_input_path'})
+    self.assertEqual(output.to_dict(fields=['test_input_path'])['test_input_path'], 'input-0')
+    # by default we get everything
+    self.assertTrue({'metrics', 'data', 'output_dir_url', 'updated_date'} <= set(output.to_dict()))
+
+  def test_batch_status(self):
+    ids = self.new_outputs(3)
+    status = self.batch_status()
+    self.assertEqual(status['counts'], {'total': 3, 'pending': 3, 'running': 0, 'failed': 0, 'deleted': 0})
+    self.assertEqual({int(i) for i in status['outputs']}, set(ids))
+    self.assertEqual(set(next(iter(status['outputs'].values()))), {'id', 'is_pending', 'is_running', 'is_failed', 'output_dir_url'})
+    # clients can ask only for some fields
+    status = self.batch_status(fields='id,is_failed')
+    self.assertEqual(set(next(iter(status['outputs'].values()))), {'id', 'is_failed'})
+
+  def test_batch_status_updated_since(self):
+    ids = self.new_outputs(3)
+    updated_at = self.batch_status()['updated_at']
+    r = self.client.put(f'/api/v1/output/{ids[0]}/', json={"is_pending": False, "is_failed": True})
+    self.assertEqual(r.status_code, 200)
+    # only the outputs that changed are sent again...
+    status = self.batch_status(updated_since=updated_at)
+    self.assertEqual([int(i) for i in status['outputs']], [ids[0]])
+    self.assertTrue(status['outputs'][str(ids[0])]['is_failed'])
+    # ...but the counts are over the whole batch
+    self.assertEqual(status['counts']['pending'], 2)
+    self.assertEqual(status['counts']['failed'], 1)
+    self.assertEqual(self.batch_status(updated_since=status['updated_at'])['outputs'], {})
+
+  def test_batch_status_errors(self):
+    # the batch was not created yet
+    status = self.batch_status()
+    self.assertIsNone(status['batch'])
+    self.assertEqual(status['outputs'], {})
+    self.new_outputs(1)
+    r = self.client.get(f'/api/v1/batch/status?{urlencode({"project": self.project, "commit": self.commit, "updated_since": "yesterday"})}')
+    self.assertEqual(r.status_code, 400)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,84 @@
+import time
+import threading
+import unittest
+from unittest import mock
+
+from .utils import BackendTestCase
+
+
+class TestWaitOutputs(BackendTestCase):
+  def finish_later(self, output_id, delay=0.5, **status):
+    """Updates an output from another thread, like a run finishing."""
+    def finish():
+      time.sleep(delay)
+      client = self.app.test_client()
+      client.put(f'/api/v1/output/{output_id}/', json={"is_pending": False, **status})
+    thread = threading.Thread(target=finish)
+    thread.start()
+    return thread
+
+  def wait(self, ids, **params):
+    r = self.client.post('/api/v1/outputs/wait', json={"ids": ids, **params})
+    self.assertEqual(r.status_code, 200, r.get_data(as_text=True))
+    return r.get_json()
+
+  def test_watch_outputs(self):
+    from backend.output_events import watch_outputs
+    ids = self.new_outputs(2)
+    watcher = watch_outputs(ids, timeout=10)
+    try:
+      statuses = next(watcher)
+      self.assertTrue(all(statuses[id]['is_pending'] for id in ids))
+      thread = self.finish_later(ids[0], is_failed=True)
+      start = time.time()
+      updates = next(watcher)
+      # we were notified, we did not wait for the fallback polling
+      self.assertLess(time.time() - start, 5)
+      self.assertEqual(list(updates), [ids[0]])
+      self.assertTrue(updates[ids[0]]['is_failed'])
+      thread.join()
+    finally:
+      watcher.close()
+
+  def test_wait(self):
+    ids = self.new_outputs(2)
+    threads = [self.finish_later(id) for id in ids]
+    data = self.wait(ids, timeout=10)
+    self.assertTrue(data['done'])
+    self.assertFalse(any(o['is_pending'] for o in data['outputs'].values()))
+    for thread in threads:
+      thread.join()
+    # older clients send the IDs in the URL
+    r = self.client.get(f'/api/v1/outputs/wait?ids={",".join(str(id) for id in ids)}')
+    self.assertTrue(r.get_json()['done'])
+
+  def test_wait_any(self):
+    ids = self.new_outputs(2)
+    thread = self.finish_later(ids[0])
+    self.assertTrue(self.wait(ids, mode='any', timeout=10)['done'])
+    thread.join()
+
+  def test_wait_timeout(self):
+    ids = self.new_outputs(1)
+    data = self.wait(ids, timeout=0.5)
+    self.assertFalse(data['done'])
+    self.assertTrue(data['outputs'][str(ids[0])]['is_pending'])
+
+  def test_wait_too_many_waiters(self):
+    from backend import output_events
+    ids = self.new_outputs(1)
+    with mock.patch.object(output_events, 'max_waiters', 0):
+      start = time.time()
+      data = self.wait(ids, timeout=10)
+    # we answer right away
+    self.assertLess(time.time() - start, 5)
+    self.assertFalse(data['done'])
+    self.assertEqual(data['retry_after'], output_events.waiters_retry_after)
+
+  def test_wait_errors(self):
+    self.assertEqual(self.client.post('/api/v1/outputs/wait', json={}).status_code, 400)
+    self.assertEqual(self.client.post('/api/v1/outputs/wait', json={"ids": [1], "mode": "some"}).status_code, 400)
+
+
+if __name__ == '__main__':
+  unittest.main()
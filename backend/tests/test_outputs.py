@@ -0,0 +1,37 @@
+import unittest
+
+from .utils import BackendTestCase
+
+
+class TestOutputs(BackendTestCase):
+  def test_new_outputs(self):
+    ids = self.new_outputs(3)
+    self.assertEqual(len(set(ids)), 3)
+    # outputs are identified by their input/platform/configurations/parameters
+    self.assertEqual(self.new_outputs(3), ids)
+    r = self.client.get(f'/api/v1/output/{ids[0]}/')
+    self.assertTrue(r.get_json()['is_pending'])
+
+  def test_new_outputs_are_validated_first(self):
+    from backend.models import CiCommit
+    outputs = [self.output_payload('input-0'), {**self.output_payload('input-1'), "input_path": None}]
+    r = self.client.post('/api/v1/outputs/', json=self.commit_payload(outputs=outputs))
+    self.assertEqual(r.status_code, 400)
+    self.assertIn('#1', r.get_json()['error'])
+    # nothing was written
+    self.assertIsNone(CiCommit.query.filter(CiCommit.hexsha == self.commit).one_or_none())
+
+  def test_new_outputs_unknown_commit(self):
+    # without the commit information, the server would need to read it from git
+    payload = self.commit_payload(outputs=[self.output_payload('input-0')])
+    del payload['qaboard_config']
+    for key in [k for k in payload if k.startswith('commit_') and k != 'commit_sha']:
+      del payload[key]
+    r = self.client.post('/api/v1/outputs/', json=payload)
+    # clients fall back to per-output requests on 404, which would not help
+    self.assertEqual(r.status_code, 422)
+    self.assertTrue(r.get_json()['commit_not_found'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+"""
+The backend tests need a PostgreSQL database, e.g. started with `docker-compose up -d db`.
+They use their own database (QABOARD_DB_NAME=qaboard_test by default), and are skipped if it can't be reached.
+
+    cd backend
+    QABOARD_DB_HOST=localhost python -m pytest tests
+"""
+import os
+import uuid
+import datetime
+import unittest
+
+os.environ.setdefault('QABOARD_DB_NAME', 'qaboard_test')
+
+
+class BackendTestCase(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    try:
+      from backend import app
+      from backend.database import engine, Base
+      import backend.models
+      with engine.connect():
+        pass
+    except Exception as e:
+      raise unittest.SkipTest(f'The backend tests need a database: {e}')
+    # In production the schema is managed by alembic migrations
+    Base.metadata.create_all(engine)
+    cls.app = app
+    cls.client = app.test_client()
+
+  def setUp(self):
+    # each test uses its own project and commit
+    self.project = f'tests/{uuid.uuid4().hex[:8]}'
+    self.commit = uuid.uuid4().hex + uuid.uuid4().hex[:8]
+
+  def tearDown(self):
+    from backend.database import db_session
+    db_session.remove()
+
+  def commit_payload(self, **kwargs):
+    """What `qa` sends about the commit, see qaboard.api.qaboard_payload"""
+    return {
+      "project": self.project,
+      "project_root": self.project,
+      "commit_sha": self.commit,
+      "git_commit_sha": self.commit,
+      "commit_branch": "master",
+      "commit_parents": [],
+      "commit_message": "test",
+      "commit_committer_name": "tests",
+      "commit_authored_datetime": datetime.datetime.utcnow().isoformat(),
+      "qaboard_config": {"project": {"name": self.project}},
+      "artifacts_commit": f"/tmp/qaboard-tests/{self.commit}",
+      "job_type": "local",
+      "user": "tests",
+      **kwargs,
+    }
+
+  def output_payload(self, input_path, **kwargs):
+    return {
+      "input_path": input_path,
+      "database": "/tmp/qaboard-tests/database",
+      "batch_label": "default",
+      "platform": "linux",
+      "configurations": [],
+      "extra_parameters": {},
+      "output_directory": f"/tmp/qaboard-tests/{self.commit}/{input_path}",
+      **kwargs,
+    }
+
+  def new_outputs(self, count, **kwargs):
+    """Creates pending outputs, and returns their IDs."""
+    outputs = [self.output_payload(f'input-{index}', is_pending=True) for index in range(count)]
+    r = self.client.post('/api/v1/outputs/', json=self.commit_payload(outputs=outputs, **kwargs))
+    self.assertEqual(r.status_code, 200, r.get_data(as_text=True))
+    return [o['id'] for o in r.get_json()]
@@ -3,6 +3,8 @@ Utilities related to CI database: fetching results, saving results...
 """
 import os
 import json
+import time
+import threading
 from pathlib import Path
 from copy import deepcopy
 from functools import lru_cache
@@ -107,21 +109,10 @@ def serialize_paths(data):
 
 
 
-def notify_qa_database(object_type='output', **kwargs):
-  """
-  """
-  import requests
-  from .config import is_ci, is_in_git_repo, config, _metrics
+def qaboard_payload(**kwargs) -> Dict[str, Any]:
+  """The data we send to QA-Board to create or update an object (output, batch, commit...)"""
+  from .config import is_ci, config, _metrics
   from .config import commit_id, commit_branch, commit_tag, commit_committer_name, commit_committer_email, commit_authored_datetime, commit_parents, commit_message
-
-  if kwargs.get('offline'):
-    return
-
-  # we only update QA-Board if we're in a CI run, or if the user used `qa --ci`
-  if not (is_ci or kwargs['share']):
-    return
-
-  url = f"{api_prefix}/{object_type}/"
   data = {
     'job_type': 'ci' if is_ci else 'local',
     'commit_sha': commit_id,
@@ -142,14 +133,54 @@ def notify_qa_database(object_type='output', **kwargs):
     "qaboard_config": serialize_paths(deepcopy(config)),
     "qaboard_metrics": _metrics,
   })
+  return data
+
+
+# Requests to QA-Board keep their connections alive
+api_timeout = float(os.environ.get('QA_API_TIMEOUT', 30)) # seconds
+# requests.Session is not thread-safe, each thread has its own
+_thread_data = threading.local()
+
+def api_session():
+  """Returns the requests.Session used by this thread for calls to QA-Board."""
+  session = getattr(_thread_data, 'session', None)
+  if session is None:
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _thread_data.session = session
+  return session
+
+
+def post_to_qa_database(url: str, data: Dict[str, Any], raise_not_found=False, retries=0, timeout=None):
+  """
+  POSTs data to QA-Board, and returns the server's response, or None if there was an error.
+  With `raise_not_found`, raises NotImplementedError if the server does not know about the url (e.g. older versions).
+  Connection errors and server errors are retried `retries` times.
+  """
+  import requests
   if 'QA_VERBOSE' in os.environ:
     click.secho(url, fg='cyan', err=True)
     click.secho(str(data), fg='cyan', dim=True, err=True)
 
+  r = None
   try:
     # we can't use requests' json serialization (simplejson or json) because it fails with numpy arrays
-    data = simplejson.dumps(data, ignore_nan=True, cls=NumpyEncoder)
-    r = requests.post(url, data=data, headers={'Content-Type': 'application/json'})
+    data_str = simplejson.dumps(data, ignore_nan=True, cls=NumpyEncoder)
+    for attempt in range(retries + 1):
+      try:
+        r = api_session().post(url, data=data_str, headers={'Content-Type': 'application/json'}, timeout=timeout or api_timeout)
+      except requests.exceptions.RequestException:
+        if attempt == retries:
+          raise
+      else:
+        if r.status_code < 500 or attempt == retries:
+          break
+      time.sleep(min(2 ** attempt, 30)) # seconds
+    assert r is not None
     if 'QA_VERBOSE' in os.environ:
       click.secho(r.text, fg='cyan', dim=True, err=True)
     r.raise_for_status()
@@ -158,12 +189,11 @@ def notify_qa_database(object_type='output', **kwargs):
     except:
       click.secho(f"WARNING: Can't understand the server response: {r.text}", fg='yellow', err=True)
   except Exception as e:
+    if raise_not_found and r is not None and r.status_code in (404, 405):
+      raise NotImplementedError(url)
     click.secho(f'WARNING: [{e}] Failed to update QA-Board.', fg='yellow', bold=True, err=True)
     click.secho(url, fg='yellow', err=True)
-    data = json.loads(data)
-    del data['qaboard_config']
-    del data['qaboard_metrics']
-    del data['inputs_settings']
+    data = {k: v for k, v in data.items() if k not in ('qaboard_config', 'qaboard_metrics', 'inputs_settings')}
     click.secho(str(data), fg='yellow', err=True)
     try:
       click.secho(str(r.request.headers), fg='yellow', dim=True, err=True)
@@ -171,13 +201,123 @@ def notify_qa_database(object_type='output', **kwargs):
       click.secho(f'{r.status_code}: {r.text}', fg='yellow', dim=True, err=True)
     except:
       pass
+  return None
+
+
+# Status updates that nobody waits for (e.g. "this run is now running") are sent
+# from a background thread, so that they don't delay the runs.
+notify_retries = int(os.environ.get('QA_NOTIFY_RETRIES', 3))
+# When `qa` exits, we don't wait long for QA-Board, e.g. if it is down
+exit_timeout = float(os.environ.get('QA_NOTIFY_EXIT_TIMEOUT', 10)) # seconds
+_notifications = None
+_exiting = False
+
+def _send_notifications(notifications):
+  while True:
+    url, data = notifications.get()
+    try:
+      if _exiting:
+        post_to_qa_database(url, data, timeout=exit_timeout)
+      else:
+        post_to_qa_database(url, data, retries=notify_retries)
+    finally:
+      notifications.task_done()
+
+
+def _notifications_queue():
+  global _notifications
+  if _notifications is None:
+    import queue
+    import atexit
+    _notifications = queue.Queue()
+    threading.Thread(target=_send_notifications, args=(_notifications,), daemon=True).start()
+    atexit.register(_flush_notifications_at_exit)
+  return _notifications
+
+
+def flush_notifications(timeout: Optional[float] = None) -> bool:
+  """Waits until all the notifications sent in the background are done. Returns False on timeout."""
+  if _notifications is None:
+    return True
+  if timeout is None:
+    _notifications.join()
+    return True
+  deadline = time.time() + timeout
+  with _notifications.all_tasks_done:
+    while _notifications.unfinished_tasks:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      _notifications.all_tasks_done.wait(remaining)
+  return True
+
+
+def _flush_notifications_at_exit():
+  global _exiting
+  _exiting = True # the notifications left are not retried
+  if not flush_notifications(timeout=exit_timeout):
+    click.secho(f'WARNING: Could not update QA-Board after {exit_timeout}s, giving up.', fg='yellow', err=True)
+
+
+def _should_notify(**kwargs) -> bool:
+  if kwargs.get('offline'):
+    return False
+  # we only update QA-Board if we're in a CI run, or if the user used `qa --ci`
+  return bool(is_ci or kwargs['share'])
+
+
+def notify_qa_database(object_type='output', blocking=True, **kwargs):
+  """
+  Creates or updates an object in QA-Board (output, batch, commit...).
+  With `blocking=False`, the update is sent in the background and we return None.
+  """
+  if not _should_notify(**kwargs):
+    return
+  url = f"{api_prefix}/{object_type}/"
+  data = qaboard_payload(**kwargs)
+  if not blocking:
+    _notifications_queue().put((url, data))
+    return
+  # Updates must reach QA-Board in order, e.g. "failed" after "running"
+  flush_notifications()
+  return post_to_qa_database(url, data)
+
+
+# How many outputs we send per request when registering outputs in bulk 
+notify_chunk_size = int(os.environ.get('QA_NOTIFY_CHUNK_SIZE', 500))
+
+def notify_qa_database_outputs(outputs: List[Dict[str, Any]], **kwargs) -> List[Optional[Dict[str, Any]]]:
+  """
+  Creates or updates many outputs at once. `kwargs` is data shared by all outputs (e.g. `ctx.obj`),
+  while each item of `outputs` has the data specific to each output.
+  Returns for each output what QA-Board knows about it (at least its `id`), or None on errors.
+  """
+  if not outputs or not _should_notify(**kwargs):
+    return [None for _ in outputs]
+  url = f"{api_prefix}/outputs/"
+  shared_data = qaboard_payload(**kwargs)
+  flush_notifications()
+  db_outputs: List[Optional[Dict[str, Any]]] = []
+  for start in range(0, len(outputs), notify_chunk_size):
+    chunk = outputs[start:start+notify_chunk_size]
+    try:
+      db_outputs_chunk = post_to_qa_database(url, {
+        **shared_data,
+        "outputs": [serialize_paths(o) for o in chunk],
+      }, raise_not_found=True)
+    except NotImplementedError:
+      # older QA-Board servers don't know about bulk updates
+      db_outputs_chunk = [notify_qa_database(**{**kwargs, **o}) for o in chunk]
+    if not db_outputs_chunk:
+      db_outputs_chunk = [None for _ in chunk]
+    db_outputs.extend(db_outputs_chunk)
+  return db_outputs
 
 
 def get_output(output_id):
-  import requests
   url = f"{api_prefix}/output/{output_id}/"
   try:
-    r = requests.get(url, headers={'Content-Type': 'application/json'})
+    r = api_session().get(url, headers={'Content-Type': 'application/json'}, timeout=api_timeout)
     r.raise_for_status()
     return r.json()
   except:
@@ -187,11 +327,66 @@ def get_output(output_id):
     except:
       pass
 
+def update_output(output_id, data: Dict[str, Any]):
+  """Updates the status, data or metrics of an existing output."""
+  url = f"{api_prefix}/output/{output_id}/"
+  try:
+    r = api_session().put(url, json=serialize_paths(data), timeout=api_timeout)
+    r.raise_for_status()
+    return r.json()
+  except:
+    click.secho(f'WARNING: Failed to contact the QA-Board. (PUT Output {output_id})', fg='yellow', bold=True, err=True)
+
+# The server answers long-polling requests after at most this duration
+wait_timeout = 240 # seconds
+
+def wait_for_outputs(output_ids: List, mode: str = 'all', timeout: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+  """
+  Waits until all (or any, with mode="any") of the outputs are not pending anymore, and returns their statuses by ID.
+  The server tells us when outputs change. With older servers, or if there are network issues, we poll.
+  """
+  deadline = time.time() + timeout if timeout else None
+  # the IDs are sent in the body, there can be too many for a URL
+  params = {"ids": [int(id) for id in output_ids], "mode": mode}
+  while True:
+    request_timeout = wait_timeout if not deadline else max(0, min(wait_timeout, deadline - time.time()))
+    try:
+      r = api_session().post(f'{api_prefix}/outputs/wait', json={**params, "timeout": request_timeout}, timeout=request_timeout + api_timeout)
+      if r.status_code in (404, 405): # older servers
+        break
+      r.raise_for_status()
+      data = r.json()
+      if data['done'] or (deadline and time.time() >= deadline):
+        return data['outputs']
+      # the server is busy with other clients waiting
+      if data.get('retry_after'):
+        time.sleep(data['retry_after'] if not deadline else max(0, min(data['retry_after'], deadline - time.time())))
+    except Exception as e:
+      click.secho(f'WARNING: [{e}] Failed to wait for outputs via QA-Board, we will poll.', fg='yellow', err=True)
+      break
+
+  outputs: Dict[str, Dict[str, Any]] = {}
+  failed_requests = 0
+  while True:
+    for id in output_ids:
+      if str(id) in outputs and not outputs[str(id)]["is_pending"]:
+        continue
+      output = get_output(id)
+      if output:
+        outputs[str(id)] = output
+      else:
+        failed_requests += 1
+    finished = [o for o in outputs.values() if not o["is_pending"]]
+    is_done = len(finished) == len(output_ids) if mode == 'all' else bool(finished)
+    if is_done or (deadline and time.time() >= deadline) or failed_requests > 10:
+      return outputs
+    time.sleep(5)
+
+
 # We used to use a cache but now we want to check run statuses before/after the batch
 # @lru_cache()
 def batch_info(reference, batch, is_branch=False, project=project, metrics: Optional[List[str]]=None):
   """Get data about a batch of outputs in the database"""
-  import requests
   params = {
     "project": str(project),
     "batch": batch,
@@ -202,7 +397,7 @@ def batch_info(reference, batch, is_branch=False, project=project, metrics: Opti
     params["branch"] = reference
   commit_id = reference if not is_branch else ''
   url = f'{api_prefix}/commit/{commit_id}'
-  r = requests.get(url, params=params)
+  r = api_session().get(url, params=params, timeout=api_timeout)
   try:
     data = r.json()
   except Exception as e:
@@ -217,13 +412,43 @@ def batch_info(reference, batch, is_branch=False, project=project, metrics: Opti
   return batches[batch]
 
 
-def get_outputs(qa_context: Optional[Dict[str, Any]]) -> Dict[int, Any]:
+# What `qa batch` needs to know about existing outputs
+status_fields = ['id', 'is_pending', 'is_running', 'is_failed', 'output_dir_url']
+matching_fields = [*status_fields, 'output_type', 'platform', 'configurations', 'extra_parameters', 'test_input_database', 'test_input_path']
+
+
+def batch_status(reference, batch, fields: Optional[List[str]] = None, updated_since: Optional[str] = None, project=project) -> Optional[Dict[str, Any]]:
+  """
+  Get the status of the outputs in a batch, with only the given output `fields`.
+  Returns None if the server is too old to support it.
+  Use the "updated_at" from the response as `updated_since` to only get the outputs that changed.
+  """
+  params = {
+    "project": str(project),
+    "commit": reference,
+    "batch": batch,
+  }
+  if fields:
+    params['fields'] = ','.join(fields)
+  if updated_since:
+    params['updated_since'] = updated_since
+  r = api_session().get(f'{api_prefix}/batch/status', params=params, timeout=api_timeout)
+  if r.status_code == 404:
+    return None
+  r.raise_for_status()
+  return r.json()
+
+
+def get_outputs(qa_context: Optional[Dict[str, Any]], fields: Optional[List[str]] = None) -> Dict[int, Any]:
   if not qa_context:
     return {}
   should_notify_qa_database = (is_ci or qa_context['share']) and not (qa_context['dryrun'] or qa_context['offline'])
   if not should_notify_qa_database:
     return {}
   try:
+    status = batch_status(reference=commit_id, batch=qa_context['batch_label'], fields=fields or matching_fields)
+    if status is not None:
+      return status['outputs']
     return batch_info(reference=commit_id, batch=qa_context['batch_label'])['outputs']
   except:
     return {}
@@ -243,23 +468,39 @@ def aggregated_metrics(batch_label, metrics=None):
   }
 
 
-def matching_output(output_reference: RunContext, outputs: List[Dict]):
+def output_key(run_context: RunContext, input_path: Optional[str] = None):
+  """
+  Canonical key identifying a run by its (input, platform, configurations, parameters).
+  Runs with the same key are the same run, e.g. from different batches or commits.
+  """
+  return (
+    input_path if input_path is not None else run_context.input_path.as_posix(),
+    run_context.platform,
+    json.dumps(run_context.configurations, sort_keys=True, default=str),
+    json.dumps(run_context.extra_parameters, sort_keys=True, default=str),
+  )
+
+
+def index_outputs(outputs: List[Dict]) -> Dict[Any, List[Dict]]:
+  """Returns the non-pending outputs by key, to match many runs with `matching_output`."""
+  index: Dict[Any, List[Dict]] = {}
+  for o in outputs:
+    if o["is_pending"]:
+      continue
+    key = output_key(RunContext.from_api_output(o), input_path=f'{o["test_input_database"]}/{o["test_input_path"]}')
+    index.setdefault(key, []).append(o)
+  return index
+
+
+def matching_output(output_reference: RunContext, outputs: List[Dict], index: Optional[Dict[Any, List[Dict]]] = None):
   """
   Return the output from from a given batch that is like a given output.
   This helps us compare an output to historical results.
+  If you match many outputs, build the `index` once with `index_outputs`.
   """
-  matching_outputs = [o for o in outputs if f'{o["test_input_database"]}/{o["test_input_path"]}' == output_reference.input_path.as_posix()]
-  valid_outputs = [o for o in matching_outputs if not o["is_pending"]]
-  def match_ref(output):
-    output_ctx = RunContext.from_api_output(output)
-    if not output_ctx.platform == output_reference.platform:
-      return False
-    if not json.dumps(output_ctx.configurations, sort_keys=True) == json.dumps(output_reference.configurations, sort_keys=True):
-      return False
-    if not json.dumps(output_ctx.extra_parameters, sort_keys=True) == json.dumps(output_reference.extra_parameters, sort_keys=True):
-      return False
-    return True
-  valid_outputs = [o for o in valid_outputs if match_ref(o)]
+  if index is None:
+    index = index_outputs(outputs)
+  valid_outputs = index.get(output_key(output_reference))
   if not valid_outputs:
     return None
   # at most 1, garanteed by database constaints
@@ -13,7 +13,7 @@ from click import secho
 
 from .conventions import make_batch_conf_dir, output_dirs_for_input_part
 from .iterators import iter_inputs
-from .utils import PathType
+from .utils import PathType, manifest_hash_algorithms
 from .config import commit_id, project, subproject, outputs_commit_root, outputs_commit, is_ci, default_platform, config
 from .config import user, default_batches_files
 
@@ -104,9 +104,18 @@ def cmpfiles(dir_1=Path(), dir_2=Path(), patterns=None, ignore=None, cmp=default
 
 
 
+def same_hashes(meta_1, meta_2):
+  """Compares two manifest entries using a hash algorithm they both recorded, or returns None if there is none."""
+  common = [key for key in meta_1 if key in manifest_hash_algorithms and key in meta_2]
+  if not common:
+    return None
+  return all(meta_1[key] == meta_2[key] for key in common)
+
+
 def cmpmanifests(manifest_path_1, manifest_path_2, patterns=None, ignore=None):
   """Bit-accuracy test between two manifests.
-  Their format is {filepath: {md5, size_st}}"""
+  Their format is {filepath: {st_size, <hash algorithm>: digest}}, usually md5 or blake2b.
+  Files hashed with different algorithms can't be compared and are reported as errors."""
   def parse_json(path):
     with path.open() as f:
       data = f.read()
@@ -151,8 +160,10 @@ def cmpmanifests(manifest_path_1, manifest_path_2, patterns=None, ignore=None):
       if any(fnmatch.fnmatch(file_1, f"{i}*") for i in ignore):
         continue
       if file_1_str in manifest_2:
-        is_same = meta_1['md5'] == manifest_2[file_1_str]['md5']
-        if not is_same:
+        is_same = same_hashes(meta_1, manifest_2[file_1_str])
+        if is_same is None:
+          errors.add(file_1)
+        elif not is_same:
           mismatch.add(file_1)
         else:
           match.add(file_1)
@@ -3,6 +3,7 @@ Provides a default QA configuration for the projects, by reading the configurati
 """
 import os
 import sys
+import json
 import datetime
 from getpass import getuser
 from pathlib import Path
@@ -11,7 +12,7 @@ from typing import Dict, Any, Tuple, List, Optional, Union
 import yaml
 import click
 
-from .utils import merge, getenvs
+from .utils import merge, getenvs, YamlLoader
 from .git import git_head, git_show
 from .conventions import slugify, get_commit_dirs, location_from_spec, batches_files
 from .iterators import flatten
@@ -42,7 +43,7 @@ def find_configs(path : Path) -> List[Tuple[Dict, Path]]:
           if not qatools_config_path.exists():
             continue
         with qatools_config_path.open('r') as f:
-            qatools_config = yaml.load(f, Loader=yaml.SafeLoader)
+            qatools_config = yaml.load(f, Loader=YamlLoader)
             if not qatools_config: # support empty files that just mark subprojects
               qatools_config = {}
             configsxpaths.append((qatools_config, qatools_config_path))
@@ -54,7 +55,36 @@ def find_configs(path : Path) -> List[Tuple[Dict, Path]]:
 
 
 
-qatools_configsxpaths = find_configs(path=Path())
+# `qa batch` shares the configuration it resolved with the `qa run` it starts, see config_snapshot() below.
+# It saves them from finding and parsing qaboard.yaml files, calling git...
+config_snapshot_version = 2
+
+def load_config_snapshot() -> Optional[Dict[str, Any]]:
+  snapshot_json = os.environ.get('QA_CONFIG_SNAPSHOT')
+  if not snapshot_json:
+    return None
+  try:
+    snapshot = json.loads(snapshot_json)
+  except ValueError:
+    return None
+  # the snapshot is only valid if we would have found the same qaboard.yaml files...
+  if snapshot.get('version') != config_snapshot_version or os.getcwd() not in snapshot.get('cwds', []):
+    return None
+  # ...and if they were not edited since
+  for path, mtime_ns in snapshot.get('mtimes', {}).items():
+    try:
+      if os.stat(path).st_mtime_ns != mtime_ns:
+        return None
+    except OSError:
+      return None
+  return snapshot
+
+snapshot = load_config_snapshot()
+cwd_at_import = os.getcwd()
+if snapshot:
+  qatools_configsxpaths = [(c, Path(p)) for c, p in snapshot['configs']]
+else:
+  qatools_configsxpaths = find_configs(path=Path())
 qatools_configs = [q[0] for q in qatools_configsxpaths]
 qatools_config_paths = [q[1] for q in qatools_configsxpaths]
 if not qatools_configsxpaths:
@@ -180,8 +210,9 @@ if root_qatools_config:
   assert project
   assert project_root
   outputs_root, artifacts_root = storage_roots(config, project, subproject)
-  mkdir(outputs_root)
-  mkdir(artifacts_root)
+  if not snapshot:
+    mkdir(outputs_root)
+    mkdir(artifacts_root)
   artifacts_project_root = artifacts_root / project_root
   artifacts_project = artifacts_root / project
   outputs_project_root = outputs_root / project_root
@@ -249,6 +280,11 @@ else:
     commit_tag = None
 
 
+if snapshot:
+    commit_id = snapshot['commit_id']
+    commit_branch = snapshot['commit_branch']
+    globals().update(snapshot['commit_details'])
+
 # TODO: refactor in git.py, consider calling git directly...
 repo_root = Path(os.environ.get('QA_REPO', str(root_qatools if root_qatools else Path())))
 is_in_git_repo = False
@@ -276,26 +312,42 @@ else:
     artifacts_branch_root = Path()
     artifacts_branch = Path()
 
-commit_committer_name: Optional[str] = user
-commit_committer_email: Optional[str] = None
-commit_authored_datetime = os.environ.get("GIT_AUTHORED_DATETIME", datetime.datetime.now(datetime.timezone.utc).isoformat())
-commit_message: Optional[str] = os.environ.get("GIT_MESSAGE")
-commit_parents: List[str] = []
-if commit_id and is_in_git_repo:
-  fields = ['%cn', '%ce', '%aI', '%P', "%B"]
-  try:
-    commit_info = git_show("%n".join(fields), commit_id)
-    fields_values = commit_info.split('\n', maxsplit=len(fields)-1)
-    commit_committer_name, commit_committer_email, commit_authored_datetime_, commit_parents_str, commit_message_ = fields_values
-    if not commit_authored_datetime:
-      commit_authored_datetime = commit_authored_datetime_
-    if not commit_message:
-      commit_message = commit_message_
-    commit_parents = commit_parents_str.split()
-  except Exception as e:
-    print(e)
-    # may fail when working on the first commit in a repo, like in our tests
-    pass
+# Details about the commit (commit_committer_name, commit_message...) need a `git` subprocess,
+# and most commands don't use them. They are computed on first access, see __getattr__ below.
+def commit_details() -> Dict[str, Any]:
+  details: Dict[str, Any] = {
+    "commit_committer_name": user,
+    "commit_committer_email": None,
+    "commit_authored_datetime": os.environ.get("GIT_AUTHORED_DATETIME", datetime.datetime.now(datetime.timezone.utc).isoformat()),
+    "commit_message": os.environ.get("GIT_MESSAGE"),
+    "commit_parents": [],
+  }
+  if commit_id and is_in_git_repo:
+    fields = ['%cn', '%ce', '%aI', '%P', "%B"]
+    try:
+      commit_info = git_show("%n".join(fields), commit_id)
+      fields_values = commit_info.split('\n', maxsplit=len(fields)-1)
+      commit_committer_name, commit_committer_email, commit_authored_datetime_, commit_parents_str, commit_message_ = fields_values
+      details["commit_committer_name"] = commit_committer_name
+      details["commit_committer_email"] = commit_committer_email
+      if not details["commit_authored_datetime"]:
+        details["commit_authored_datetime"] = commit_authored_datetime_
+      if not details["commit_message"]:
+        details["commit_message"] = commit_message_
+      details["commit_parents"] = commit_parents_str.split()
+    except Exception as e:
+      print(e)
+      # may fail when working on the first commit in a repo, like in our tests
+      pass
+  return details
+
+commit_details_names = ('commit_committer_name', 'commit_committer_email', 'commit_authored_datetime', 'commit_message', 'commit_parents')
+
+def __getattr__(name):
+  if name in commit_details_names:
+    globals().update(commit_details())
+    return globals()[name]
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if root_qatools_config:
@@ -370,7 +422,11 @@ available_metrics: Dict[str, Dict[str, Any]] = {}
 main_metrics: List = []
 
 metrics_file = config.get('outputs', {}).get('metrics')
-if metrics_file:
+if snapshot:
+  _metrics = snapshot['metrics']
+  available_metrics = _metrics.get('available_metrics', {})
+  main_metrics = _metrics.get('main_metrics', [])
+elif metrics_file:
   metrics_file_path = Path(root_qatools / metrics_file)
   if not metrics_file_path.exists():
     if not ignore_config_errors:
@@ -380,7 +436,7 @@ if metrics_file:
   else:
     with metrics_file_path.open(errors="surrogateescape") as f:
       try:
-        _metrics = yaml.load(f, Loader=yaml.SafeLoader)
+        _metrics = yaml.load(f, Loader=YamlLoader)
       except Exception as e:
         config_has_error = True
         if not ignore_config_errors:
@@ -396,6 +452,44 @@ default_secrets_path = os.environ.get('QA_SECRETS', '/home/ispq/.secrets.yaml' i
 secrets_path = Path(config.get('secrets', default_secrets_path))
 if secrets_path.exists():
   with secrets_path.open() as f:
-    secrets = yaml.load(f, Loader=yaml.SafeLoader)
+    secrets = yaml.load(f, Loader=YamlLoader)
 else:
   secrets = {}
+
+
+def config_snapshot() -> Optional[str]:
+  """
+  Serializes what we resolved when reading the configuration, for `qa run` started by `qa batch`.
+  Pass it to them with the QA_CONFIG_SNAPSHOT environment variable. Returns None if it can't be serialized.
+  It is only used if the runs start from the same directory, and if the configuration files did not change since.
+  """
+  if not qatools_configsxpaths:
+    return None
+  # runs check that the files we read were not edited since
+  paths = [*qatools_config_paths]
+  if metrics_file:
+    paths.append(Path(root_qatools / metrics_file))
+  try:
+    mtimes = {str(path.resolve()): path.stat().st_mtime_ns for path in paths}
+  except OSError:
+    return None
+  # we don't include secrets, they would be visible by anyone on the cluster
+  snapshot = {
+    "version": config_snapshot_version,
+    # from those directories we find the same qaboard.yaml files
+    "cwds": sorted({cwd_at_import, str(project_dir)} if project_dir else {cwd_at_import}),
+    "configs": [(c, str(p)) for c, p in qatools_configsxpaths],
+    "mtimes": mtimes,
+    "metrics": _metrics,
+    "commit_id": commit_id,
+    "commit_branch": commit_branch,
+    "commit_details": {name: getattr(sys.modules[__name__], name) for name in commit_details_names},
+  }
+  try:
+    snapshot_json = json.dumps(snapshot)
+  except (TypeError, ValueError): # e.g. dates in YAML files
+    return None
+  # we pass it as an environment variable, and they have a size limit
+  if len(snapshot_json) > 100_000:
+    return None
+  return snapshot_json
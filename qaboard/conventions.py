@@ -259,3 +259,12 @@ def output_dirs_for_input_part(input_path, database, config):
     if len(input_dir.as_posix()) > 70:
         input_dir = Path(slugify_hash(input_dir.as_posix(), maxlength=70))
     return input_dir
+
+
+def local_cache_dir() -> Path:
+  """Where qaboard caches data on the local host. Follows XDG conventions on linux, and uses %LOCALAPPDATA% on Windows."""
+  if 'QA_CACHE_DIR' in os.environ:
+    return Path(os.environ['QA_CACHE_DIR'])
+  if os.name == 'nt':
+    return Path(os.environ['LOCALAPPDATA']) / 'qaboard' / 'cache' if 'LOCALAPPDATA' in os.environ else Path.home() / '.cache' / 'qaboard'
+  return Path(os.environ['XDG_CACHE_HOME']) / 'qaboard' if 'XDG_CACHE_HOME' in os.environ else Path.home() / '.cache' / 'qaboard'
@@ -0,0 +1,202 @@
+"""
+Persistent cache of file hashes, used to avoid re-reading input files when computing manifests.
+
+Entries are keyed on the file's path and validated with its (device, inode, size, mtime) signature:
+if any of those changed, the file is hashed again. The cache is an SQLite database,
+one per inputs database, that can be shared by many concurrent `qa run` on the same host.
+When nothing changed, runs only read the cache.
+SQLite databases can be corrupted by concurrent writers from many hosts, so caches are never saved on network filesystems:
+if your home directory is on NFS, like on most LSF farms, each host uses its own cache in its temporary directory.
+
+It is opt-in, via qaboard.yaml:
+```yaml
+manifests:
+  cache: true  # or a host-local directory where the cache is saved. By default we use ~/.cache/qaboard/hashes
+  cache_max_entries: 1000000
+```
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from getpass import getuser
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+
+import click
+
+from .conventions import local_cache_dir, slugify_hash
+
+
+default_max_entries = 1_000_000
+# we only record when entries are used with this resolution, to avoid writing to the cache on each run
+accessed_resolution = 24 * 3600 # seconds
+network_filesystems = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs', 'afs', 'lustre', 'gpfs', 'ceph')
+
+
+def is_network_filesystem(path: Path) -> bool:
+  """Whether a path is on a network filesystem. We only know on linux."""
+  if os.name == 'nt':
+    return str(path).startswith('\\\\')
+  try:
+    with open('/proc/mounts') as f:
+      mounts = [line.split()[1:3] for line in f]
+  except OSError:
+    return False
+  path = os.path.realpath(path)
+  matching = [(mount_point, fs_type) for mount_point, fs_type in mounts if path == mount_point or path.startswith(mount_point.rstrip('/') + '/')]
+  if not matching:
+    return False
+  _, fs_type = max(matching, key=lambda m: len(m[0]))
+  return fs_type in network_filesystems
+
+
+def sqlite_cache_dir(cache_spec, name: str, label: str) -> Optional[Path]:
+  """
+  Returns where an SQLite cache is saved, given its setting: true for the default location, or a directory.
+  Returns None if the directory is on a network filesystem, where SQLite's locking is not reliable across hosts.
+  """
+  if cache_spec is True or cache_spec in ('1', 'true', 'True'):
+    cache_dir = local_cache_dir() / name
+    if is_network_filesystem(cache_dir):
+      try:
+        user = getuser()
+      except Exception: # e.g. in containers without a user
+        user = str(os.getuid()) if hasattr(os, 'getuid') else 'default'
+      cache_dir = Path(tempfile.gettempdir()) / f'qaboard-{user}' / name
+  else:
+    cache_dir = Path(cache_spec)
+  if is_network_filesystem(cache_dir):
+    click.secho(f'WARNING: The {label} is disabled: {cache_dir} is on a network filesystem, where concurrent runs from many hosts could corrupt it. Use a directory local to each host.', fg='yellow', err=True)
+    return None
+  return cache_dir
+
+
+class HashCache():
+  name = 'hash cache'
+
+  def __init__(self, path: Path, max_entries: int = default_max_entries):
+    self.path = path
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    # Writes are accumulated and saved when closing the cache, it limits lock contention between processes
+    self._new_entries: List[Tuple] = []
+    self._accessed: List[Tuple] = []
+    self._lock = threading.Lock()
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    # the hashing is done from many threads
+    self.connection = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+    # faster with concurrent readers. We are never on a network filesystem, where it would not be safe
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+    with self.connection:
+      self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS hashes (
+          path TEXT NOT NULL,
+          algorithm TEXT NOT NULL,
+          st_dev INTEGER, st_ino INTEGER, st_size INTEGER, st_mtime_ns INTEGER,
+          info TEXT NOT NULL,
+          accessed REAL NOT NULL,
+          PRIMARY KEY (path, algorithm)
+        )""")
+      self.connection.execute("CREATE INDEX IF NOT EXISTS hashes_accessed ON hashes (accessed)")
+      self.connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+  @staticmethod
+  def for_database(database: Path, config: Optional[Dict] = None) -> Optional['HashCache']:
+    """Returns the cache used for inputs from a given database, or None if the cache is not enabled."""
+    manifests_config = (config or {}).get('manifests', {})
+    cache_spec = os.environ.get('QA_HASH_CACHE', manifests_config.get('cache'))
+    if not cache_spec or cache_spec in ('0', 'false', 'False'):
+      return None
+    cache_dir = sqlite_cache_dir(cache_spec, 'hashes', HashCache.name)
+    if not cache_dir:
+      return None
+    database_slug = slugify_hash(Path(database).resolve().as_posix(), maxlength=64)
+    try:
+      return HashCache(
+        cache_dir / f'{database_slug}.sqlite',
+        max_entries=int(manifests_config.get('cache_max_entries', default_max_entries)),
+      )
+    except Exception as e:
+      click.secho(f'WARNING: [{e}] Could not open the hash cache in {cache_dir}', fg='yellow', err=True)
+      return None
+
+  def get(self, path: Path, stat: os.stat_result, algorithm: str = 'md5') -> Optional[Dict[str, Any]]:
+    """Returns the cached file info if the file did not change since it was hashed, otherwise None."""
+    signature = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    key = (str(path), algorithm)
+    with self._lock:
+      try:
+        row = self.connection.execute(
+          "SELECT st_dev, st_ino, st_size, st_mtime_ns, info, accessed FROM hashes WHERE path=? AND algorithm=?",
+          key,
+        ).fetchone()
+      except sqlite3.Error:
+        row = None
+      if row is None or tuple(row[:4]) != signature:
+        self.misses += 1
+        return None
+      self.hits += 1
+      now = time.time()
+      if now - row[5] > accessed_resolution:
+        self._accessed.append((now, *key))
+    return json.loads(row[4])
+
+  def put(self, path: Path, stat: os.stat_result, info: Dict[str, Any], algorithm: str = 'md5'):
+    with self._lock:
+      self._new_entries.append((str(path), algorithm, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, json.dumps(info), time.time()))
+
+  def stats(self) -> Dict[str, int]:
+    """Hit/miss counters, for this process and in total. Totals are only saved by processes that update the cache."""
+    try:
+      totals = dict(self.connection.execute("SELECT name, value FROM counters").fetchall())
+    except sqlite3.Error:
+      totals = {}
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "total_hits": totals.get('hits', 0) + self.hits,
+      "total_misses": totals.get('misses', 0) + self.misses,
+    }
+
+  def should_evict(self) -> bool:
+    # Counting entries is slow with large caches, so we only check from time to time,
+    # on average every 5% of max_entries new entries
+    return random.random() < 20 * len(self._new_entries) / self.max_entries
+
+  def evict(self):
+    """Removes the least recently used entries if there are too many."""
+    count = self.connection.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+    # we leave some slack to avoid evicting a few entries every time
+    if count > 1.1 * self.max_entries:
+      self.connection.execute(
+        "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY accessed ASC LIMIT ?)",
+        (count - self.max_entries,),
+      )
+
+  def close(self):
+    """Saves the new entries and closes the cache."""
+    with self._lock:
+      try:
+        # we don't lock the database for writing if nothing changed
+        if self._new_entries or self._accessed:
+          with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._new_entries)
+            self.connection.executemany("UPDATE hashes SET accessed=? WHERE path=? AND algorithm=?", self._accessed)
+            for name, value in (('hits', self.hits), ('misses', self.misses)):
+              self.connection.execute("INSERT OR IGNORE INTO counters VALUES (?, 0)", (name,))
+              self.connection.execute("UPDATE counters SET value = value + ? WHERE name=?", (value, name))
+            if self.should_evict():
+              self.evict()
+      except sqlite3.Error as e:
+        # the cache is just an optimization, it should never make runs fail
+        click.secho(f'WARNING: [{e}] Could not update the {self.name} at {self.path}', fg='yellow', err=True)
+      if 'QA_VERBOSE' in os.environ:
+        click.secho(f'{self.name.capitalize()}: {self.hits} hits, {self.misses} misses ({self.path})', dim=True, err=True)
+      self._new_entries, self._accessed = [], []
+      self.connection.close()
@@ -0,0 +1,178 @@
+"""
+Persistent index of the directory trees of inputs databases, used to find inputs without walking huge databases.
+
+For each directory we save its list of sub-directories, files and symbolic links to directories, validated by the directory's mtime:
+adding, removing or renaming an entry updates the mtime of its parent directory, so only directories
+that changed are listed again. Checking an unchanged directory costs a single `stat`.
+The index is an SQLite database, one per inputs database, shared by all processes on the host.
+Like the hash cache, it is never saved on network filesystems.
+
+It is opt-in, via qaboard.yaml:
+```yaml
+inputs:
+  index: true  # or a host-local directory where the index is saved. By default we use ~/.cache/qaboard/inputs
+```
+"""
+import os
+import json
+import time
+import fnmatch
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Iterator
+
+import click
+
+from .conventions import slugify_hash
+from .hash_cache import sqlite_cache_dir
+
+
+# Directories modified very recently may still change during the same mtime "tick", we don't index them yet
+recent_mtime_seconds = 2
+
+def has_magic(pattern: str) -> bool:
+  return any(c in pattern for c in '*?[')
+
+
+class InputsIndex():
+  def __init__(self, path: Path):
+    self.path = path
+    self.hits = 0
+    self.misses = 0
+    self._new_entries: List[Tuple] = []
+    # listings already read by this process
+    self._listings: Dict[str, Tuple[int, Tuple[List[str], List[str], List[str]]]] = {}
+    self._lock = threading.Lock()
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self.connection = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+    with self.connection:
+      self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS directories (
+          path TEXT PRIMARY KEY,
+          st_mtime_ns INTEGER NOT NULL,
+          listing TEXT NOT NULL
+        )""")
+
+  @staticmethod
+  def for_database(database: Path, config: Optional[Dict] = None) -> Optional['InputsIndex']:
+    """Returns the index of a given database, or None if the index is not enabled."""
+    inputs_config = (config or {}).get('inputs', {})
+    index_spec = os.environ.get('QA_INPUTS_INDEX', inputs_config.get('index'))
+    if not index_spec or index_spec in ('0', 'false', 'False'):
+      return None
+    index_dir = sqlite_cache_dir(index_spec, 'inputs', 'inputs index')
+    if not index_dir:
+      return None
+    database_slug = slugify_hash(Path(database).resolve().as_posix(), maxlength=64)
+    try:
+      return InputsIndex(index_dir / f'{database_slug}.sqlite')
+    except Exception as e:
+      click.secho(f'WARNING: [{e}] Could not open the inputs index in {index_dir}', fg='yellow', err=True)
+      return None
+
+  def listdir(self, directory: Path) -> Optional[Tuple[List[str], List[str], List[str]]]:
+    """
+    Returns the (sub-directories, files, symbolic links to directories) in a directory, or None if it can't be listed.
+    Like Path.rglob, "**" does not follow the symbolic links, to avoid loops.
+    """
+    try:
+      stat = os.stat(directory)
+    except OSError:
+      return None
+    key = str(directory)
+    listing = self._listings.get(key)
+    if listing is not None and listing[0] == stat.st_mtime_ns:
+      return listing[1]
+    with self._lock:
+      try:
+        row = self.connection.execute("SELECT st_mtime_ns, listing FROM directories WHERE path=?", (key,)).fetchone()
+      except sqlite3.Error:
+        row = None
+    # older indexes did not save the symbolic links separately
+    cached_listing = json.loads(row[1]) if row is not None and row[0] == stat.st_mtime_ns else None
+    if cached_listing is not None and len(cached_listing) == 3:
+      self.hits += 1
+      subdirs, files, linked_dirs = cached_listing
+      self._listings[key] = (stat.st_mtime_ns, (subdirs, files, linked_dirs))
+      return subdirs, files, linked_dirs
+
+    self.misses += 1
+    subdirs, files, linked_dirs = [], [], []
+    try:
+      with os.scandir(directory) as entries:
+        for entry in entries:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              subdirs.append(entry.name)
+            elif entry.is_symlink() and entry.is_dir():
+              linked_dirs.append(entry.name)
+            else:
+              files.append(entry.name)
+          except OSError:
+            continue
+    except OSError:
+      return None
+    self._listings[key] = (stat.st_mtime_ns, (subdirs, files, linked_dirs))
+    if stat.st_mtime < time.time() - recent_mtime_seconds:
+      with self._lock:
+        self._new_entries.append((key, stat.st_mtime_ns, json.dumps([subdirs, files, linked_dirs])))
+    return subdirs, files, linked_dirs
+
+  def glob(self, directory: Path, pattern: str) -> Iterator[Path]:
+    """Like Path.glob, but using the index."""
+    seen = set()
+    for path in self._select(directory, Path(pattern).parts):
+      if path not in seen:
+        seen.add(path)
+        yield path
+
+  def rglob(self, directory: Path, pattern: str) -> Iterator[Path]:
+    """Like Path.rglob, but using the index."""
+    yield from self.glob(directory, f'**/{pattern}')
+
+  def _select(self, directory: Path, parts: Tuple[str, ...]) -> Iterator[Path]:
+    if not parts:
+      yield directory
+      return
+    part, rest = parts[0], parts[1:]
+    if part == '**':
+      yield from self._select(directory, rest)
+      listing = self.listdir(directory)
+      if listing:
+        for subdir in listing[0]:
+          yield from self._select(directory / subdir, parts)
+    elif not has_magic(part):
+      # no need to list the directory, it also keeps the semantics of pathlib for e.g. ".." or case-insensitive filesystems
+      child = directory / part
+      if rest:
+        if child.is_dir():
+          yield from self._select(child, rest)
+      elif child.exists():
+        yield child
+    else:
+      listing = self.listdir(directory)
+      if not listing:
+        return
+      subdirs, files, linked_dirs = listing
+      for name in (subdirs + linked_dirs if rest else subdirs + linked_dirs + files):
+        if fnmatch.fnmatch(name, part):
+          yield from self._select(directory / name, rest)
+
+  def stats(self) -> Dict[str, int]:
+    return {"hits": self.hits, "misses": self.misses}
+
+  def close(self):
+    """Saves the new entries and closes the index."""
+    with self._lock:
+      try:
+        with self.connection:
+          self.connection.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", self._new_entries)
+      except sqlite3.Error as e:
+        click.secho(f'WARNING: [{e}] Could not update the inputs index at {self.path}', fg='yellow', err=True)
+      if 'QA_VERBOSE' in os.environ:
+        click.secho(f'Inputs index: {self.hits} directories unchanged, {self.misses} listed ({self.path})', dim=True, err=True)
+      self._new_entries = []
+      self.connection.close()
@@ -18,7 +18,7 @@ import yaml
 import click
 
 from .conventions import pretty_hash, get_settings, location_from_spec
-from .utils import input_metadata, entrypoint_module
+from .utils import inputs_metadata, entrypoint_module, YamlLoader
 from .compat import cased_path
 from .run import RunContext
 
@@ -72,12 +72,59 @@ def match(value, value_filter) -> bool:
     return value == value_filter
 
 
-def iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config, only=None, exclude=None):
+class DatabaseIndexes():
+  """
+  The inputs indexes and metadata caches of each database, kept open during a whole pass over the batches
+  instead of being opened again for every batch.
+  """
+  def __init__(self, qatools_config):
+    self.qatools_config = qatools_config
+    self.inputs_indexes: Dict = {}
+    self.metadata_caches: Dict = {}
+
+  def inputs_index(self, database):
+    from .inputs_index import InputsIndex
+    key = str(database)
+    if key not in self.inputs_indexes:
+      self.inputs_indexes[key] = InputsIndex.for_database(database, self.qatools_config)
+    return self.inputs_indexes[key]
+
+  def metadata_cache(self, database):
+    from .metadata_cache import MetadataCache
+    key = str(database)
+    if key not in self.metadata_caches:
+      self.metadata_caches[key] = MetadataCache.for_database(database, self.qatools_config)
+    return self.metadata_caches[key]
+
+  def close(self):
+    for index in [*self.inputs_indexes.values(), *self.metadata_caches.values()]:
+      if index:
+        index.close()
+    self.inputs_indexes, self.metadata_caches = {}, {}
+
+
+def iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config, only=None, exclude=None, indexes=None):
+  own_indexes = indexes is None
+  if own_indexes:
+    indexes = DatabaseIndexes(qatools_config)
+  inputs_index = indexes.inputs_index(database)
+  metadata_cache = indexes.metadata_cache(database) if only or exclude else None
+  try:
+    yield from _iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config, only, exclude, inputs_index, metadata_cache)
+  finally:
+    if own_indexes:
+      indexes.close()
+
+
+def _iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config, only=None, exclude=None, inputs_index=None, metadata_cache=None):
   if not path:
     path = "*"
+  # On huge databases, walking the tree is slow, and the index lets us only list directories that changed
+  glob_ = inputs_index.glob if inputs_index else lambda directory, pattern: directory.glob(pattern)
+  rglob_ = inputs_index.rglob if inputs_index else lambda directory, pattern: directory.rglob(pattern)
 
   maybe_parent = lambda path: path.parent if use_parent_folder else path
-  input_paths = list(database.glob(str(path))) # to support wildcards
+  input_paths = list(glob_(database, str(path))) # to support wildcards
   if not input_paths:
     if 'QA_BATCH_FAIL_IF_EMPTY' in os.environ:
       click.secho(f'ERROR: No inputs found for the batch "{path}"', fg='red', err=True)
@@ -97,13 +144,16 @@ def iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config
   for glob in globs:
     for input_path in input_paths:
       input_path = cased_path(input_path)
-      inputs = set([maybe_parent(f) for f in input_path.rglob(glob)])
+      inputs = set([maybe_parent(f) for f in rglob_(input_path, glob)])
       inputs = [cased_path(i) for i in inputs] # fix case issues on Windows
       if fnmatch.fnmatch(input_path, f'*/{glob}') or str(input_path).endswith(glob):
         inputs.append(cased_path(input_path))
-      for i in inputs:
+      if only or exclude:
+        # user metadata functions are often slow, we compute them in parallel
+        metadatas = inputs_metadata(inputs, database, qatools_config, metadata_cache)
+      for idx, i in enumerate(inputs):
         if only or exclude:
-          metadata = input_metadata(i, database, i.relative_to(database), qatools_config)
+          metadata = metadatas[idx]
           if only:
             if not match(metadata, only): continue
           if exclude:
@@ -135,7 +185,7 @@ def iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config
       click.secho(f'WARNING: No inputs found matching "{path}" [{globs}] under "{database}".', fg='yellow', err=True)
 
 
-def _iter_inputs(path, database, inputs_settings, qatools_config, only=None, exclude=None):
+def _iter_inputs(path, database, inputs_settings, qatools_config, only=None, exclude=None, indexes=None):
   if path and Path(path).is_absolute():
     database_str, *path_parts =  Path(path).parts
     path = Path(*path_parts)
@@ -162,7 +212,7 @@ def _iter_inputs(path, database, inputs_settings, qatools_config, only=None, exc
   elif not isinstance(globs, tuple) and not isinstance(globs, list):
     globs = [globs]
   use_parent_folder = inputs_settings.get('use_parent_folder', False)
-  yield from iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config, only=only, exclude=exclude)
+  yield from iter_inputs_at_path(path, database, globs, use_parent_folder, qatools_config, only=only, exclude=exclude, indexes=indexes)
 
 
 
@@ -186,7 +236,7 @@ def iter_inputs(
     try:
       from .config import project, subproject
       batches_file_path = location_from_spec(batches_file, {"project": project, "subproject": subproject})
-      new_batches = yaml.load(open(batches_file_path), Loader=yaml.SafeLoader)
+      new_batches = yaml.load(open(batches_file_path), Loader=YamlLoader)
       if new_batches is None:
         click.secho(f"WARNING: no data in: {batches_file}", fg='yellow', err=True)
         continue
@@ -250,18 +300,22 @@ def iter_inputs(
     type=inputs_settings['type']
   )
 
-  for batch in batches:
-    if debug: click.secho(f'batch: {batch}', dim=True, err=True)
+  indexes = DatabaseIndexes(qatools_config)
+  try:
+    for batch in batches:
+      if debug: click.secho(f'batch: {batch}', dim=True, err=True)
 
-    # We can ask for two types of batches:
-    # 1. All inputs under a given folder in the database
-    if batch not in available_batches:
-      # Maybe we asked recordings from a location...
-      if debug: click.secho(str(batch), bold=True, fg='cyan', err=True)
-      inputs_iter = _iter_inputs(batch, run_context.database, inputs_settings, qatools_config)
-      yield from (replace(run_context, input_path=i, database=d) for i, d in inputs_iter)
-    else:
-      yield from iter_batch(available_batches[batch], run_context, qatools_config, inputs_settings, debug)
+      # We can ask for two types of batches:
+      # 1. All inputs under a given folder in the database
+      if batch not in available_batches:
+        # Maybe we asked recordings from a location...
+        if debug: click.secho(str(batch), bold=True, fg='cyan', err=True)
+        inputs_iter = _iter_inputs(batch, run_context.database, inputs_settings, qatools_config, indexes=indexes)
+        yield from (replace(run_context, input_path=i, database=d) for i, d in inputs_iter)
+      else:
+        yield from iter_batch(available_batches[batch], run_context, qatools_config, inputs_settings, debug, indexes)
+  finally:
+    indexes.close()
 
 
 class SubscriptableDict:
@@ -308,7 +362,7 @@ def deep_interpolate(value, replaced: str, to_value):
     return value
 
 
-def iter_batch(batch: Dict, default_run_context: RunContext, qatools_config, default_inputs_settings, debug):
+def iter_batch(batch: Dict, default_run_context: RunContext, qatools_config, default_inputs_settings, debug, indexes=None):
     # Happens often when there is an orphan "my-batch:" in in the yaml file
     if batch is None:
       return
@@ -319,6 +373,10 @@ def iter_batch(batch: Dict, default_run_context: RunContext, qatools_config, def
     if 'platform' in batch:
       run_context.platform = batch['platform']
     runner = run_context.job_options.get('type', 'local')
+    if runner == 'local' and batch.get('lsf'):
+      # local runs can be packed on the host like on LSF, according to the threads/memory they need
+      from .runners.local_scheduler import resource_options
+      run_context.job_options = {**{k: v for k, v in batch['lsf'].items() if k in resource_options}, **run_context.job_options}
     if batch.get(runner):
       run_context.job_options = {**run_context.job_options, **batch[runner]}
 
@@ -360,12 +418,12 @@ def iter_batch(batch: Dict, default_run_context: RunContext, qatools_config, def
           if param in ['configuration', 'configurations', 'configs', 'platform']:
             continue
           matrix_run_context.configurations = deep_interpolate(matrix_run_context.configurations, 'matrix', {param: value})
-        yield from iter_batch(batch_, matrix_run_context, qatools_config, default_inputs_settings, debug)
+        yield from iter_batch(batch_, matrix_run_context, qatools_config, default_inputs_settings, debug, indexes)
       return
 
     locations = batch.get('inputs', batch.get('tests'))
     if not locations:
-      inputs_iter = _iter_inputs(None, run_context.database, inputs_settings, qatools_config, only=batch.get('only'), exclude=batch.get('exclude'))
+      inputs_iter = _iter_inputs(None, run_context.database, inputs_settings, qatools_config, only=batch.get('only'), exclude=batch.get('exclude'), indexes=indexes)
       yield from (replace(run_context, input_path=i, database=d) for i, d in inputs_iter)
       return
 
@@ -418,7 +476,7 @@ def iter_batch(batch: Dict, default_run_context: RunContext, qatools_config, def
         else: # string?
           location_run_context.configurations =  [*location_run_context.configurations, location_configurations]
       if debug: click.secho(str(location_run_context.database / location), bold=True, fg='cyan', err=True)
-      inputs_iter = _iter_inputs(location, location_run_context.database, location_inputs_settings, qatools_config, only=batch.get('only'), exclude=batch.get('exclude'))
+      inputs_iter = _iter_inputs(location, location_run_context.database, location_inputs_settings, qatools_config, only=batch.get('only'), exclude=batch.get('exclude'), indexes=indexes)
       yield from (replace(location_run_context, input_path=i, database=d) for i, d in inputs_iter)
 
 
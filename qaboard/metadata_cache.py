@@ -0,0 +1,96 @@
+"""
+Persistent cache of the inputs' metadata, as returned by the `metadata` function from the entrypoint.
+
+Metadata functions often parse file headers, and filtering batches with `only`/`exclude` calls them for every input.
+Entries are keyed on the input's path and validated with its (device, inode, size, mtime) signature,
+for directories with the total size and latest mtime of everything inside, and with a hash of the entrypoint's source: if you change your `metadata` function, metadata is computed again.
+Note that only the entrypoint file itself is hashed, not the modules it imports.
+
+It is opt-in, via qaboard.yaml:
+```yaml
+inputs:
+  metadata_cache: true  # or a host-local directory where the cache is saved. By default we use ~/.cache/qaboard/metadata
+```
+"""
+import os
+import stat
+import hashlib
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional, Dict, Any
+
+import click
+
+from .conventions import slugify_hash
+from .hash_cache import HashCache, default_max_entries, sqlite_cache_dir
+
+
+class MetadataCache(HashCache):
+  name = 'metadata cache'
+
+  def __init__(self, path: Path, entrypoint_hash: str, max_entries: int = default_max_entries):
+    super().__init__(path, max_entries)
+    self.entrypoint_hash = entrypoint_hash
+
+  @staticmethod
+  def for_database(database: Path, config: Optional[Dict] = None) -> Optional['MetadataCache']: # type: ignore
+    """Returns the cache used for inputs from a given database, or None if the cache is not enabled."""
+    inputs_config = (config or {}).get('inputs', {})
+    cache_spec = os.environ.get('QA_METADATA_CACHE', inputs_config.get('metadata_cache'))
+    if not cache_spec or cache_spec in ('0', 'false', 'False'):
+      return None
+    entrypoint = (config or {}).get('project', {}).get('entrypoint')
+    try:
+      entrypoint_hash = hashlib.md5(Path(entrypoint).read_bytes()).hexdigest()
+    except Exception: # no entrypoint, the error is reported when we try to import it
+      return None
+    cache_dir = sqlite_cache_dir(cache_spec, 'metadata', MetadataCache.name)
+    if not cache_dir:
+      return None
+    database_slug = slugify_hash(Path(database).resolve().as_posix(), maxlength=64)
+    try:
+      return MetadataCache(
+        cache_dir / f'{database_slug}.sqlite',
+        entrypoint_hash=entrypoint_hash,
+        max_entries=int(inputs_config.get('metadata_cache_max_entries', default_max_entries)),
+      )
+    except Exception as e:
+      click.secho(f'WARNING: [{e}] Could not open the metadata cache in {cache_dir}', fg='yellow', err=True)
+      return None
+
+  @staticmethod
+  def stat(path: Path):
+    """
+    Returns the signature used to validate the cached metadata of an input.
+    When inputs are directories, their own mtime doesn't change when the files inside are modified,
+    so we use the total size and the latest mtime of all the files and directories inside.
+    """
+    path_stat = os.stat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+      return path_stat
+    size, mtime_ns = 0, path_stat.st_mtime_ns
+    directories = [str(path)]
+    while directories:
+      with os.scandir(directories.pop()) as entries:
+        for entry in entries:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              directories.append(entry.path)
+              entry_stat = entry.stat(follow_symlinks=False)
+            else:
+              entry_stat = entry.stat()
+              size += entry_stat.st_size
+          except OSError: # e.g. broken symbolic links
+            continue
+          mtime_ns = max(mtime_ns, entry_stat.st_mtime_ns)
+    return SimpleNamespace(st_dev=path_stat.st_dev, st_ino=path_stat.st_ino, st_size=size, st_mtime_ns=mtime_ns)
+
+  def get(self, path: Path, stat: os.stat_result) -> Optional[Dict[str, Any]]: # type: ignore
+    """Returns the cached metadata if the input and the entrypoint did not change since, otherwise None."""
+    return super().get(path, stat, algorithm=self.entrypoint_hash)
+
+  def put(self, path: Path, stat: os.stat_result, metadata: Dict[str, Any]): # type: ignore
+    try:
+      super().put(path, stat, metadata, algorithm=self.entrypoint_hash)
+    except (TypeError, ValueError): # metadata that can't be saved as JSON is not cached
+      pass
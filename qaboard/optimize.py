@@ -7,9 +7,8 @@ import datetime
 import subprocess
 
 import click
-from joblib import Parallel, delayed
 
-from .api import NumpyEncoder, batch_info, notify_qa_database, print_url, matching_output
+from .api import NumpyEncoder, batch_info, notify_qa_database, print_url, matching_output, index_outputs
 from .config import project, subproject, commit_id, outputs_commit, available_metrics, default_batches_files, default_platform
 from .conventions import batch_dir
 from .utils import PathType, getenvs
@@ -24,9 +23,10 @@ from .run import RunContext
 @click.option('--batches-file', 'batches_files', default=default_batches_files, multiple=True, help="YAML file listing batches of inputs+config+database selected from the database.")
 @click.option('--config-file', required=True, type=PathType(), help="YAML search space configuration file.")
 @click.option('--parallel-param-sampling', type=int, help="Parallel paramater sampling.")
+@click.option('--async', 'asynchronous', is_flag=True, default=None, help="Keep --parallel-param-sampling evaluations running at all times, and ask for a new point as soon as one finishes.")
 @click.argument('forwarded_args', nargs=-1, type=click.UNPROCESSED)
 @click.pass_context
-def optimize(ctx, batches, batches_files, config_file, parallel_param_sampling, forwarded_args):
+def optimize(ctx, batches, batches_files, config_file, parallel_param_sampling, asynchronous, forwarded_args):
   import numpy as np
   np.random.seed(int(os.environ.get('QA_SEED', 101)))
 
@@ -56,100 +56,112 @@ def optimize(ctx, batches, batches_files, config_file, parallel_param_sampling,
   if not parallel_param_sampling:
     parallel_param_sampling = optim_config.get('parallel_sampling', 1)
 
+  if asynchronous is None:
+    asynchronous = optim_config.get('asynchronous', False)
+
+  def report(iteration, suggested, y, results):
+    """Saves in QA-Board the results of an iteration, and whether they are the best so far."""
+    iteration_batch_label = f"{ctx.obj['batch_label']}|iter{iteration+1}"
+    iteration_batch_dir = batch_dir_for(iteration_batch_label)
+    metrics = tuple([m for m in optim_config['objective'].keys() if m != 'target'])
+    aggregated_metrics_ = aggregated_metrics(iteration_batch_label, metrics=metrics)
+    notify_qa_database(**{
+      **ctx.obj,
+      **{
+        "extra_parameters": dim_mapping(suggested),
+        # TODO: we really should to tuning/platform in make_batch_conf_dir
+        #       1. make change, 2. rename existing folders)
+        "output_directory": iteration_batch_dir,
+        'input_path': '|'.join(batches),
+        # we want to show in the summary tab the best results for the tuning experiment
+        # but in the exploration see the results per iteration....
+        "input_type": 'optim_iteration', # or... single ? don't show them in the UI
+        "is_pending": False,
+        "is_failed": False,
+        "metrics": {
+          "iteration": iteration+1,
+          "objective": y,
+          **aggregated_metrics_,
+        },
+      },
+    }, command=command)
+
+    # results
+    #    .x [float]: location of the minimum.
+    #    .fun [float]: function value at the minimum.
+    #    .models: surrogate models used for each iteration.
+    #    .x_iters [array]: location of function evaluation for each iteration.
+    #    .func_vals [array]: function value for each iteration.
+    #    .space [Space]: the optimization space.
+    #    .specs [dict]: parameters passed to the function.
+    # Note: with --async, results are not told in the order of the iterations
+    is_best = y <= results.fun or len(results.func_vals) == 1
+    if is_best:
+      click.secho(f'New best @iteration{iteration+1}: {y} at iteration {iteration+1}', fg='green')
+
+    is_best_data = {
+      "is_best_iter": True,
+      "best_params": dim_mapping(suggested),
+      "best_metrics": {
+        "objective": y,
+        **aggregated_metrics_,
+      },
+    } if is_best else {}
+
+    notify_qa_database(
+      object_type='batch',
+      command=command,
+      **ctx.obj,
+      **{"data": {
+          "optimization": True,
+          "iteration": iteration+1,
+          "iteration_label": iteration_batch_label,
+          **is_best_data,
+      }},
+    )
+
+    if is_best:
+      try:
+        click.secho(f'Creating plots', fg='blue')
+        make_plots(results, optim_dir)
+      except:
+        pass
+    else:
+      # We remove the results to make sure we don't waste disk space
+      # It is also be done server-side...
+      print(f"RM {iteration_batch_dir}")
+      rmtree(iteration_batch_dir, ignore_errors=True)
+
   # TODO: warm-start
   #   load and "tell" existing results (if there are any)
   #   (or use a checkpoint?)
-  for iteration in range(0, optim_config['evaluations'], parallel_param_sampling):
-      click.secho(f"Starting iteration {iteration}", fg='blue')
-      if parallel_param_sampling == 1:
-        suggested = optimizer.ask()
-      else:
-        click.secho(f"  {parallel_param_sampling} parallel samples", fg='blue')
-        suggested = optimizer.ask(n_points=parallel_param_sampling)
-      # print("suggested", suggested)
-      click.secho(f"Computing objective", fg='blue')
-      if parallel_param_sampling == 1:
-        y = objective([*suggested, iteration])
-      else:
-        y = Parallel(n_jobs=parallel_param_sampling)(delayed(objective)([*s, iteration+idx]) for idx, s in enumerate(suggested))
-      # print(f"y={y}", suggested)
-      click.secho(f"Updating optimizer", fg='blue')
-      results = optimizer.tell(suggested, y)
-
-      click.secho(f"Updating QA-Board", fg='blue')
-      if parallel_param_sampling == 1:
-        suggested = [suggested]
-        y = [y]
-      for idx, y_iter in enumerate(y): 
-        iteration_batch_label = f"{ctx.obj['batch_label']}|iter{iteration+idx+1}"
-        iteration_batch_dir = batch_dir_for(iteration_batch_label)
-        metrics = tuple([m for m in optim_config['objective'].keys() if m != 'target'])
-        aggregated_metrics_ = aggregated_metrics(iteration_batch_label, metrics=metrics)
-        notify_qa_database(**{
-          **ctx.obj,
-          **{
-            "extra_parameters": dim_mapping(suggested[idx]),
-            # TODO: we really should to tuning/platform in make_batch_conf_dir
-            #       1. make change, 2. rename existing folders)
-            "output_directory": iteration_batch_dir,
-            'input_path': '|'.join(batches),
-            # we want to show in the summary tab the best results for the tuning experiment
-            # but in the exploration see the results per iteration....
-            "input_type": 'optim_iteration', # or... single ? don't show them in the UI
-            "is_pending": False,
-            "is_failed": False,
-            "metrics": {
-              "iteration": iteration+idx+1,
-              "objective": y_iter,
-              **aggregated_metrics_,
-            },
-          },
-        }, command=command)
-
-        # results
-        #    .x [float]: location of the minimum.
-        #    .fun [float]: function value at the minimum.
-        #    .models: surrogate models used for each iteration.
-        #    .x_iters [array]: location of function evaluation for each iteration.
-        #    .func_vals [array]: function value for each iteration.
-        #    .space [Space]: the optimization space.
-        #    .specs [dict]: parameters passed to the function.
-        is_best = results.func_vals[iteration+idx] <= results.fun or iteration+idx==0
-        if is_best:
-          click.secho(f'New best @iteration{iteration+idx+1}: {y} at iteration {iteration+idx+1}', fg='green')
-
-        is_best_data = {
-          "is_best_iter": True,
-          "best_params": dim_mapping(suggested[idx]),
-          "best_metrics": {
-            "objective": y_iter,
-            **aggregated_metrics_,
-          },
-        } if is_best else {}
-
-        notify_qa_database(
-          object_type='batch',
-          command=command,
-          **ctx.obj,
-          **{"data": {
-              "optimization": True,
-              "iteration": iteration+idx+1,
-              "iteration_label": iteration_batch_label,
-              **is_best_data,
-          }},
-        )
-
-        if is_best:
-          try:
-            click.secho(f'Creating plots', fg='blue')
-            make_plots(results, optim_dir)
-          except:
-            pass
+  if asynchronous:
+    results = optimize_async(objective, optimizer, optim_config, parallel_param_sampling, report)
+  else:
+    for iteration in range(0, optim_config['evaluations'], parallel_param_sampling):
+        click.secho(f"Starting iteration {iteration}", fg='blue')
+        if parallel_param_sampling == 1:
+          suggested = optimizer.ask()
         else:
-          # We remove the results to make sure we don't waste disk space
-          # It is also be done server-side...
-          print(f"RM {iteration_batch_dir}")
-          rmtree(iteration_batch_dir, ignore_errors=True)
+          click.secho(f"  {parallel_param_sampling} parallel samples", fg='blue')
+          suggested = optimizer.ask(n_points=parallel_param_sampling)
+        # print("suggested", suggested)
+        click.secho(f"Computing objective", fg='blue')
+        if parallel_param_sampling == 1:
+          y = objective([*suggested, iteration])
+        else:
+          from joblib import Parallel, delayed
+          y = Parallel(n_jobs=parallel_param_sampling)(delayed(objective)([*s, iteration+idx]) for idx, s in enumerate(suggested))
+        # print(f"y={y}", suggested)
+        click.secho(f"Updating optimizer", fg='blue')
+        results = optimizer.tell(suggested, y)
+
+        click.secho(f"Updating QA-Board", fg='blue')
+        if parallel_param_sampling == 1:
+          suggested = [suggested]
+          y = [y]
+        for idx, y_iter in enumerate(y): 
+          report(iteration+idx, suggested[idx], y_iter, results)
 
   print(results)
   if not results.models: # needs at least n_initial_points(=5) evaluations!
@@ -160,6 +172,55 @@ def optimize(ctx, batches, batches_files, config_file, parallel_param_sampling,
 
 
 
+def ask_with_pending(optimizer, pending, strategy='cl_min'):
+  """
+  Suggests a new point while other points are still evaluated.
+  With the "constant liar" strategy, we pretend that pending points gave a made-up result,
+  by default the best so far (cl_min), so that we don't suggest points close to them.
+  """
+  if not pending:
+    return optimizer.ask()
+  import numpy as np
+  lies = {'cl_min': np.min, 'cl_mean': np.mean, 'cl_max': np.max}
+  if strategy not in lies:
+    raise ValueError(f'ERROR: `constant_liar` must be one of {", ".join(lies)}, not "{strategy}".')
+  lie = lies[strategy](optimizer.yi) if optimizer.yi else 0.0
+  # we tell the lies to a copy of the optimizer, that we discard
+  opt = optimizer.copy(random_state=optimizer.rng.randint(0, np.iinfo(np.int32).max))
+  opt.tell(pending, [lie] * len(pending))
+  return opt.ask()
+
+
+def optimize_async(objective, optimizer, optim_config, in_flight, report):
+  """
+  Keeps `in_flight` evaluations running at all times. As soon as one finishes, we tell its result
+  to the optimizer and start a new one, instead of waiting for the slowest evaluation of each round.
+  """
+  if "ps" in optimizer.acq_func:
+    raise ValueError('ERROR: asynchronous optimization does not support the "ps" acquisition functions.')
+  from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+  strategy = optim_config.get('constant_liar', 'cl_min')
+  evaluations = optim_config['evaluations']
+  click.secho(f"Asynchronous optimization: {in_flight} evaluations at a time", fg='blue')
+  results = None
+  pending = {} # future => (iteration, point)
+  next_iteration = 0
+  with ThreadPoolExecutor(max_workers=in_flight) as executor:
+    while pending or next_iteration < evaluations:
+      while len(pending) < in_flight and next_iteration < evaluations:
+        suggested = ask_with_pending(optimizer, [x for _, x in pending.values()], strategy)
+        click.secho(f"Starting iteration {next_iteration}", fg='blue')
+        pending[executor.submit(objective, [*suggested, next_iteration])] = (next_iteration, suggested)
+        next_iteration += 1
+      done, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        iteration, suggested = pending.pop(future)
+        y = future.result()
+        click.secho(f"Updating optimizer with iteration {iteration}", fg='blue')
+        results = optimizer.tell(suggested, y)
+        report(iteration, suggested, y, results)
+  return results
+
 
 def init_optimization(optim_config_file, ctx):
   with optim_config_file.open('r') as f:
@@ -316,6 +377,7 @@ def batch_objective(project, commit_id, batch_label, config_objective):
         project=project,
         metrics=metrics,
       )
+      target_outputs_index = index_outputs(list(target_batch_info['outputs'].values()))
   else:
     use_default_targets = True
 
@@ -333,7 +395,7 @@ def batch_objective(project, commit_id, batch_label, config_objective):
         if use_default_targets:
           metric_target = available_metrics[metric]['target']
         else:
-          output_target = matching_output(RunContext.from_api_output(output), target_batch_info['outputs'].values())
+          output_target = matching_output(RunContext.from_api_output(output), [], index=target_outputs_index)
           if not output_target:
             raise ValueError(f"Could not find an output for {output['test_input_path']} in the target batch")
           metric_target = output_target['metrics'][metric]
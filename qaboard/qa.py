@@ -11,11 +11,10 @@ import uuid
 import yaml
 import datetime
 import traceback
+from copy import deepcopy
 from pathlib import Path
 
 import click
-from rich.traceback import install
-install(show_locals=False, suppress=[click])
 
 from .run import RunContext
 from .runners import Job, JobGroup
@@ -24,10 +23,10 @@ from .conventions import make_batch_dir, make_batch_conf_dir
 from .conventions import serialize_config, deserialize_config, get_settings
 from .utils import PathType, entrypoint_module, load_tuning_search
 from .utils import save_outputs_manifest, total_storage
-from .utils import redirect_std_streams
+from .utils import redirect_std_streams, environment
 from .utils import getenvs
 from .api import url_to_dir, print_url
-from .api import get_outputs, notify_qa_database, serialize_paths
+from .api import get_outputs, notify_qa_database, notify_qa_database_outputs, serialize_paths
 from .iterators import iter_inputs, iter_parameters
 
 from .config import config_has_error, ignore_config_errors
@@ -65,6 +64,10 @@ def qa(ctx, platform, configurations, label, tuning, tuning_filepath, dryrun, sh
 
   will_show_help = '-h' in sys.argv or '--help' in sys.argv
   noop_command = 'init' in sys.argv
+  # It can cost a network round-trip, and batches start many `qa run`
+  if not will_show_help and ctx.invoked_subcommand not in ('run', 'postprocess'):
+    from .check_for_updates import check_for_updates
+    check_for_updates()
   if root_qatools and root_qatools != Path().resolve() and not will_show_help and not noop_command:
     ctx.obj['previous_cwd'] = os.getcwd()
     click.echo(click.style("Working	directory changed to: ", fg='blue') + click.style(str(root_qatools), fg='blue', bold=True), err=True)
@@ -212,7 +215,22 @@ def run(ctx, input_path, output_path, keep_previous, no_postprocess, forwarded_a
       print_url(ctx)
 
       if not ctx.obj['offline']:
-          notify_qa_database(**ctx.obj, is_pending=True, is_running=True)
+          # We don't need to wait for QA-Board to know the run started
+          notify_qa_database(**ctx.obj, is_pending=True, is_running=True, blocking=False)
+
+      # runs that already succeeded with the same inputs/configurations/artifacts are not computed again
+      from .run_cache import RunCache
+      run_cache = RunCache.from_config(config) if not ctx.obj['dryrun'] else None
+      # the inputs manifest reuses the input files' hashes
+      inputs_info = run_cache.inputs_info(run_context) if run_cache else None
+      run_cache_key = run_cache.key(run_context, inputs_info) if run_cache else None
+      cached_run = run_cache.restore(run_cache_key, run_context) if run_cache else None
+      if cached_run:
+        click.secho(f"Results from the run cache: {cached_run['output_dir']}", fg='cyan', err=True)
+        cached_from = {k: v for k, v in cached_run.items() if k != 'metrics'}
+        metrics = postprocess_(cached_run['metrics'], run_context, skip=True, save_manifests_in_database=save_manifests_in_database, cached_from=cached_from, inputs_info=inputs_info)
+        click.secho(str(metrics), fg='green')
+        return
 
       start = time.time()
       cwd = os.getcwd() 
@@ -242,7 +260,7 @@ def run(ctx, input_path, output_path, keep_previous, no_postprocess, forwarded_a
       if os.getcwd() != cwd:
         os.chdir(cwd)
 
-      metrics = postprocess_(runtime_metrics, run_context, skip=no_postprocess or runtime_metrics['is_failed'], save_manifests_in_database=save_manifests_in_database)
+      metrics = postprocess_(runtime_metrics, run_context, skip=no_postprocess or runtime_metrics['is_failed'], save_manifests_in_database=save_manifests_in_database, inputs_info=inputs_info)
       if not metrics:
         metrics = runtime_metrics
 
@@ -251,12 +269,16 @@ def run(ctx, input_path, output_path, keep_previous, no_postprocess, forwarded_a
         click.secho(str(metrics), fg='red', bold=True)
         exit(1)
       else:
+        if run_cache:
+          run_cache.put(run_cache_key, run_context, commit_id)
         click.secho(str(metrics), fg='green')
 
 
-def postprocess_(runtime_metrics, run_context, skip=False, save_manifests_in_database=False):
+def postprocess_(runtime_metrics, run_context, skip=False, save_manifests_in_database=False, cached_from=None, inputs_info=None):
   """Computes computes various success metrics and outputs."""
-  from .utils import file_info
+  from itertools import islice
+  from .utils import file_info, files_info, iter_files
+  from .hash_cache import HashCache
   from .compat import windows_to_linux_path
 
   try:
@@ -293,32 +315,41 @@ def postprocess_(runtime_metrics, run_context, skip=False, save_manifests_in_dat
       json.dump(metrics, f, sort_keys=True, indent=2, separators=(',', ': '))
   # To help identify if input files change, we compute and save some metadata.
   manifest_inputs = run_context.obj.get('manifest-inputs', [run_context.input_path])
-  input_files = {}
-  for manifest_input in manifest_inputs:
-    manifest_input = Path(manifest_input)
-    if manifest_input.is_dir():
-      for idx, path in enumerate(manifest_input.rglob('*')):
-        if idx >= 200:
-          break
-        if not path.is_file():
-          continue
-        input_files[windows_to_linux_path(path).as_posix()] = file_info(path, config=config)
-    elif manifest_input.is_file():
-      input_files.update({windows_to_linux_path(manifest_input).as_posix(): file_info(manifest_input, config=config)})
-    try:
-      with (run_context.output_dir / 'manifest.inputs.json').open('w') as f:
-        json.dump(input_files, f, sort_keys=True, indent=2)
-    except Exception as e:
-      click.secho(f'WARNING: When writing the input manifest:', fg="yellow", bold=True, err=True)
-      click.secho(str(e), fg="yellow", err=True)
-
-  outputs_manifest = save_outputs_manifest(run_context.output_dir, config=config)
+  # Inputs rarely change, so we can (opt-in) avoid re-hashing them every run
+  hash_cache = HashCache.for_database(run_context.database, config)
+  try:
+    input_files = {}
+    for manifest_input in manifest_inputs:
+      manifest_input = Path(manifest_input)
+      if inputs_info is not None and manifest_input == run_context.input_path:
+        # already computed for the run cache
+        input_files.update({windows_to_linux_path(path).as_posix(): info for path, info in islice(inputs_info.items(), 200)})
+      elif manifest_input.is_dir():
+        files = list(islice(iter_files(manifest_input), 200))
+        infos = files_info(files, config=config, hash_cache=hash_cache)
+        input_files.update({windows_to_linux_path(path).as_posix(): info for (path, _), info in zip(files, infos)})
+      elif manifest_input.is_file():
+        input_files.update({windows_to_linux_path(manifest_input).as_posix(): file_info(manifest_input, config=config, hash_cache=hash_cache)})
+      try:
+        with (run_context.output_dir / 'manifest.inputs.json').open('w') as f:
+          json.dump(input_files, f, sort_keys=True, indent=2)
+      except Exception as e:
+        click.secho(f'WARNING: When writing the input manifest:', fg="yellow", bold=True, err=True)
+        click.secho(str(e), fg="yellow", err=True)
+  finally:
+    if hash_cache:
+      hash_cache.close()
+
+  # with --keep-previous, we only need to hash files that changed since the last run
+  outputs_manifest = save_outputs_manifest(run_context.output_dir, config=config, incremental=True)
   output_data = {
     'storage': total_storage(outputs_manifest),
   }
   if 'params' in metrics:
     output_data['params'] = metrics['params']
     del metrics['params']
+  if cached_from:
+    output_data['cached_from'] = cached_from
 
 
   if save_manifests_in_database:
@@ -382,24 +413,32 @@ def sync(ctx, input_path, output_path):
     ignore_unknown_options=True,
 ))
 @click.pass_context
-@click.option('--output-id', 'output_id', help='Custom output directory path.')
-def wait(ctx, output_id):
-  from .api import get_output 
-  while True:
-    output = get_output(output_id)
-    click.secho("...waiting")      
-    if output["is_pending"]:
-        time.sleep(5)
-        continue
-    break
-    exit(0 if not output["is_failed"] else 1)
+@click.option('--output-id', 'output_ids', multiple=True, help='ID of an output to wait for. Can be repeated.')
+@click.option('--any', 'wait_any', is_flag=True, help='Wait until any of the outputs is done, instead of all.')
+@click.option('--command-id', 'command_id', help='Wait for the runs started locally in the background by `qa batch --no-wait`.')
+def wait(ctx, output_ids, wait_any, command_id):
+  """Wait for outputs to finish. Exits with an error if they failed."""
+  if command_id:
+    from .runners.local_scheduler import state_path, wait_for_state
+    is_failed = wait_for_state(state_path(command_id))
+    exit(1 if is_failed else 0)
+  from .api import wait_for_outputs
+  click.secho("...waiting", err=True)
+  outputs = wait_for_outputs(output_ids, mode='any' if wait_any else 'all')
+  # outputs that can't be found, e.g. deleted, are considered failed
+  done = [outputs.get(str(id)) or {"is_pending": False, "is_failed": True} for id in output_ids]
+  done = [o for o in done if not o["is_pending"]]
+  is_failed = all(o["is_failed"] for o in done) if wait_any else any(o["is_failed"] for o in done)
+  exit(1 if is_failed else 0)
 
 
 runners_config = config.get('runners', {})
+# keys of `runners` in qaboard.yaml that are settings, not runners
+runners_settings = ['default', 'order']
 if 'default' in runners_config:
   default_runner = runners_config['default']
 else:
-  task_runners = [r for r in runners_config if r not in ['default', 'local']]
+  task_runners = [r for r in runners_config if r not in [*runners_settings, 'local']]
   default_runner = task_runners[0] if task_runners else 'local'
 lsf_config = config['lsf'] if 'lsf' in config else config.get('runners', {}).get('lsf', {}) 
 if 'lsf' in config:
@@ -415,11 +454,21 @@ local_config = config.get('runners', {}).get('local', {})
 @click.option('--tuning-search', 'tuning_search_dict', help='string containing JSON describing the tuning parameters to explore')
 @click.option('--tuning-search-file', type=PathType(), default=None, help='tuning file describing the tuning parameters to explore')
 @click.option('--no-wait', is_flag=True, help="If true, returns as soon as the jobs are sent, otherwise waits for completion.")
+@click.option('--order', 'batch_order', type=click.Choice(['planned', 'longest-first']), default=os.environ.get('QA_BATCH_ORDER', runners_config.get('order', 'planned')), help="Start runs in the planned order, or the runs that took longest in the past first.")
+@click.option('--shard', default=os.environ.get('QA_BATCH_SHARD'), help="Only start part of the runs, e.g. on CI nodes: i/N, with i from 1 to N.")
+@click.option('--shard-strategy', type=click.Choice(['hash', 'cost']), default=os.environ.get('QA_BATCH_SHARD_STRATEGY', 'hash'), help="Assign runs to shards by hash, or balance how long they took in the past.")
+@click.option('--shard-reference', default=os.environ.get('QA_BATCH_SHARD_REFERENCE'), help="Commit whose results balance shards with --shard-strategy=cost. Pass the same to all shards. Default: the latest results on the reference branch.")
+@click.option('--shard-merge', is_flag=True, help="Wait for the runs started by all the shards, and report the overall status.")
+@click.option('--fail-fast', is_flag=True, default=str(os.environ.get('QA_BATCH_FAIL_FAST', False)).lower() in ('1', 'true', 'yes'), help="Cancel the remaining runs as soon as a run fails.")
+@click.option('--max-failures', type=int, default=int(os.environ.get('QA_BATCH_MAX_FAILURES', 0)), help="Cancel the remaining runs after N runs failed. 0=never, unless --fail-fast")
 @click.option('--list', 'list_contexts', is_flag=True, help="Print as JSON details about each run we would do.")
 @click.option('--list-output-dirs', is_flag=True, help="Only print the prefixes for the results of each batch we run on.")
 @click.option('--list-inputs', is_flag=True, help="Print to stdout a JSON with a list of the inputs we would call qa run on.")
 @click.option('--runner', default=default_runner, help="Run runs locally or using a task queue like Celery, LSF...")
 @click.option('--local-concurrency', default=os.environ.get('QA_BATCH_CONCURRENCY', local_config.get('concurrency')), type=int, help="joblib's n_jobs: 0=unlimited, 2=2 at a time, -1=#cpu-1")
+@click.option('--local-threads', default=os.environ.get('QA_BATCH_LOCAL_THREADS', local_config.get('threads', 0)), type=int, help="Threads available for runs that declare their cost in threads/memory. 0=#cpu")
+@click.option('--local-memory', default=os.environ.get('QA_BATCH_LOCAL_MEMORY', local_config.get('memory', 0)), help="Memory (MB) available for runs that declare their cost in threads/memory. 0=all RAM")
+@click.option('--local-warm/--no-local-warm', default=str(os.environ.get('QA_BATCH_LOCAL_WARM', local_config.get('warm', False))).lower() in ('1', 'true', 'yes'), help="Runs in worker processes that import qaboard and your entrypoint only once.")
 @click.option('--lsf-threads', default=lsf_config.get('threads', 0), type=int, help="restrict number of lsf threads to use. 0=no restriction")
 @click.option('--lsf-max-memory', default=lsf_config.get('max_memory', lsf_config.get('memory', 0)), help="restrict memory (MB) to use. 0=no restriction")
 @click.option('--lsf-queue', default=lsf_config.get('queue'), help="LSF queue (-q)")
@@ -431,7 +480,7 @@ local_config = config.get('runners', {}).get('local', {})
 @click.option('--prefix-outputs-path', type=PathType(), default=None, help='Custom prefix for the outputs; they will be at $prefix/$output_path')
 @click.argument('forwarded_args', nargs=-1, type=click.UNPROCESSED)
 @click.pass_context
-def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, no_wait, list_contexts, list_output_dirs, list_inputs, runner, local_concurrency, lsf_threads, lsf_max_memory, lsf_queue, lsf_fast_queue, lsf_resources, lsf_priority, action_on_existing, action_on_pending, prefix_outputs_path, forwarded_args):
+def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, no_wait, batch_order, shard, shard_strategy, shard_reference, shard_merge, fail_fast, max_failures, list_contexts, list_output_dirs, list_inputs, runner, local_concurrency, local_threads, local_memory, local_warm, lsf_threads, lsf_max_memory, lsf_queue, lsf_fast_queue, lsf_resources, lsf_priority, action_on_existing, action_on_pending, prefix_outputs_path, forwarded_args):
   """Run on all the inputs/tests/recordings in a given batch using the LSF cluster."""
   if not batches_files:
     click.secho(f'WARNING: Could not find how to identify input tests.', fg='red', err=True, bold=True)
@@ -449,12 +498,20 @@ def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, n
 
   print_url(ctx)
   existing_outputs = get_outputs(ctx.obj)
+  # we index existing outputs once, batches can have 10k+ runs
+  if not 'QA_BATCH_COMPLEX_MATCHING' in os.environ:
+    existing_outputs_by_dir = {}
+    for o in existing_outputs.values():
+      existing_outputs_by_dir.setdefault(url_to_dir(o['output_dir_url']), o)
+  else:
+    from .api import index_outputs
+    existing_outputs_index = index_outputs(list(existing_outputs.values()))
   command_id = os.environ.get('QA_BATCH_COMMAND_ID', str(uuid.uuid4())) # unique IDs for triggered runs makes it easier to wait/cancel them 
 
   os.environ['QA_BATCH']= 'true' # triggered runs will be less verbose than with just `qa run` 
   os.environ['QA_BATCHES_FILES'] = json.dumps([str(b) for b in batches_files])
   dryrun = ctx.obj['dryrun'] or list_output_dirs or list_inputs or list_contexts
-  should_notify_qa_database = (is_ci or ctx.obj['share']) and not (dryrun or ctx.obj['offline'])
+  should_notify_qa_database = (is_ci or ctx.obj['share']) and not (dryrun or ctx.obj['offline'] or shard_merge)
   if should_notify_qa_database:
     command_data = {
       "command_created_at_datetime":  datetime.datetime.utcnow().isoformat(),
@@ -474,6 +531,9 @@ def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, n
     "type": runner,
     "command_id": command_id,
   }
+  if fail_fast or max_failures:
+    # how many runs can fail before we cancel the others
+    default_runner_options["fail_fast"] = max_failures or 1
   # Each runner should add what it cares about...
   # TODO: Having --runner-X prefixes makes it all a mess, but still the help text is useful
   # TODO: It would be nice to generate the CLI help depending on the runner that's chosen, then we could use
@@ -486,14 +546,28 @@ def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, n
       "queue": lsf_queue,
       "fast_queue": lsf_fast_queue,
       "user": ctx.obj['user'],
+      # job arrays
+      **{k: lsf_config[k] for k in ('arrays', 'chunk_size', 'array_max_size', 'arrays_dir', 'tracking') if k in lsf_config},
     })
   if runner == "local":
     default_runner_options["concurrency"] = local_concurrency
+    default_runner_options["warm"] = local_warm
+    default_runner_options["host_threads"] = local_threads
+    default_runner_options["host_memory"] = local_memory
+  if runner == 'celery':
+    celery_config = runners_config.get('celery', {})
+    default_runner_options.update({k: celery_config[k] for k in ('qaboard_envs_dir', 'qaboard_env_expires') if k in celery_config})
   if runner == 'local' or runner == 'celery':
     default_runner_options["cwd"] = ctx.obj['previous_cwd'] if 'previous_cwd' in ctx.obj else os.getcwd()
 
   jobs = JobGroup(job_options=default_runner_options)
+  jobs_to_register = []
+  reference_branch = config.get('project', {}).get('reference_branch', 'master')
+  if shard and not shard_merge:
+    from .runners.sharding import make_shard
+    shard = make_shard(shard, shard_strategy, ctx.obj, reference_branch, shard_reference)
 
+  planned_runs = []
   inputs_iter = iter_inputs(batches, batches_files, ctx.obj['database'], ctx.obj['configurations'], ctx.obj['platform'], default_runner_options, config, ctx.obj['inputs_settings'])
   for run_context in inputs_iter:
     input_configuration_str = serialize_config(run_context.configurations)
@@ -523,10 +597,16 @@ def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, n
           run_context.extra_parameters = tuning_params
       else:
         run_context.extra_parameters = tuning_params
+      if shard and not shard_merge and not shard.includes(run_context):
+        continue
 
       if list_inputs:
         print(run_context.input_path)
         break
+      if shard_merge:
+        # we only wait for the runs started by the shards
+        jobs.append(Job(run_context))
+        continue
 
       # In the past we could assume a given run had a unique output dir,
       # so we could identify platform+input+config+tuning tuples describing runs by their output dir
@@ -535,11 +615,10 @@ def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, n
       # But when trying to get results from older `qa batch`, we care...
       # We could remove the feature flag, maybe when it's used a bit more and we check there is no noticeable runtime cost..
       if not 'QA_BATCH_COMPLEX_MATCHING' in os.environ:
-        matching_existing_outputs = [o for o in existing_outputs.values() if url_to_dir(o['output_dir_url']) == run_context.output_dir]
-        matching_existing_output = matching_existing_outputs[0] if matching_existing_outputs else None
+        matching_existing_output = existing_outputs_by_dir.get(run_context.output_dir)
       else:
         from .api import matching_output
-        matching_existing_output = matching_output(run_context, list(existing_outputs.values()))
+        matching_existing_output = matching_output(run_context, [], index=existing_outputs_index)
       if action_on_existing=='assert-exists':
         if not matching_existing_output:
           click.secho("ERROR: At least 1 run cannot be found in QA-Board's past runs'", err=True, fg="red")
@@ -551,119 +630,163 @@ def batch(ctx, batches, batches_files, tuning_search_dict, tuning_search_file, n
         print(run_context.output_dir)
         break
 
-      is_pending = matching_existing_output['is_pending'] if matching_existing_output else False
-      is_failed = matching_existing_output['is_failed'] if matching_existing_output else run_context.is_failed()
-      ran_before = True if matching_existing_output else run_context.ran()
-      should_run = not is_pending and (action_on_existing=='run' or is_failed or not ran_before)
-      if not should_run and action_on_existing=='skip':
+      planned_runs.append((deepcopy(run_context), input_configuration_str, tuning_params, tuning_str, matching_existing_output))
+
+  # Without results in QA-Board, we check the output directories.
+  # The batch journal tells us about runs that finished, and we check the others in parallel.
+  from .runners.journal import BatchJournal, probe_failures, use_journal
+  journal = BatchJournal.for_batch(outputs_commit, ctx.obj["batch_label"]) if use_journal else None
+  past_failures = {} # whether runs failed, or None if they did not run
+  if action_on_existing != 'run':
+    runs_to_check = []
+    for index, (run_context, *_, matching_existing_output) in enumerate(planned_runs):
+      if matching_existing_output:
+        continue
+      status = journal.status(run_context.output_dir) if journal else None
+      if status in ('done', 'failed'):
+        past_failures[index] = status == 'failed'
+      else:
+        runs_to_check.append(index)
+    past_failures.update(zip(runs_to_check, probe_failures([planned_runs[index][0] for index in runs_to_check])))
+
+  for index, (run_context, input_configuration_str, tuning_params, tuning_str, matching_existing_output) in enumerate(planned_runs):
+    is_pending = matching_existing_output['is_pending'] if matching_existing_output else False
+    is_failed = matching_existing_output['is_failed'] if matching_existing_output else past_failures.get(index) is not False
+    ran_before = True if matching_existing_output else past_failures.get(index) is not None
+    should_run = not is_pending and (action_on_existing=='run' or is_failed or not ran_before)
+    if not should_run and action_on_existing=='skip':
+      continue
+    if is_pending and action_on_pending == 'skip':
         continue
-      if is_pending and action_on_pending == 'skip':
-          continue
 
-      if not forwarded_args:
-        forwarded_args_cli = None
+    if not forwarded_args:
+      forwarded_args_cli = None
+    else:
+      if not on_windows:
+         # FIXME: we assume no single quotes...
+        forwarded_args_cli = ' '.join(f"'{a}'" for a in forwarded_args)
       else:
-        if not on_windows:
-           # FIXME: we assume no single quotes...
-          forwarded_args_cli = ' '.join(f"'{a}'" for a in forwarded_args)
-        else:
-          from .compat import escaped_for_cli
-          forwarded_args_cli = ' '.join(escaped_for_cli(a) for a in forwarded_args)
+        from .compat import escaped_for_cli
+        forwarded_args_cli = ' '.join(escaped_for_cli(a) for a in forwarded_args)
 
-      if input_configuration_str == get_default_configuration(ctx.obj['inputs_settings']):
-        configuration_cli = None
+    if input_configuration_str == get_default_configuration(ctx.obj['inputs_settings']):
+      configuration_cli = None
+    else:
+      # We can't use --config, or "-c A -c B" until we ensure all clients updated a version supporting it
+      if not on_windows:
+        configuration = input_configuration_str.replace("'", "'\"'\"'") # support single-quotes
+        configuration_cli =  f"--configuration '{configuration}'"
       else:
-        # We can't use --config, or "-c A -c B" until we ensure all clients updated a version supporting it
-        if not on_windows:
-          configuration = input_configuration_str.replace("'", "'\"'\"'") # support single-quotes
-          configuration_cli =  f"--configuration '{configuration}'"
-        else:
-          from .compat import escaped_for_cli
-          configuration_cli =  f'--configuration {escaped_for_cli(input_configuration_str)}'
+        from .compat import escaped_for_cli
+        configuration_cli =  f'--configuration {escaped_for_cli(input_configuration_str)}'
 
-      if not tuning_params:
-        tuning_cli = None
+    if not tuning_params:
+      tuning_cli = None
+    else:
+      if not on_windows:
+        tuning_str = tuning_str.replace("'", "'\"'\"'") # support single-quotes
+        tuning_cli =  f"--tuning '{tuning_str}'"
       else:
-        if not on_windows:
-          tuning_str = tuning_str.replace("'", "'\"'\"'") # support single-quotes
-          tuning_cli =  f"--tuning '{tuning_str}'"
-        else:
-          from .compat import escaped_for_cli
-          tuning_cli =  f'--tuning {escaped_for_cli(tuning_str)}'
-
-
-      from .runners import runners
-      platform_cli =None
-      Runner = runners[run_context.job_options['type']]
-      if getattr(Runner, "platform", default_platform) != default_platform:
-        run_context.platform = getattr(Runner, "platform")
-      if run_context.platform != default_platform:
-        platform_cli = f'--platform "{run_context.platform}"'
-      # We could serialize properly the run_context/runner_options, and e.g. call "qa --pickled-cli" and use the CLI command below just for logs... 
-      args = [
-          f"qa",
-          f'--share' if ctx.obj["share"] else None,
-          f'--offline' if ctx.obj['offline'] else None,
-          f'--label "{ctx.obj["raw_batch_label"]}"' if ctx.obj["raw_batch_label"] != default_batch_label else None,
-          platform_cli,
-          f'--type "{run_context.type}"' if run_context.type != default_input_type else None,
-          f'--database "{run_context.database.as_posix()}"' if run_context.database != get_default_database(ctx.obj['inputs_settings']) else None,
-          configuration_cli,
-          tuning_cli,
-          'run' if should_run else action_on_existing,
-          f'--input "{run_context.rel_input_path}"',
-          f'--output "{run_context.output_dir}"' if prefix_outputs_path else None,
-          forwarded_args_cli if forwarded_args_cli else None,
-      ]
-      command = ' '.join([arg for arg in args if arg is not None])
-      click.secho(command, fg='cyan', err=True)
-      click.secho(f"   {run_context.output_dir if run_context.output_dir.is_absolute else run_context.output_dir.relative_to(subproject)}", fg='blue', err=True)
-      if 'QA_TESTING' in os.environ:
-        # we want to make sure we test the current code
-        command = re.sub('^qa', 'python -m qaboard', command) 
-      if str(subproject) != '.':
-        command = f"cd {subproject} && {command}"
-
-      run_context.command = command
-      run_context.job_options['command_id'] = command_id
-      job = Job(run_context)
-
-      if should_notify_qa_database and not is_pending:
-        # TODO: accumulate and send all at once to avoid 100s of requests?
-        db_output = notify_qa_database(**{
-          **ctx.obj,
-          **run_context.obj, # for now we don't want to worry about backward compatibility, and input_path being abs vs relative...
-          "is_pending": True,
-          "data": {
-            "job_options": run_context.job_options,
-          }
-        })
-        if db_output: # Note: the ID is already in the matching job above
-          job.id = db_output["id"]
-      if is_pending:
-        wait_command = f"qa wait --output-id {matching_existing_output['id']}"
-        if action_on_pending=="sync":
-          job.id = matching_existing_output['id']
-          job.run_context.command = wait_command
-        elif action_on_pending=="wait":
-          job.run_context.command = f"{wait_command} || {job.run_context.command}"
-        else:
-          assert action_on_pending=="continue"
-      jobs.append(job)
+        from .compat import escaped_for_cli
+        tuning_cli =  f'--tuning {escaped_for_cli(tuning_str)}'
+
+
+    from .runners import runners
+    platform_cli =None
+    Runner = runners[run_context.job_options['type']]
+    if getattr(Runner, "platform", default_platform) != default_platform:
+      run_context.platform = getattr(Runner, "platform")
+    if run_context.platform != default_platform:
+      platform_cli = f'--platform "{run_context.platform}"'
+    # We could serialize properly the run_context/runner_options, and e.g. call "qa --pickled-cli" and use the CLI command below just for logs... 
+    args = [
+        f"qa",
+        f'--share' if ctx.obj["share"] else None,
+        f'--offline' if ctx.obj['offline'] else None,
+        f'--label "{ctx.obj["raw_batch_label"]}"' if ctx.obj["raw_batch_label"] != default_batch_label else None,
+        platform_cli,
+        f'--type "{run_context.type}"' if run_context.type != default_input_type else None,
+        f'--database "{run_context.database.as_posix()}"' if run_context.database != get_default_database(ctx.obj['inputs_settings']) else None,
+        configuration_cli,
+        tuning_cli,
+        'run' if should_run else action_on_existing,
+        f'--input "{run_context.rel_input_path}"',
+        f'--output "{run_context.output_dir}"' if prefix_outputs_path else None,
+        forwarded_args_cli if forwarded_args_cli else None,
+    ]
+    command = ' '.join([arg for arg in args if arg is not None])
+    click.secho(command, fg='cyan', err=True)
+    click.secho(f"   {run_context.output_dir if run_context.output_dir.is_absolute else run_context.output_dir.relative_to(subproject)}", fg='blue', err=True)
+    if is_pending:
+      # each job waits for its pending run, so they don't hold back the others
+      wait_command = f"qa wait --output-id {matching_existing_output['id']}"
+      if action_on_pending == "sync":
+        command = wait_command
+      elif action_on_pending == "wait":
+        command = f"{wait_command} || {command}"
+      else:
+        assert action_on_pending == "continue"
+    if 'QA_TESTING' in os.environ:
+      # we want to make sure we test the current code
+      command = re.sub(r'(^|\|\| )qa ', r'\1python -m qaboard ', command)
+    if str(subproject) != '.':
+      command = f"cd {subproject} && {command}"
+
+    run_context.command = command
+    run_context.job_options['command_id'] = command_id
+    job = Job(run_context)
+    if is_pending and action_on_pending == "sync":
+      job.id = matching_existing_output['id']
+
+    if should_notify_qa_database and not is_pending:
+      # We register all the pending outputs at once after planning the batch
+      jobs_to_register.append((job, {
+        **run_context.obj, # for now we don't want to worry about backward compatibility, and input_path being abs vs relative...
+        "is_pending": True,
+        "data": {
+          "job_options": run_context.job_options,
+        }
+      }))
+    jobs.append(job)
+
+  if journal and not dryrun and not shard_merge:
+    journal.write((job.run_context.output_dir, 'planned') for job in jobs)
+    jobs.journal = journal
+
+  if jobs_to_register:
+    db_outputs = notify_qa_database_outputs([o for _, o in jobs_to_register], **ctx.obj)
+    for (job, _), db_output in zip(jobs_to_register, db_outputs):
+      if db_output: # Note: the ID is already in the matching job above
+        job.id = db_output["id"]
+
+  if batch_order == 'longest-first' and len(jobs) > 1:
+    from .runners.ordering import order_jobs
+    order_jobs(jobs, ctx.obj, reference=reference_branch)
 
   if list_contexts:
     print(json.dumps([serialize_paths(j.run_context.asdict()) for j in jobs], indent=2))
     return
 
   if not dryrun:
-    is_failed = jobs.start(
-      blocking=not no_wait,
-      qa_context=ctx.obj,
-    )
+    # runs will reuse the configuration we already resolved
+    from .config import config_snapshot
+    # ...and the hash of the run cache's artifacts
+    from .run_cache import RunCache
+    run_cache = RunCache.from_config(config) if jobs and not shard_merge else None
+    with environment(QA_CONFIG_SNAPSHOT=config_snapshot(), QA_RUN_CACHE_ARTIFACTS_HASH=run_cache.artifacts_hash if run_cache else None):
+      if shard_merge:
+        from .runners.sharding import merge_shards
+        is_failed = merge_shards(jobs, ctx.obj)
+      else:
+        is_failed = jobs.start(
+          blocking=not no_wait,
+          qa_context=ctx.obj,
+        )
 
     from .gitlab import gitlab_token, update_gitlab_status
     from .api import qaboard_url
-    if gitlab_token and jobs and is_ci and 'QABOARD_TUNING' not in os.environ:
+    # with shards, the status is reported by --shard-merge
+    if gitlab_token and jobs and is_ci and 'QABOARD_TUNING' not in os.environ and not (shard and not shard_merge):
       name = f"QA {subproject.name}" if subproject else 'QA'
       target_url = f"{qaboard_url}/{config['project']['name']}/commit/{commit_id}"
       label = ctx.obj["batch_label"]
@@ -811,7 +934,14 @@ def init(ctx):
   qa_init(ctx)
 
 
+def rich_excepthook(*exc_info):
+  # rich is slow to import, we only need it to show tracebacks
+  from rich.traceback import install
+  install(show_locals=False, suppress=[click])
+  sys.excepthook(*exc_info)
+
 def main():
+  sys.excepthook = rich_excepthook
   from .compat import ensure_cli_backward_compatibility
   ensure_cli_backward_compatibility()
   qa(obj={}, auto_envvar_prefix='QA')
@@ -142,10 +142,18 @@ class RunContext():
             extra_parameters["forwarded_args"] = ctx.params["forwarded_args"]
         extra_parameters.update(ctx.obj["extra_parameters"])
         ctx.obj["extra_parameters"] = extra_parameters
+        # the metadata was likely cached already when listing inputs in qa batch
+        from .metadata_cache import MetadataCache
+        metadata_cache = MetadataCache.for_database(database, config)
+        try:
+            metadata = input_metadata(input_path_absolute, database, input_path, config, metadata_cache)
+        finally:
+            if metadata_cache:
+                metadata_cache.close()
         run_context = RunContext(
             input_path=input_path_absolute,
             database=database,
-            input_metadata=input_metadata(input_path_absolute, database, input_path, config),
+            input_metadata=metadata,
             configurations=ctx.obj["configurations"],
             extra_parameters=extra_parameters,
             platform=ctx.obj["platform"],
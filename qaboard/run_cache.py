@@ -0,0 +1,174 @@
+"""
+Cache of successful runs, to avoid computing again results we already have.
+
+Runs are identified by the hashes of their input files, their configurations, tuning parameters, platform,
+and the hash of what else changes results, e.g. your binary. If a run with the same key succeeded before,
+`qa run` links its output files in the new output directory instead of calling your `run` function,
+and QA-Board records where the results come from (in the output's `data.cached_from`).
+
+It is opt-in, via qaboard.yaml:
+```yaml
+outputs:
+  cache: true  # or a directory where the cache is saved, ideally shared by all hosts doing runs. By default we use ~/.cache/qaboard/runs
+  # Files that change the results, e.g. your build. They are hashed, with the entrypoint.
+  cache_artifacts:
+  - build/my-binary
+  # Or a hash you compute yourself. Also read from QA_RUN_CACHE_KEY
+  # cache_key: 1a2b3c
+```
+Output files are hard-linked when possible: don't edit them in place.
+Entries are small JSON files, which unlike SQLite are safe to share over NFS.
+"""
+import os
+import json
+import shutil
+import hashlib
+import datetime
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+import click
+
+from .conventions import local_cache_dir
+from .run import RunContext
+
+
+cache_version = 1
+# qaboard writes those files again after a run, so they are copied, not linked
+rewritten_files = ('metrics.json', 'manifest.inputs.json', 'manifest.outputs.json', 'run.json', 'log.txt')
+
+
+class RunCache():
+  def __init__(self, path: Path, artifacts_hash: str, config: Optional[Dict] = None):
+    self.path = path
+    self.artifacts_hash = artifacts_hash
+    self.config = config or {}
+
+  @staticmethod
+  def from_config(config: Optional[Dict] = None) -> Optional['RunCache']:
+    """Returns the run cache, or None if it is not enabled."""
+    outputs_config = (config or {}).get('outputs', {})
+    cache_spec = os.environ.get('QA_RUN_CACHE', outputs_config.get('cache'))
+    if not cache_spec or cache_spec in ('0', 'false', 'False'):
+      return None
+    cache_dir = local_cache_dir() / 'runs' if cache_spec is True or cache_spec in ('1', 'true', 'True') else Path(cache_spec)
+    # `qa batch` hashes the artifacts once for all its runs
+    artifacts_hash = os.environ.get('QA_RUN_CACHE_ARTIFACTS_HASH') or RunCache.hash_artifacts(config)
+    return RunCache(cache_dir, artifacts_hash, config) if artifacts_hash else None
+
+  @staticmethod
+  def hash_artifacts(config: Optional[Dict] = None) -> Optional[str]:
+    """Returns the hash of what changes results besides the runs' inputs, or None if we can't know it."""
+    from .utils import hash_hex, manifest_hash
+    outputs_config = (config or {}).get('outputs', {})
+    user_key = os.environ.get('QA_RUN_CACHE_KEY', outputs_config.get('cache_key'))
+    artifacts = outputs_config.get('cache_artifacts', [])
+    if isinstance(artifacts, str):
+      artifacts = [artifacts]
+    if not user_key and not artifacts:
+      click.secho('WARNING: The run cache needs to know what changes results. Define outputs.cache_artifacts or outputs.cache_key.', fg='yellow', err=True)
+      return None
+    algorithm = manifest_hash(config)
+    hashes = {"key": str(user_key) if user_key else None}
+    entrypoint = (config or {}).get('project', {}).get('entrypoint')
+    paths = [Path(entrypoint)] if entrypoint else []
+    for pattern in artifacts:
+      matches = sorted(p for p in Path().glob(pattern) if p.is_file())
+      if not matches:
+        click.secho(f'WARNING: The run cache is disabled, no file matches the artifact "{pattern}".', fg='yellow', err=True)
+        return None
+      paths.extend(matches)
+    try:
+      hashes.update({p.as_posix(): hash_hex(p, algorithm) for p in paths})
+    except OSError as e:
+      click.secho(f'WARNING: [{e}] The run cache is disabled, we could not hash the artifacts.', fg='yellow', err=True)
+      return None
+    return hashlib.sha256(json.dumps(hashes, sort_keys=True).encode('utf-8')).hexdigest()
+
+  def inputs_info(self, run_context: RunContext) -> Dict[Path, Dict]:
+    """Returns metadata about the run's input files. `qa run` reuses it for manifest.inputs.json."""
+    from .utils import input_files_info
+    from .hash_cache import HashCache
+    hash_cache = HashCache.for_database(run_context.database, self.config)
+    try:
+      return input_files_info(run_context.input_path, config=self.config, hash_cache=hash_cache)
+    finally:
+      if hash_cache:
+        hash_cache.close()
+
+  def key(self, run_context: RunContext, inputs_info: Optional[Dict[Path, Dict]] = None) -> str:
+    """Identifies runs that give the same results."""
+    if inputs_info is None:
+      inputs_info = self.inputs_info(run_context)
+    if run_context.input_path.is_dir():
+      input_files = {path.relative_to(run_context.input_path).as_posix(): info for path, info in inputs_info.items()}
+    else:
+      input_files = {'': info for info in inputs_info.values()}
+    key = {
+      "version": cache_version,
+      "artifacts": self.artifacts_hash,
+      "input_path": run_context.rel_input_path.as_posix(),
+      "input_files": input_files,
+      "type": run_context.type,
+      "platform": run_context.platform,
+      "configurations": run_context.configurations,
+      "extra_parameters": run_context.extra_parameters,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+  def entry_path(self, key: str) -> Path:
+    return self.path / key[:2] / f'{key}.json'
+
+  def get(self, key: str) -> Optional[Dict[str, Any]]:
+    try:
+      return json.loads(self.entry_path(key).read_text())
+    except (OSError, ValueError):
+      return None
+
+  def put(self, key: str, run_context: RunContext, commit_id: Optional[str] = None):
+    entry = {
+      "output_dir": str(run_context.output_dir.resolve()),
+      "commit_id": commit_id,
+      "created": datetime.datetime.utcnow().isoformat(),
+    }
+    path = self.entry_path(key)
+    try:
+      path.parent.mkdir(parents=True, exist_ok=True)
+      tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+      tmp_path.write_text(json.dumps(entry))
+      os.replace(str(tmp_path), str(path))
+    except OSError as e:
+      click.secho(f'WARNING: [{e}] Could not save the run in the run cache', fg='yellow', err=True)
+
+  def restore(self, key: str, run_context: RunContext) -> Optional[Dict[str, Any]]:
+    """
+    If the run is in the cache, links its files in the output directory and returns its cache entry, with its metrics.
+    Returns None if we need to run.
+    """
+    from .utils import iter_files
+    entry = self.get(key)
+    if not entry:
+      return None
+    source = Path(entry['output_dir'])
+    if source == run_context.output_dir.resolve():
+      return None
+    try:
+      metrics = json.loads((source / 'metrics.json').read_text())
+    except (OSError, ValueError): # e.g. the results were deleted
+      return None
+    if metrics.get('is_failed', True):
+      return None
+    for path, _ in iter_files(source):
+      relative_path = path.relative_to(source)
+      destination = run_context.output_dir / relative_path
+      if destination.exists():
+        continue
+      destination.parent.mkdir(parents=True, exist_ok=True)
+      if relative_path.as_posix() not in rewritten_files:
+        try:
+          os.link(path, destination)
+          continue
+        except OSError: # e.g. on different filesystems
+          pass
+      shutil.copy2(str(path), str(destination))
+    return {**entry, "metrics": metrics}
@@ -1,5 +1,13 @@
 import os
-from typing import List, Dict, Any
+import json
+import time
+import zlib
+import base64
+import hashlib
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import click
 
 from .base import BaseRunner
 from .job import Job
@@ -11,6 +19,96 @@ secrets = ("TOKEN", "ACCESS", "AUTH", "SECRET")
 def is_secret(env_variable):
   return any([s in env_variable for s in secrets])
 
+# Options used by `qa batch`, not by Celery
+batch_options = ('on_job_done', 'fail_fast', 'env')
+poll_interval = 1 # seconds
+# Batch environments are only needed until all their runs started
+env_expires = 7 * 24 * 3600 # seconds
+
+
+def task_id(command_id: str, index: int) -> str:
+  # We know the ID of each task to be able to cancel them
+  return f"{command_id}-{index}"
+
+
+def encode_env(env: Dict[str, str]) -> str:
+  return base64.b64encode(zlib.compress(json.dumps(env, sort_keys=True).encode('utf-8'))).decode('ascii')
+
+def decode_env(env_blob: str) -> Dict[str, str]:
+  return json.loads(zlib.decompress(base64.b64decode(env_blob)).decode('utf-8'))
+
+def env_key(env_blob: str) -> str:
+  return f"qaboard-env-{hashlib.sha1(env_blob.encode('ascii')).hexdigest()}"
+
+
+def env_diff(base: Dict[str, str], env: Dict[str, str]) -> Dict[str, Optional[str]]:
+  """Returns the variables to change in the base environment to get env. Removed variables are None."""
+  diff: Dict[str, Optional[str]] = {k: v for k, v in env.items() if base.get(k) != v}
+  diff.update({k: None for k in base if k not in env})
+  return diff
+
+def apply_env_diff(base: Dict[str, str], diff: Dict[str, Optional[str]]) -> Dict[str, str]:
+  env = {**base, **diff}
+  return {k: v for k, v in env.items() if v is not None}
+
+
+def job_env(job: Job, env: Dict[str, str]) -> Dict[str, str]:
+  """Runs can set environment variables in their runner options, e.g. `celery: {env: {CUDA_VISIBLE_DEVICES: 0}}`."""
+  variables = job.run_context.job_options.get('env') or {}
+  return {**env, **{k: str(v) for k, v in variables.items()}}
+
+
+def envs_dir(job_options: Dict[str, Any]) -> Optional[Path]:
+  """
+  Where we save batch environments when the result backend can't store them. Workers must be able to read it.
+  Since environments can hold private data, it is a dedicated directory, never the outputs that users browse.
+  """
+  directory = os.environ.get('QA_RUNNERS_CELERY_ENVS_DIR', job_options.get('qaboard_envs_dir'))
+  return Path(directory) if directory else None
+
+
+def clean_envs_dir(directory: Path, expires: int):
+  """Removes the environments of old batches."""
+  for path in directory.glob('*.env'):
+    try:
+      if time.time() - path.stat().st_mtime > expires:
+        path.unlink()
+    except OSError: # e.g. another batch removed it
+      pass
+
+
+def save_env(app, env_blob: str, directory: Optional[Path], expires: int = env_expires) -> Dict[str, str]:
+  """
+  All the runs in a batch share the same environment. We store it once, and tasks only get a reference:
+  - in the result backend, if it can store data (e.g. redis),
+  - otherwise in a directory shared with the workers (e.g. with the default rpc:// backend), that must be configured.
+  Returns the task arguments that tell workers where to find it.
+  """
+  from celery.backends.base import KeyValueStoreBackend
+  key = env_key(env_blob)
+  if isinstance(app.backend, KeyValueStoreBackend):
+    try:
+      backend_key = app.backend.get_key_for_task(key)
+      app.backend.set(backend_key, env_blob)
+      app.backend.expire(backend_key, expires)
+      return {"env_key": key}
+    except Exception:
+      pass
+  if directory is None:
+    raise ValueError("Your Celery result backend can't store the batch's environment: set runners.celery.qaboard_envs_dir in qaboard.yaml (or QA_RUNNERS_CELERY_ENVS_DIR) to a directory your workers can read.")
+  try:
+    directory.mkdir(parents=True, exist_ok=True)
+    clean_envs_dir(directory, expires)
+    path = directory / f"{key}.env"
+    # readers never see partially written files
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_text(env_blob)
+    os.replace(str(tmp_path), str(path))
+    return {"env_path": str(path)}
+  except OSError as e:
+    click.secho(f'WARNING: Could not save the environment in {directory} ({e}), every task will carry a copy. Set runners.celery.qaboard_envs_dir to a directory your workers can read.', fg='yellow', err=True)
+    return {"env_blob": env_blob}
+
 
 class CeleryRunner(BaseRunner):
   type = "celery"
@@ -22,7 +120,7 @@ class CeleryRunner(BaseRunner):
   def start_jobs(jobs: List[Job], job_options: Dict[str, Any], blocking=True):
     from celery import group
     from .celery_app import app, start
-    app.conf.update(**job_options)
+    app.conf.update(**{k: v for k, v in job_options.items() if k not in batch_options})
 
     # same as for the  local runner, but not sure it's necessary
     cwd = os.getcwd()
@@ -30,9 +128,25 @@ class CeleryRunner(BaseRunner):
       os.chdir(job_options['cwd'])
 
     env = {k:v for k, v in os.environ.items() if not is_secret(k)}
+    env_kwargs = save_env(
+      app,
+      encode_env(env),
+      envs_dir(job_options),
+      int(job_options.get('qaboard_env_expires', env_expires)),
+    )
+
+    # Tasks only get what they need to run, not whole jobs, and only how their environment differs from the batch's
+    def signature(index, job):
+      diff = env_diff(env, job_env(job, env))
+      return start.s(
+        command=job.run_context.command,
+        cwd=cwd,
+        **env_kwargs,
+        **({"env_diff": diff} if diff else {}),
+      ).set(task_id=task_id(job_options['command_id'], index))
 
     # https://docs.celeryproject.org/en/stable/userguide/canvas.html#canvas-group
-    g = group(start.s(job, cwd=cwd, env=env) for job in jobs)
+    g = group(signature(index, job) for index, job in enumerate(jobs))
     # We set the group ID with our own UUID to make cancellation easier to manage
     g.id = job_options['command_id']
     result = g()
@@ -47,36 +161,39 @@ class CeleryRunner(BaseRunner):
       import signal
       def sigterm_handler(_signo, _stackframe):
         print('Aborted.')
-        g.revoke()
+        result.revoke(terminate=True)
         exit(1)
       signal.signal(signal.SIGTERM, sigterm_handler)
       signal.signal(signal.SIGINT, sigterm_handler)
 
-      results = result.get()
+      # We report runs as soon as they finish
+      on_job_done = job_options.get('on_job_done')
+      jobs_by_task_id = {task_id(job_options['command_id'], index): job for index, job in enumerate(jobs)}
+      def task_done(id, returncode):
+        # returncode is an exception if the task failed
+        if on_job_done and id in jobs_by_task_id:
+          on_job_done(jobs_by_task_id[id], returncode != 0)
+      if result.supports_native_join:
+        # results are consumed as they arrive, e.g. with the rpc:// or redis backends
+        result.join_native(callback=task_done, propagate=False)
+      else:
+        pending = dict(zip(result.results, jobs_by_task_id))
+        while pending:
+          for task_result, id in list(pending.items()):
+            if task_result.ready():
+              del pending[task_result]
+              task_done(id, task_result.result if task_result.successful() else 1)
+          if pending:
+            time.sleep(poll_interval)
     os.chdir(cwd)
 
 
 
   @staticmethod
   def stop_jobs(jobs: List[Job], job_options: Dict[str, Any]):
-    return # FIXME: we should do something
-    raise NotImplementedError
-    # TODO: not sure whether we should .revoke(terminate=True)
-    # TODO: one of the options below should work, but I don't have time to test it right now...
-
-    # http://docs.celeryproject.org/en/latest/userguide/workers.html#worker-persistent-revokes
-    from celery.result import AsyncResult
-    AsyncResult(job_options['command_id']).revoke()
-
-    # https://docs.celeryproject.org/en/stable/reference/celery.result.html
-    from celery.result import GroupResult
-    g = GroupResult(id=job_options['command_id'])
-
-    # https://stackoverflow.com/questions/13685344/retrieving-groupresult-from-taskset-id-in-celery
-    # We may need to call result.save() in the task above for it to work...
-    from celery.result import GroupResult
-    result = GroupResult.restore(job_options['command_id'])
-    result.revoke()
-
-    from celery.task.control import revoke
-    revoke(job_options['command_id'])
+    # FIXME: QA-Board does not know how many jobs there are, so it can't stop them
+    if not jobs:
+      return
+    from .celery_app import app
+    # http://docs.celeryproject.org/en/latest/userguide/workers.html#revoke-revoking-tasks
+    app.control.revoke([task_id(job_options['command_id'], index) for index in range(len(jobs))], terminate=True)
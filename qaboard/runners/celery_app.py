@@ -1,5 +1,6 @@
 import os
 import subprocess
+from pathlib import Path
 
 from celery import Celery
 
@@ -19,20 +20,49 @@ app.conf.update(**celery_config)
 
 
 
+# Environments shared by the runs of a batch, by key or path
+batch_envs = {}
+
+def batch_env(env_key=None, env_path=None):
+  key = env_key or env_path
+  if key not in batch_envs:
+    from .celery import decode_env
+    if env_path:
+      env_blob = Path(env_path).read_text()
+    else:
+      env_blob = app.backend.get(app.backend.get_key_for_task(env_key))
+      if env_blob is None:
+        raise ValueError(f"Could not find the environment {env_key} in the result backend")
+    if len(batch_envs) > 100:
+      batch_envs.clear()
+    batch_envs[key] = decode_env(env_blob.decode('ascii') if isinstance(env_blob, bytes) else env_blob)
+  return batch_envs[key]
+
+
 @app.task(bind=True, name=celery_config.get('qaboard_task_name', "qaboard"))
-def start(self, job, cwd=None, env=None):
+def start(self, job=None, cwd=None, env=None, command=None, env_blob=None, env_key=None, env_path=None, env_diff=None):
   # https://docs.celeryproject.org/en/stable/userguide/tasks.html#task-request-info
   print('Executing task id {0.id}, groupID: {0.group}'.format(self.request))
+  # older versions of qaboard sent the whole job
+  if job is not None:
+    command = job.run_context.command
+    cwd = cwd if cwd else job.run_context.job_options['cwd']
+  if env_key or env_path:
+    env = batch_env(env_key, env_path)
+  elif env_blob:
+    from .celery import decode_env
+    env = decode_env(env_blob)
+  if env_diff:
+    from .celery import apply_env_diff
+    env = apply_env_diff(env if env is not None else dict(os.environ), env_diff)
 
   pipe = subprocess.PIPE
-  # print("job.run_context.command", job.run_context.command)
-  # print("env", env)
-  with subprocess.Popen(job.run_context.command, shell=True,
+  with subprocess.Popen(command, shell=True,
                         encoding='utf-8',
                         # Avoid issues with code outputing malformed unicode
                         # https://docs.python.org/3/library/codecs.html#error-handlers
                         errors='surrogateescape',
-                        cwd=cwd if cwd else job.run_context.job_options['cwd'],
+                        cwd=cwd,
                         env=env,
                         stdout=pipe, stderr=pipe) as process:
     for line in process.stdout:
@@ -44,7 +44,6 @@ import time
 from typing import List, Dict, Any
 
 from click import secho
-import requests
 
 from .base import BaseRunner
 from .job import Job
@@ -75,6 +74,7 @@ def trigger_run(task: str) -> Dict:
             "task": task,
         }
     }
+    import requests
     r = requests.post(f"{api_prefix}/jenkins/build/trigger/", json=data)
     try:
         r.raise_for_status()
@@ -93,6 +93,7 @@ def trigger_run(task: str) -> Dict:
 
 
 def build_status(build_info):
+  import requests
   r = requests.post(f"{api_prefix}/jenkins/build/", json=build_info)
   try:
       r.raise_for_status()
@@ -130,6 +131,7 @@ def wait_for_build(build_info, should_print_log=True):
 
 def print_log(log_url):
     try:
+        import requests
         r = requests.get(log_url)
         result = r.text
         secho(f"JENKINS LOG:", fg='blue', bold=True)
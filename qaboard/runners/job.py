@@ -8,7 +8,8 @@ from typing import Optional, List, Dict, Any, Callable
 import click
 
 from ..run import RunContext 
-from ..api import url_to_dir, get_outputs, get_output, notify_qa_database
+from ..api import url_to_dir, get_outputs, get_output, update_output, notify_qa_database, status_fields
+from .journal import BatchJournal, parallel_map
 
 # TODO: We could make start_jobs belong to JobGroup as simply "start" 
 #       It would be a bit simpler, but then we'd need new runners to implement two classes?
@@ -47,6 +48,8 @@ class Job():
 class JobGroup():
   jobs: List[Job] = field(default_factory=list)
   job_options: Optional[Dict[str, Any]] = None
+  # Remembers which runs finished, to resume interrupted batches
+  journal: Optional[BatchJournal] = None
 
   # https://docs.python.org/3/library/dataclasses.html
   def __post_init__(self):
@@ -72,49 +75,134 @@ class JobGroup():
     """
     if not self.jobs:
       return False
-    self.Runner.start_jobs(self.jobs, self.job_options, blocking)
+    self.qa_context = qa_context
+    self.done_jobs: List[Job] = []
+    self.failed_jobs = 0
+    self.job_failures: Dict[int, bool] = {} # as reported by the runner
+    self.cancelled = False
+    if self.job_options.get('fail_fast') and not blocking:
+      click.secho('WARNING: --fail-fast needs to wait for the runs, it is ignored with --no-wait', fg='yellow', err=True)
+    # Runners that know when each job finishes call `job_done`
+    job_options = {**self.job_options, "on_job_done": self.job_done} if blocking else self.job_options
+    self.Runner.start_jobs(self.jobs, job_options, blocking)
     if not blocking:
       return True
+    if self.cancelled:
+      self.mark_cancelled()
+      return True
 
     # Note: we used to always do as below, it's OK but makes many network requests
     # return any(job.is_failed(verbose=True) for job in self.jobs)
 
     # Note: We get all outputs in the batch, some not started in this command...
-    finished_outputs = get_outputs(qa_context)
-    if not finished_outputs:
-      # If we don't have jobs, either we were offline or something aweful happenned
-      return any(job.run_context.is_failed(verbose=True) for job in self.jobs)
-
+    finished_outputs = get_outputs(qa_context, fields=status_fields)
     # Here we add the matching outputs as job.qaboard_output
-    outputdir_to_qaboard_output = {url_to_dir(o['output_dir_url']): o for o in finished_outputs.values()}
+    # If we don't have outputs, either we were offline or something aweful happenned
+    outputdir_to_qaboard_output = {url_to_dir(o['output_dir_url']): o for o in finished_outputs.values()} if finished_outputs else {}
 
-    is_failed = False
     # If runs are SIGKILL'ed, they never get a chance to update that they are done
     # it happens often when users use a lot of memory and some task queue manager gets angry 
     jobs_with_pending_outputs = []
+    # we still fallback to the server-less check, in case the server was down during part of the runs...
+    jobs_without_outputs = []
+    failures: Dict[int, bool] = {}
     for job in self.jobs:
-      # we still fallback to the server-less check, in case the server was down during part of the runs...
       if job.run_context.output_dir not in outputdir_to_qaboard_output:
-        is_failed = is_failed or job.run_context.is_failed(verbose=True)
+        jobs_without_outputs.append(job)
       else:
         job.qaboard_output = outputdir_to_qaboard_output[job.run_context.output_dir]
         assert job.qaboard_output
-        is_failed = is_failed or job.qaboard_output["is_failed"]
         if job.qaboard_output['is_pending']:
           jobs_with_pending_outputs.append(job)
+        else:
+          failures[id(job)] = job.qaboard_output["is_failed"]
 
+    checked_jobs = [*jobs_without_outputs, *jobs_with_pending_outputs]
+    failures.update(zip(map(id, checked_jobs), self.check_failures(checked_jobs)))
     for job in jobs_with_pending_outputs:
-      job_is_failed = job.run_context.is_failed(verbose=True)
+      job_is_failed = failures[id(job)]
       if not job_is_failed:
         print("[INFO] Job status was 'pending':", job.run_context, job.qaboard_output)
-      is_failed = is_failed or job_is_failed
       notify_qa_database(**{
         **(qa_context if qa_context else {}),
         **job.run_context.obj, # for now we don't want to worry about backward compatibility, and input_path being abs vs relative...
         "is_pending": False,
         "is_failed": job_is_failed,
       })
-    return is_failed
+    if self.journal:
+      self.journal.write((job.run_context.output_dir, 'failed' if failures[id(job)] else 'done') for job in self.jobs)
+    return any(failures.values())
+
+  def check_failures(self, jobs: List[Job]) -> List[bool]:
+    """Whether each job failed. We trust what runners reported, and read the other runs' results in parallel."""
+    def is_failed(job):
+      if id(job) in self.job_failures:
+        return self.job_failures[id(job)]
+      return job.run_context.is_failed(verbose=True)
+    return parallel_map(is_failed, jobs)
+
+  def job_done(self, job: Job, is_failed: Optional[bool] = None):
+    """
+    Called by runners as soon as a job finishes, to report progress and failures early.
+    `is_failed` is None if the runner does not know whether the job failed.
+    """
+    if self.cancelled: # runs we stopped
+      return
+    self.done_jobs.append(job)
+    if is_failed is None:
+      is_failed = job.run_context.is_failed()
+    self.job_failures[id(job)] = is_failed
+    if self.journal:
+      self.journal.write([(job.run_context.output_dir, 'failed' if is_failed else 'done')])
+    progress = f'[{len(self.done_jobs)}/{len(self.jobs)}]'
+    if not is_failed:
+      click.secho(f'{progress} {job.run_context.output_dir}', dim=True, err=True)
+      return
+    self.failed_jobs += 1
+    click.secho(f'{progress} Failed run! More info at: {job.run_context.output_dir}', fg='red', err=True)
+    # If the run was killed, e.g. because it used too much memory, it could not update QA-Board
+    if job.id and self.qa_context and not self.qa_context.get('offline'):
+      output_db = get_output(job.id)
+      if output_db and output_db['is_pending']:
+        notify_qa_database(**{
+          **self.qa_context,
+          **job.run_context.obj,
+          "is_pending": False,
+          "is_failed": True,
+        })
+
+    fail_fast = self.job_options.get('fail_fast')
+    if fail_fast and self.failed_jobs >= fail_fast and len(self.done_jobs) < len(self.jobs):
+      click.secho(f'{self.failed_jobs} runs failed, cancelling the other runs (--fail-fast)', fg='red', bold=True, err=True)
+      self.cancelled = True
+      try:
+        self.stop()
+      except Exception as e:
+        click.secho(f'WARNING: Could not cancel the runs: {e}', fg='yellow', err=True)
+
+  def mark_cancelled(self):
+    """Tells QA-Board that the runs that were stopped are not pending anymore."""
+    done_jobs = set(id(job) for job in self.done_jobs)
+    cancelled_jobs = [job for job in self.jobs if id(job) not in done_jobs]
+    click.secho(f'Cancelled {len(cancelled_jobs)} runs.', fg='yellow', err=True)
+    if not self.qa_context or self.qa_context.get('offline'):
+      return
+    finished_outputs = get_outputs(self.qa_context, fields=status_fields)
+    outputdir_to_qaboard_output = {url_to_dir(o['output_dir_url']): o for o in finished_outputs.values()} if finished_outputs else {}
+    for job in cancelled_jobs:
+      output_db = outputdir_to_qaboard_output.get(job.run_context.output_dir)
+      if output_db and not output_db['is_pending']: # it finished before we could stop it
+        continue
+      output_id = job.id or (output_db['id'] if output_db else None)
+      if output_id:
+        update_output(output_id, {"is_pending": False, "is_running": False, "is_failed": True, "data": {"cancelled": True}})
+      else:
+        notify_qa_database(**{
+          **self.qa_context,
+          **job.run_context.obj,
+          "is_pending": False,
+          "is_failed": True,
+        })
 
   # Currently called onlt by the backend when it tries to stop a `qa batch` command
   # Sadly it only knows about the command_id, not jobs....
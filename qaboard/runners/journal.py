@@ -0,0 +1,86 @@
+"""
+Journal of the runs of a batch, saved locally as runs are planned and finish.
+
+Without QA-Board (`qa --offline`, or when it can't be reached), `qa batch` reads each run's metrics.json
+to know which runs to start again, which is slow on network storage. With the journal, an interrupted batch
+is resumed cheaply: we only check the runs that did not finish. The checks left are done in parallel.
+
+The journal is a JSON-lines file, where the last line about an output directory gives its status.
+It does not know about runs done outside of `qa batch`: if you delete results by hand, use QA_BATCH_JOURNAL=0.
+"""
+import os
+import json
+import threading
+from pathlib import Path
+from typing import List, Dict, Tuple, Optional, Iterable, Callable
+
+from ..conventions import local_cache_dir, slugify_hash
+
+
+statuses = ('planned', 'done', 'failed')
+use_journal = os.environ.get('QA_BATCH_JOURNAL', 'true') not in ('0', 'false', 'False')
+# how many output directories are checked at the same time
+probe_workers = int(os.environ.get('QA_BATCH_PROBE_WORKERS', 16))
+
+
+class BatchJournal():
+  def __init__(self, path: Path):
+    self.path = path
+    self.statuses: Dict[str, str] = {}
+    self._lock = threading.Lock()
+    self.read()
+
+  @staticmethod
+  def for_batch(outputs_commit: Path, batch_label: str) -> 'BatchJournal':
+    slug = slugify_hash(f'{Path(outputs_commit).as_posix()}/{batch_label}', maxlength=64)
+    return BatchJournal(local_cache_dir() / 'batch-journals' / f'{slug}.jsonl')
+
+  def read(self):
+    try:
+      lines = self.path.read_text().splitlines()
+    except OSError:
+      return
+    for line in lines:
+      try:
+        entry = json.loads(line)
+        self.statuses[entry['output_dir']] = entry['status']
+      except (ValueError, KeyError, TypeError): # e.g. a batch crashed while writing
+        continue
+    # we only need the latest status of each run
+    if len(lines) > 1000 and len(lines) > 4 * len(self.statuses):
+      self.write([], rewrite=True)
+
+  def status(self, output_dir: Path) -> Optional[str]:
+    return self.statuses.get(str(output_dir))
+
+  def write(self, entries: Iterable[Tuple[Path, str]], rewrite=False):
+    entries = [(str(output_dir), status) for output_dir, status in entries]
+    with self._lock:
+      self.statuses.update(entries)
+      lines = self.statuses.items() if rewrite else entries
+      text = ''.join(json.dumps({"output_dir": output_dir, "status": status}) + '\n' for output_dir, status in lines)
+      try:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if rewrite:
+          tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+          tmp_path.write_text(text)
+          os.replace(str(tmp_path), str(self.path))
+        else:
+          with self.path.open('a') as f:
+            f.write(text)
+      except OSError: # the journal only makes things faster
+        pass
+
+
+def parallel_map(function: Callable, items: List) -> List:
+  """Like `map`, for functions that wait on (network) storage."""
+  if len(items) <= 1 or probe_workers <= 1:
+    return [function(item) for item in items]
+  from concurrent.futures import ThreadPoolExecutor
+  with ThreadPoolExecutor(max_workers=min(probe_workers, len(items))) as executor:
+    return list(executor.map(function, items))
+
+
+def probe_failures(run_contexts: List) -> List[Optional[bool]]:
+  """For each run, returns whether it failed, or None if it did not run. Output directories are checked in parallel."""
+  return parallel_map(lambda run_context: run_context.is_failed() if run_context.ran() else None, run_contexts)
@@ -1,7 +1,11 @@
 import os
+import re
+import sys
+import shlex
+import importlib
 import subprocess
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
 import click
 
@@ -30,8 +34,36 @@ class LocalRunner(BaseRunner):
 
   @staticmethod
   def start_jobs(jobs: List[Job], job_options: Dict[str, Any], blocking=True):
+      from .local_scheduler import LocalScheduler, make_state, start_detached, uses_resources
       if not blocking:
-        click.secho(f'WARNING: We currently dont support non-blocking local runs.', fg='yellow', err=True)
+        state_path = start_detached(jobs, job_options)
+        click.secho(f'Started {len(jobs)} runs in the background. State: {state_path}', fg='blue', err=True)
+        click.secho(f'To wait for them: qa wait --command-id {job_options["command_id"]}', fg='blue', err=True)
+        return
+
+      on_job_done = job_options.get('on_job_done')
+      on_done = (lambda index, returncode: on_job_done(jobs[index], returncode != 0)) if on_job_done else None
+      # runs that declare how many threads or how much memory they need are packed on the host
+      if any(uses_resources(job.run_context.job_options) for job in jobs):
+        if job_options.get('warm'):
+          click.secho('WARNING: --local-warm is ignored for runs that declare the threads or memory they need.', fg='yellow', err=True)
+        LocalScheduler(make_state(jobs, job_options), on_done=on_done).run()
+        return
+      # the scheduler can also cancel runs, e.g. with `qa batch --fail-fast`
+      if job_options.get('fail_fast'):
+        if job_options.get('warm'):
+          click.secho('WARNING: --local-warm is ignored with --fail-fast.', fg='yellow', err=True)
+        state = make_state(jobs, job_options)
+        if job_options.get('concurrency') is None:
+          state['max_jobs'] = 1 # like joblib
+        LocalScheduler(state, on_done=on_done).run()
+        return
+
+      if job_options.get('warm'):
+        remaining_jobs = start_jobs_warm(jobs, job_options)
+        if not remaining_jobs:
+          return
+        jobs = remaining_jobs
 
       from joblib import Parallel, delayed
       # multiprocessing will try to reimport qaboard, which relies on the CWD
@@ -47,4 +79,120 @@ class LocalRunner(BaseRunner):
 
   @staticmethod
   def stop_jobs(jobs: List[Job], job_options: Dict[str, Any]):
-    return NotImplementedError
\ No newline at end of file
+    from .local_scheduler import running_schedulers, stop_detached
+    command_id = job_options['command_id']
+    if command_id in running_schedulers:
+      running_schedulers[command_id].stop()
+    elif not stop_detached(command_id):
+      click.secho(f'WARNING: Could not find runs to stop for {command_id}', fg='yellow', err=True)
+
+
+
+def qa_cli_args(command: str) -> Optional[Tuple[str, List[str]]]:
+  """
+  Parses the commands created by `qa batch`, like `[cd subproject && ]qa [options] run [options]`.
+  Returns the directory where it runs and the CLI arguments, or None if it's not a simple `qa` command.
+  """
+  match = re.match(r'^(?:cd (\S+) && )?(?:qa|python -m qaboard) (.*)$', command, re.DOTALL)
+  if not match:
+    return None
+  directory, args = match.groups()
+  # e.g. "qa wait --output-id 1 || qa run ..."
+  if any(operator in args for operator in ('&&', '||', ';', '|', '`', '$(')):
+    return None
+  try:
+    return directory or '.', shlex.split(args)
+  except ValueError:
+    return None
+
+
+def start_jobs_warm(jobs: List[Job], job_options: Dict[str, Any]) -> List[Job]:
+  """
+  Runs the jobs in worker processes that import qaboard and the entrypoint once, and call `qa run` in-process.
+  Returns the jobs that could not be run this way, and should be started as usual.
+  """
+  from concurrent.futures import ProcessPoolExecutor, as_completed
+  from concurrent.futures.process import BrokenProcessPool
+  import multiprocessing
+
+  if os.name == 'nt': # we only know how to parse POSIX-style commands
+    return jobs
+  cwd = job_options.get('cwd', os.getcwd())
+  warm_jobs, remaining_jobs = [], []
+  for job in jobs:
+    cli_args = qa_cli_args(job.run_context.command)
+    (warm_jobs if cli_args else remaining_jobs).append((job, cli_args))
+  # qaboard reads its configuration once per process, when imported, from the working directory
+  directories = set(cli_args[0] for _, cli_args in warm_jobs)
+  if len(directories) != 1:
+    return jobs
+  workers_cwd = str(Path(cwd) / directories.pop())
+
+  concurrency = job_options.get('concurrency')
+  if not concurrency:
+    workers = 1 if concurrency is None else os.cpu_count() or 1
+  elif concurrency < 0:
+    workers = max(1, (os.cpu_count() or 1) + 1 + concurrency)
+  else:
+    workers = concurrency
+  workers = min(workers, len(warm_jobs))
+
+  previous_cwd = os.getcwd()
+  os.chdir(workers_cwd)
+  # we start fresh processes, forking would copy the state of `qa batch` (threads, open files...)
+  context = multiprocessing.get_context('spawn')
+  not_done = []
+  try:
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as executor:
+      futures = {executor.submit(_run_in_worker, cli_args[1]): job for job, cli_args in warm_jobs}
+      for future in as_completed(futures):
+        job = futures[future]
+        try:
+          returncode = future.result()
+          if job_options.get('on_job_done'):
+            job_options['on_job_done'](job, returncode != 0)
+        except BrokenProcessPool:
+          # e.g. a run crashed the interpreter: we don't know which one, so we'll run the others again as usual
+          not_done.append(job)
+  except BrokenProcessPool:
+    not_done = [job for job, _ in warm_jobs]
+  finally:
+    os.chdir(previous_cwd)
+  if not_done:
+    click.secho(f'WARNING: A worker process crashed, {len(not_done)} runs will be started again.', fg='yellow', err=True)
+  return [job for job, _ in remaining_jobs] + not_done
+
+
+def _init_worker():
+  # imports qaboard, reads the configuration...
+  importlib.import_module('..qa', __package__)
+
+
+def _run_in_worker(args: List[str]) -> int:
+  """Calls the `qa` CLI in the current process, isolating the runs from each other."""
+  from ..qa import qa
+  from ..api import flush_notifications
+  environ, cwd, argv = dict(os.environ), os.getcwd(), sys.argv
+  sys.argv = ['qa', *args]
+  try:
+    qa.main(args=args, prog_name='qa', obj={}, auto_envvar_prefix='QA', standalone_mode=False)
+    return 0
+  except SystemExit as e:
+    return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+  except click.exceptions.Exit as e:
+    return e.exit_code
+  except click.ClickException as e:
+    e.show()
+    return e.exit_code
+  except Exception:
+    import traceback
+    click.secho(f'[ERROR] {" ".join(args)}', fg='red', err=True)
+    click.secho(traceback.format_exc(), fg='red', err=True)
+    return 1
+  finally:
+    flush_notifications()
+    # runs can change the environment (e.g. with configurations like {"ENV": {...}}) and the working directory
+    os.environ.clear()
+    os.environ.update(environ)
+    os.chdir(cwd)
+    sys.argv = argv
@@ -0,0 +1,315 @@
+"""
+Schedules local runs according to the threads and memory they need, so we don't oversubscribe the host.
+
+Runs declare their cost in the batches YAML, like for LSF:
+```yaml
+my-batch:
+  inputs:
+  - image.jpg
+  local:
+    threads: 4
+    memory: 8000 # MB
+```
+By default all the host's CPUs and RAM are available. You can restrict them in qaboard.yaml:
+```yaml
+runners:
+  local:
+    threads: 16
+    memory: 32000 # MB
+```
+
+The scheduler's state is saved as a JSON file, so that detached batches (`qa batch --no-wait`)
+can run in the background and be followed with `qa wait --command-id`.
+"""
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple, Callable
+
+import click
+
+from ..conventions import local_cache_dir
+
+
+# Keys that describe the cost of a run, with the same names as the LSF runner options
+resource_options = ('threads', 'max_threads', 'memory', 'max_memory')
+state_version = 1
+# we are woken up when a run finishes, this is only a fallback
+poll_interval = 1 # seconds
+# Schedulers running in this process, by command ID, so that they can be stopped
+running_schedulers: Dict[str, 'LocalScheduler'] = {}
+
+
+def to_megabytes(value: Any) -> int:
+  if isinstance(value, str):
+    value = value.strip().upper()
+    for suffix, factor in (('G', 1000), ('M', 1)):
+      if value.endswith(suffix) or value.endswith(f'{suffix}B'):
+        return int(float(value.rstrip('B')[:-1]) * factor)
+  return int(float(value or 0))
+
+
+def uses_resources(job_options: Dict[str, Any]) -> bool:
+  return any(job_options.get(k) for k in resource_options)
+
+
+def job_resources(job_options: Dict[str, Any]) -> Tuple[int, int]:
+  """Returns the (threads, memory in MB) a run needs."""
+  threads = int(job_options.get('threads') or job_options.get('max_threads') or 1)
+  memory = to_megabytes(job_options.get('memory') or job_options.get('max_memory') or 0)
+  return max(1, threads), max(0, memory)
+
+
+def host_resources(job_options: Dict[str, Any]) -> Tuple[int, int]:
+  """Returns the (threads, memory in MB) available for runs. 0 memory means we don't know it."""
+  threads = int(job_options.get('host_threads') or 0) or os.cpu_count() or 1
+  memory = to_megabytes(job_options.get('host_memory') or 0)
+  if not memory:
+    try:
+      memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1000 * 1000)
+    except (ValueError, OSError, AttributeError): # e.g. on Windows
+      memory = 0
+  return threads, memory
+
+
+def state_path(command_id: str) -> Path:
+  return local_cache_dir() / 'local-batches' / f'{command_id}.json'
+
+
+def read_state(path: Path) -> Optional[Dict[str, Any]]:
+  try:
+    return json.loads(path.read_text())
+  except (OSError, ValueError):
+    return None
+
+
+def write_state(path: Path, state: Dict[str, Any]):
+  # readers never see partially written files
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+  tmp_path.write_text(json.dumps(state, indent=2))
+  os.replace(str(tmp_path), str(path))
+
+
+def is_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except (PermissionError, OSError):
+    pass
+  return True
+
+
+def make_state(jobs, job_options: Dict[str, Any]) -> Dict[str, Any]:
+  host_threads, host_memory = host_resources(job_options)
+  concurrency = job_options.get('concurrency')
+  if not concurrency:
+    max_jobs = 0 # the resources are the limit
+  elif concurrency < 0:
+    max_jobs = max(1, (os.cpu_count() or 1) + 1 + concurrency)
+  else:
+    max_jobs = concurrency
+  state_jobs = []
+  for job in jobs:
+    threads, memory = job_resources(job.run_context.job_options)
+    state_jobs.append({
+      "id": job.id,
+      "command": job.run_context.command,
+      "cwd": str(job_options.get('cwd', os.getcwd())),
+      "output_dir": str(job.run_context.output_dir),
+      "threads": threads,
+      "memory": memory,
+      "status": "pending",
+      "returncode": None,
+      "pid": None,
+    })
+  return {
+    "version": state_version,
+    "command_id": job_options.get('command_id'),
+    "pid": os.getpid(),
+    "status": "pending",
+    "threads": host_threads,
+    "memory": host_memory,
+    "max_jobs": max_jobs,
+    "jobs": state_jobs,
+  }
+
+
+class LocalScheduler():
+  def __init__(self, state: Dict[str, Any], path: Optional[Path] = None, on_done: Optional[Callable[[int, int], None]] = None):
+    self.state = state
+    self.path = path
+    # called with the index and return code of each job that finishes
+    self.on_done = on_done
+    self.running: Dict[int, subprocess.Popen] = {}
+    self.stopped = False
+    # set when a run finishes or when we are stopped
+    self.wakeup = threading.Event()
+
+  def save(self):
+    if self.path:
+      write_state(self.path, self.state)
+
+  def fits(self, job: Dict[str, Any]) -> bool:
+    running = [self.state['jobs'][i] for i in self.running]
+    if not running:
+      return True # a run larger than the host will still run, alone
+    if self.state['max_jobs'] and len(running) >= self.state['max_jobs']:
+      return False
+    threads = sum(j['threads'] for j in running) + job['threads']
+    memory = sum(j['memory'] for j in running) + job['memory']
+    return threads <= self.state['threads'] and (not self.state['memory'] or memory <= self.state['memory'])
+
+  def start(self, index: int):
+    job = self.state['jobs'][index]
+    process = subprocess.Popen(
+      job['command'], shell=True,
+      cwd=job['cwd'],
+      # to stop runs, we need to stop the processes started by the shell too
+      start_new_session=os.name != 'nt',
+    )
+    self.running[index] = process
+    job.update({"status": "running", "pid": process.pid, "start": time.time()})
+    threading.Thread(target=self.wait, args=(process,), daemon=True).start()
+
+  def wait(self, process: subprocess.Popen):
+    process.wait()
+    self.wakeup.set()
+
+  def stop(self):
+    """Cancels the pending jobs and terminates the running ones."""
+    self.stopped = True
+    self.wakeup.set()
+
+  def run(self) -> int:
+    """Runs all the jobs, and returns how many failed."""
+    self.state.update({"status": "running", "pid": os.getpid()})
+    pending = [i for i, job in enumerate(self.state['jobs']) if job['status'] == 'pending']
+    self.save()
+    command_id = self.state.get('command_id')
+    if command_id:
+      running_schedulers[command_id] = self
+    cancelled = False
+    try:
+      while pending or self.running:
+        self.wakeup.clear()
+        changed = False
+        if self.stopped and not cancelled:
+          cancelled = True
+          for index in pending:
+            self.state['jobs'][index]['status'] = 'cancelled'
+          pending = []
+          for process in self.running.values():
+            if process.poll() is None:
+              terminate(process)
+          changed = True
+        # first-fit: smaller runs can use the resources left by the run at the head of the queue
+        for index in list(pending):
+          if self.fits(self.state['jobs'][index]):
+            self.start(index)
+            pending.remove(index)
+            changed = True
+        for index, process in list(self.running.items()):
+          returncode = process.poll()
+          if returncode is not None:
+            del self.running[index]
+            status = "cancelled" if self.stopped and returncode else "done"
+            self.state['jobs'][index].update({"status": status, "returncode": returncode, "end": time.time()})
+            if self.on_done and status == 'done':
+              self.on_done(index, returncode)
+            changed = True
+        if changed:
+          self.save()
+        else:
+          self.wakeup.wait(poll_interval)
+    finally:
+      for process in self.running.values():
+        terminate(process)
+      self.state['status'] = 'done'
+      self.save()
+      if command_id:
+        running_schedulers.pop(command_id, None)
+    return sum(1 for job in self.state['jobs'] if job['returncode'] or job['status'] == 'cancelled')
+
+
+def terminate(process: subprocess.Popen):
+  if os.name == 'nt':
+    process.terminate()
+    return
+  import signal
+  try:
+    os.killpg(process.pid, signal.SIGTERM)
+  except OSError:
+    process.terminate()
+
+
+def start_detached(jobs, job_options: Dict[str, Any]) -> Path:
+  """Starts the jobs in a background process, and returns the path to the state file."""
+  command_id = job_options.get('command_id') or str(os.getpid())
+  path = state_path(command_id)
+  state = make_state(jobs, job_options)
+  write_state(path, state)
+  log_path = path.with_suffix('.log')
+  with log_path.open('w') as log:
+    subprocess.Popen(
+      [sys.executable, '-m', 'qaboard.runners.local_scheduler', str(path)],
+      cwd=job_options.get('cwd', os.getcwd()),
+      stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+      start_new_session=True, # keeps running when the terminal closes
+    )
+  return path
+
+
+def wait_for_state(path: Path, verbose=True) -> bool:
+  """Waits until a detached batch is done, and returns whether some runs failed."""
+  last_done = None
+  while True:
+    state = read_state(path)
+    if not state:
+      click.secho(f'ERROR: Could not read the batch state from {path}', fg='red', err=True)
+      return True
+    done = sum(1 for job in state['jobs'] if job['status'] in ('done', 'cancelled'))
+    if state['status'] == 'done':
+      break
+    if state['status'] == 'running' and not is_alive(state['pid']):
+      click.secho(f'ERROR: The batch scheduler (pid {state["pid"]}) died. Logs: {path.with_suffix(".log")}', fg='red', err=True)
+      return True
+    if verbose and done != last_done:
+      click.secho(f'...waiting: {done}/{len(state["jobs"])} runs done', dim=True, err=True)
+      last_done = done
+    time.sleep(1)
+  failed = [job for job in state['jobs'] if job['returncode'] and job['status'] == 'done']
+  for job in failed:
+    click.secho(f'ERROR: Failed run! More info at: {job["output_dir"]}', fg='red', err=True)
+  cancelled = [job for job in state['jobs'] if job['status'] == 'cancelled']
+  if cancelled:
+    click.secho(f'WARNING: {len(cancelled)} runs were cancelled.', fg='yellow', err=True)
+  return bool(failed or cancelled)
+
+
+def stop_detached(command_id: str) -> bool:
+  """Stops a batch running in the background. Returns False if it was not running."""
+  import signal
+  state = read_state(state_path(command_id))
+  if not state or state['status'] == 'done' or not is_alive(state['pid']):
+    return False
+  os.kill(state['pid'], signal.SIGTERM)
+  return True
+
+
+if __name__ == '__main__':
+  path = Path(sys.argv[1])
+  state = read_state(path)
+  if not state or state.get('version') != state_version:
+    click.secho(f'ERROR: Invalid batch state at {path}', fg='red', err=True)
+    exit(1)
+  scheduler = LocalScheduler(state, path)
+  # `qa batch --fail-fast` or QA-Board can stop us
+  import signal
+  signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+  scheduler.run()
@@ -11,12 +11,15 @@ Note:
 """
 import re
 import os
+import json
 import random
 import string
+import shutil
 import subprocess
+from copy import copy
 from pathlib import Path
 from dataclasses import dataclass, fields, replace, asdict
-from typing import Optional, List, Dict, Any, cast
+from typing import Optional, List, Dict, Any, Tuple, Callable, cast
 
 from click import secho
 
@@ -25,6 +28,7 @@ from .job import Job
 from ..run import RunContext
 from ..api import get_output
 from ..utils import getenvs
+from ..conventions import local_cache_dir
 
 
 
@@ -54,6 +58,19 @@ class LsfOptions():
   # as a format string, e.g.
   #   "ssh my-bridge-host {bsub_command}"
   #   "sss my-bridge-host su {user} {bsub_command}"
+  # Runs can be sent as job arrays, each element runs `chunk_size` runs one after the other.
+  # It's opt-in: the LSF hosts (and the `bridge` user) must be able to read `arrays_dir`
+  arrays: bool = os.environ.get('QA_RUNNERS_LSF_ARRAYS', '') in ('1', 'true', 'True')
+  chunk_size: int = 1
+  # Clusters limit the size of arrays (MAX_JOB_ARRAY_SIZE in lsb.params, 1000 by default)
+  array_max_size: int = 1000
+  # Where we save the tables of commands run by each array. It must be readable from the LSF hosts.
+  # By default we use qaboard's cache in your home directory, usually on shared storage.
+  arrays_dir: str = os.environ.get('QA_RUNNERS_LSF_ARRAYS_DIR', '')
+  # How blocking batches know that jobs are done:
+  # - "bjobs": polls the status of all jobs with a single `bjobs` call, and reports each job as it finishes
+  # - "wait": sends a job that waits for the others, we only know when all jobs finished
+  tracking: str = 'bjobs'
     
 
 # We'll filter user-provided options, keeping only known ones
@@ -94,7 +111,7 @@ class LsfRunner(BaseRunner):
     return f"{batch_prefix}_{random_str}"
 
 
-  def start(self, blocking=True, name: Optional[str] = None, flags: str = ''):
+  def start(self, blocking=True, name: Optional[str] = None, flags: str = '', log_file: Optional[Path] = None):
     """Sends a job to the LSF queue and returns the results of the subprocess call that sent the command to LSF.
     The `dependencies` parameter specifies jobs that must be exited (any error code is OK) before this one.
     """
@@ -104,7 +121,7 @@ class LsfRunner(BaseRunner):
     # In our cluster, we have filessytem sync issues, and LSF does't print live logs.
     # So here we save STDOUT to log.lsf.txt, while we log in real-time log.txt ourselves
     # Ideally we should copy the actual LSF logs after the job, since they have STDOUT and a summary header
-    lsf_log_file = (self.output_dir / "log.lsf.txt").resolve() if self.output_dir else None
+    lsf_log_file = log_file if log_file else (self.output_dir / "log.lsf.txt").resolve() if self.output_dir else None
     bsub_command = " ".join(
       [
         # When running without a TTY (usually under su/sudo)
@@ -170,8 +187,17 @@ class LsfRunner(BaseRunner):
   @staticmethod
   def start_jobs(jobs: List[Job], job_options: Dict[str, Any], blocking=True):
     # start asynchronously the jobs 
-    for job in jobs:
-      job.start(blocking=False)
+    # LSF job ID and array index => jobs
+    lsf_jobs: Dict[Tuple[str, int], List[Job]] = {}
+    arrays = dict_to_LsfOptions(job_options).arrays
+    if arrays:
+      lsf_jobs = start_job_arrays(jobs, job_options)
+    else:
+      for job in jobs:
+        out = job.start(blocking=False)
+        lsf_job_id = parse_lsf_job_id(out.stdout)
+        if lsf_job_id:
+          lsf_jobs[(lsf_job_id, 0)] = [job]
 
     if blocking:
       # Runs may take a while, so just in case we receive SIGTERM/SIGINT,
@@ -185,15 +211,27 @@ class LsfRunner(BaseRunner):
       signal.signal(signal.SIGINT, sigterm_handler)
 
 
-      # We create a job that will just wait for the others
-      from copy import deepcopy
-      waiting_job = deepcopy(jobs[0])
-      waiting_job.runner = cast(LsfRunner, waiting_job.runner) # we'll never mix runners
-      waiting_job.runner.options = dict_to_LsfOptions(job_options)
-      waiting_job.runner.command = 'echo Done'
-      waiting_job.runner.output_dir = None # disable logging
-      batch_prefix = f"{job_options['command_id'][:8]}_"
-      waiting_job.start(blocking=True, name=f'{batch_prefix}WAIT', flags=f'-w "ended({batch_prefix}*)"')
+      options = dict_to_LsfOptions(job_options)
+      is_tracked = False
+      # we need the LSF job ID of all jobs
+      if options.tracking == 'bjobs' and sum(len(j) for j in lsf_jobs.values()) == len(jobs):
+        is_tracked = LsfTracker(lsf_jobs, options, on_job_done=job_options.get('on_job_done')).wait()
+      if not is_tracked:
+        if job_options.get('fail_fast'):
+          secho('WARNING: We can only know when all LSF jobs are done, --fail-fast is ignored.', fg='yellow', err=True)
+        # We create a job that will just wait for the others
+        from copy import deepcopy
+        waiting_job = deepcopy(jobs[0])
+        waiting_job.runner = cast(LsfRunner, waiting_job.runner) # we'll never mix runners
+        waiting_job.runner.options = options
+        waiting_job.runner.command = 'echo Done'
+        waiting_job.runner.output_dir = None # disable logging
+        batch_prefix = f"{job_options['command_id'][:8]}_"
+        waiting_job.start(blocking=True, name=f'{batch_prefix}WAIT', flags=f'-w "ended({batch_prefix}*)"')
+
+      # the arrays are done, we don't need their commands anymore
+      if arrays:
+        shutil.rmtree(str(job_arrays_dir(job_options)), ignore_errors=True)
 
       # Our shared storage takes a while to sync when using LSF. It should be solved, and this sleep removed...
       if not all([j.id for j in jobs]): # if we can read the status from the database, no sync issue
@@ -227,3 +265,185 @@ class LsfRunner(BaseRunner):
       job_not_found = "is not found" in out.stdout
       if not (being_terminated or job_not_found): 
         raise ValueError(out.stdout)
+
+
+
+# Runs the commands of an element of a job array. Each line of the table is "log_file<TAB>base64(command)"
+array_element_script = """#!/bin/sh
+table="$1"
+chunk_size="$2"
+first=$(( (LSB_JOBINDEX - 1) * chunk_size + 1 ))
+last=$(( LSB_JOBINDEX * chunk_size ))
+status=0
+tab="$(printf '\\t')"
+while IFS="$tab" read -r log_file encoded_command; do
+  [ -z "$encoded_command" ] && continue
+  command="$(printf '%s' "$encoded_command" | base64 -d)"
+  echo "[$LSB_JOBINDEX] $command"
+  if [ "$log_file" = "-" ]; then
+    sh -c "$command" < /dev/null || status=1
+  else
+    sh -c "$command" < /dev/null > "$log_file" 2>&1 || status=1
+  fi
+done << EOF
+$(sed -n "${first},${last}p" "$table")
+EOF
+exit $status
+"""
+
+
+# Batches that don't wait for their jobs can't remove their command tables, we remove them later
+max_arrays_dir_age = 7 * 24 * 3600 # seconds
+
+
+def job_arrays_root(job_options: Dict[str, Any]) -> Path:
+  arrays_dir = dict_to_LsfOptions(job_options).arrays_dir
+  return Path(arrays_dir) if arrays_dir else local_cache_dir() / 'lsf-arrays'
+
+
+def job_arrays_dir(job_options: Dict[str, Any]) -> Path:
+  """Where we save the command tables of a batch. Like the output directories, it must be readable from the LSF hosts."""
+  return job_arrays_root(job_options) / job_options['command_id']
+
+
+def clean_job_arrays_dirs(root: Path):
+  """Removes the command tables of old batches."""
+  import time
+  try:
+    directories = list(root.iterdir())
+  except OSError:
+    return
+  for directory in directories:
+    try:
+      if directory.stat().st_mtime < time.time() - max_arrays_dir_age:
+        shutil.rmtree(str(directory), ignore_errors=True)
+    except OSError:
+      continue
+
+
+def start_job_arrays(jobs: List[Job], job_options: Dict[str, Any]) -> Dict[Tuple[str, int], List[Job]]:
+  """
+  Sends the jobs to LSF as job arrays, instead of calling bsub for each job.
+  Jobs with the same LSF options are sent in the same array. Each element of the array
+  reads the commands it runs from a table, at the lines given by $LSB_JOBINDEX.
+  Returns the jobs run by each (LSF job ID, array index).
+  """
+  import base64
+  # jobs can have different LSF options, depending on their batch/input
+  groups: Dict[str, List[Job]] = {}
+  for job in jobs:
+    options = cast(LsfRunner, job.runner).options
+    groups.setdefault(json.dumps(asdict(options), sort_keys=True, default=str), []).append(job)
+
+  clean_job_arrays_dirs(job_arrays_root(job_options))
+  arrays_dir = job_arrays_dir(job_options)
+  arrays_dir.mkdir(parents=True, exist_ok=True)
+  script_path = arrays_dir / 'run.sh'
+  script_path.write_text(array_element_script)
+
+  lsf_jobs: Dict[Tuple[str, int], List[Job]] = {}
+  for group_jobs in groups.values():
+    options = cast(LsfRunner, group_jobs[0].runner).options
+    chunk_size = max(1, int(options.chunk_size))
+    runs_per_array = chunk_size * max(1, int(options.array_max_size))
+    for offset in range(0, len(group_jobs), runs_per_array):
+      array_jobs = group_jobs[offset:offset + runs_per_array]
+      runner = cast(LsfRunner, array_jobs[0].runner)
+      name = runner.name
+      table = []
+      for job in array_jobs:
+        job_runner = cast(LsfRunner, job.runner)
+        if job_runner.output_dir:
+          job_runner.output_dir.mkdir(parents=True, exist_ok=True)
+        log_file = (job_runner.output_dir / "log.lsf.txt").resolve() if job_runner.output_dir else '-'
+        command = job_runner.command if job_runner.command else 'echo OK'
+        table.append(f"{log_file}\t{base64.b64encode(command.encode('utf-8')).decode('ascii')}\n")
+      table_path = arrays_dir / f'{name}.tsv'
+      table_path.write_text(''.join(table))
+
+      elements = (len(array_jobs) + chunk_size - 1) // chunk_size
+      array_runner = copy(runner)
+      array_runner.command = f'sh "{script_path}" "{table_path}" {chunk_size}'
+      out = array_runner.start(
+        blocking=False,
+        name=f'{name}[1-{elements}]',
+        # LSF replaces %I by the index of the element
+        log_file=arrays_dir / f'{name}.%I.log',
+      )
+      lsf_job_id = parse_lsf_job_id(out.stdout)
+      if lsf_job_id:
+        for index in range(elements):
+          lsf_jobs[(lsf_job_id, index + 1)] = array_jobs[index * chunk_size:(index + 1) * chunk_size]
+  return lsf_jobs
+
+
+def parse_lsf_job_id(bsub_stdout: str) -> Optional[str]:
+  # e.g. "Job <1234> is submitted to queue <normal>."
+  match = re.search(r'Job <(\d+)> is submitted', bsub_stdout or '')
+  return match.group(1) if match else None
+
+
+# https://www.ibm.com/docs/en/spectrum-lsf/10.1.0?topic=bjobs-description
+lsf_finished_statuses = ('DONE', 'EXIT')
+# seconds between bjobs calls, it increases while nothing changes
+poll_interval_min = 2
+poll_interval_max = 30
+
+
+class LsfTracker():
+  """
+  Waits for LSF jobs, reporting each job as soon as it finishes.
+  A single `bjobs` call returns the status of all the jobs.
+  """
+  def __init__(self, lsf_jobs: Dict[Tuple[str, int], List[Job]], options: LsfOptions, on_job_done: Optional[Callable[[Job, Optional[bool]], None]] = None):
+    self.lsf_jobs = lsf_jobs
+    self.options = options
+    self.on_job_done = on_job_done
+    self.pending = set(lsf_jobs)
+
+  def bjobs(self) -> Optional[Dict[Tuple[str, int], Tuple[str, Optional[int]]]]:
+    """Returns the (status, exit code) of the jobs, or None if bjobs failed."""
+    lsf_job_ids = sorted(set(lsf_job_id for lsf_job_id, _ in self.pending))
+    command = f"bjobs -a -noheader -o 'jobid jobindex stat exit_code delimiter=\"|\"' {' '.join(lsf_job_ids)}"
+    if self.options.bridge:
+      command = self.options.bridge.format(**asdict(self.options), bsub_command=command)
+    out = subprocess.run(command, shell=True, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    statuses = {}
+    for line in out.stdout.splitlines():
+      fields = line.strip().split('|')
+      if len(fields) != 4 or not fields[0].isdigit():
+        continue
+      lsf_job_id, index, status, exit_code = fields
+      statuses[(lsf_job_id, int(index) if index.isdigit() else 0)] = (status, int(exit_code) if exit_code.isdigit() else 0)
+    if not statuses and out.returncode != 0 and 'is not found' not in out.stderr + out.stdout:
+      secho(f'WARNING: Could not get the status of LSF jobs with `{command}`: {out.stderr}', fg='yellow', err=True)
+      return None
+    # jobs that finished a long time ago are forgotten by LSF (CLEAN_PERIOD in lsb.params)
+    for lsf_job_id in re.findall(r'Job <(\d+)> is not found', out.stderr + out.stdout):
+      for key in self.pending:
+        if key[0] == lsf_job_id:
+          statuses[key] = ('DONE', None) # we don't know if they failed
+    return statuses
+
+  def wait(self) -> bool:
+    """Waits until all jobs are done. Returns False if we could not track them."""
+    import time
+    poll_interval = poll_interval_min
+    while self.pending:
+      statuses = self.bjobs()
+      if statuses is None:
+        return False
+      finished = [key for key in self.pending if statuses.get(key, ('', 0))[0] in lsf_finished_statuses]
+      for key in finished:
+        self.pending.remove(key)
+        status, exit_code = statuses[key]
+        # with chunks, we don't know which run made the element fail
+        is_failed = status == 'EXIT' if len(self.lsf_jobs[key]) == 1 and exit_code is not None else None
+        for job in self.lsf_jobs[key]:
+          if self.on_job_done:
+            self.on_job_done(job, is_failed)
+      if not self.pending:
+        break
+      poll_interval = poll_interval_min if finished else min(poll_interval * 1.5, poll_interval_max)
+      time.sleep(poll_interval)
+    return True
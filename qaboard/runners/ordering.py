@@ -0,0 +1,120 @@
+"""
+Orders the runs of a batch by how long they took in the past, to start the longest runs first.
+Otherwise a few long runs started last can finish long after all the others.
+
+Past durations are the `compute_time` metric saved by `qa run`. We read it from the latest results
+of the same batch on the reference branch in QA-Board, else from runs already in the output directories.
+"""
+import os
+import json
+import heapq
+import datetime
+import statistics
+from typing import List, Dict, Any, Optional, Tuple
+
+import click
+
+from .job import Job, JobGroup
+
+
+def reference_batch(qa_context: Dict[str, Any], reference: str, is_branch=True) -> Optional[Dict[str, Any]]:
+  """Returns the same batch on the reference branch or commit, with the outputs' metrics."""
+  from ..api import batch_info
+  if qa_context.get('offline'):
+    return None
+  for batch_label in dict.fromkeys((qa_context['batch_label'], 'default')):
+    try:
+      return batch_info(reference=reference, is_branch=is_branch, batch=batch_label, metrics=['compute_time'])
+    except Exception:
+      continue
+  return None
+
+
+def reference_outputs(qa_context: Dict[str, Any], reference: str) -> List[Dict[str, Any]]:
+  """Returns the outputs of the same batch on the reference branch, with their metrics."""
+  batch = reference_batch(qa_context, reference)
+  return list(batch['outputs'].values()) if batch else []
+
+
+def local_compute_time(job: Job) -> Optional[float]:
+  try:
+    with (job.run_context.output_dir / 'metrics.json').open() as f:
+      return float(json.load(f)['compute_time'])
+  except (OSError, ValueError, KeyError, TypeError):
+    return None
+
+
+def past_durations(jobs: List[Job], outputs: List[Dict[str, Any]]) -> List[Optional[float]]:
+  """Returns how long each job took in the past, or None if we don't know."""
+  from ..api import index_outputs, output_key
+  index = index_outputs(outputs)
+  durations = []
+  for job in jobs:
+    matching_outputs = index.get(output_key(job.run_context))
+    duration = matching_outputs[0].get('metrics', {}).get('compute_time') if matching_outputs else None
+    if duration is None:
+      duration = local_compute_time(job)
+    durations.append(duration)
+  return durations
+
+
+def longest_first(jobs: List[Job], durations: List[Optional[float]]) -> Tuple[List[Job], List[float]]:
+  """Sorts the jobs by decreasing duration. Jobs without history are expected to take the median duration."""
+  known = [d for d in durations if d is not None]
+  default = statistics.median(known) if known else 0
+  expected = [d if d is not None else default for d in durations]
+  order = sorted(range(len(jobs)), key=lambda i: -expected[i]) # stable: ties keep the planned order
+  return [jobs[i] for i in order], [expected[i] for i in order]
+
+
+def makespan(durations: List[float], slots: int) -> float:
+  """How long it takes to run jobs in order when `slots` jobs can run at the same time."""
+  if not durations:
+    return 0
+  workers = [0.0] * max(1, min(slots, len(durations)))
+  for duration in durations:
+    heapq.heappush(workers, heapq.heappop(workers) + duration)
+  return max(workers)
+
+
+def local_slots(job_options: Dict[str, Any], jobs: List[Job]) -> int:
+  """How many jobs the local runner runs at the same time."""
+  from .local_scheduler import uses_resources, job_resources, host_resources
+  if any(uses_resources(job.run_context.job_options) for job in jobs):
+    host_threads, _ = host_resources(job_options)
+    threads = statistics.median(job_resources(job.run_context.job_options)[0] for job in jobs)
+    return max(1, int(host_threads // threads))
+  concurrency = job_options.get('concurrency')
+  if not concurrency:
+    return 1 if concurrency is None else os.cpu_count() or 1
+  if concurrency < 0:
+    return max(1, (os.cpu_count() or 1) + 1 + concurrency)
+  return concurrency
+
+
+def format_duration(seconds: float) -> str:
+  seconds = int(seconds)
+  if seconds < 60:
+    return f'{seconds}s'
+  if seconds < 3600:
+    return f'{seconds // 60}m{seconds % 60:02d}s'
+  return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+
+
+def order_jobs(jobs: JobGroup, qa_context: Dict[str, Any], reference: str):
+  """Starts the longest jobs first, and prints when we expect the batch to finish."""
+  durations = past_durations(jobs.jobs, reference_outputs(qa_context, reference))
+  known = sum(1 for d in durations if d is not None)
+  if not known:
+    click.secho('We could not find how long runs took in the past, they will start in the planned order.', dim=True, err=True)
+    return
+  jobs.jobs, expected = longest_first(jobs.jobs, durations)
+  message = f'{known}/{len(expected)} runs took {format_duration(sum(expected))} in the past, the longest {format_duration(expected[0])}.'
+  if jobs.job_options['type'] == 'local':
+    eta = makespan(expected, local_slots(jobs.job_options, jobs.jobs))
+    end = datetime.datetime.now() + datetime.timedelta(seconds=eta)
+    message += f' Expected to finish in {format_duration(eta)}, around {end:%H:%M}.'
+  else:
+    # we don't know how many runs will be run at the same time
+    message += f' Expected to take at least {format_duration(expected[0])}.'
+  click.secho(message, fg='blue', err=True)
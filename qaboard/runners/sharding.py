@@ -0,0 +1,139 @@
+"""
+Splits batches across machines, e.g. CI nodes. On the 2nd of 4 nodes:
+```bash
+qa batch --shard 2/4 my-batch
+```
+Each shard runs a deterministic part of the runs, and registers them in the same QA-Board batch.
+A final step waits for all the runs and reports the overall status:
+```bash
+qa batch --shard-merge my-batch
+```
+By default runs are assigned to shards by hashing what identifies them (input, platform, configurations, parameters).
+With `--shard-strategy=cost`, runs are balanced using how long they took on the reference branch,
+or on the commit given with `--shard-reference`.
+"""
+import os
+import re
+import json
+import time
+import heapq
+import hashlib
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional
+
+import click
+
+from .job import JobGroup
+from ..run import RunContext
+
+
+# how long --shard-merge waits for the other shards to start their runs
+merge_timeout = float(os.environ.get('QA_BATCH_SHARD_MERGE_TIMEOUT', 3600)) # seconds
+merge_poll_interval = 10 # seconds
+
+
+def shard_key(run_context: RunContext):
+  from ..api import output_key
+  # shards may not have the database at the same location
+  return output_key(run_context, input_path=run_context.rel_input_path.as_posix())
+
+
+def run_hash(run_context: RunContext) -> int:
+  return int(hashlib.sha1(json.dumps(shard_key(run_context)).encode('utf-8')).hexdigest(), 16)
+
+
+@dataclass
+class Shard():
+  index: int # from 1 to count
+  count: int
+  # for cost-balanced sharding: shard index by run key
+  assignments: Dict[Any, int] = field(default_factory=dict)
+
+  @staticmethod
+  def parse(value: str) -> 'Shard':
+    match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', value)
+    if not match or not 1 <= int(match[1]) <= int(match[2]):
+      raise click.BadParameter(f'Expected i/N with 1 <= i <= N, got "{value}"', param_hint='--shard')
+    return Shard(index=int(match[1]), count=int(match[2]))
+
+  def balance(self, outputs: List[Dict[str, Any]]):
+    """
+    Assigns the runs that we know from past outputs to shards, so that all shards take about as long.
+    All shards must see the same outputs to agree on the assignments.
+    """
+    from ..api import output_key
+    durations = {}
+    for output in outputs:
+      compute_time = output.get('metrics', {}).get('compute_time')
+      if output['is_pending'] or compute_time is None:
+        continue
+      # like shard_key: the outputs' input paths are relative to their database
+      durations.setdefault(output_key(RunContext.from_api_output(output)), float(compute_time))
+    # longest processing time first: each run goes to the least loaded shard
+    loads = [(0.0, index) for index in range(1, self.count + 1)]
+    for key in sorted(durations, key=lambda k: (-durations[k], json.dumps(k))):
+      load, index = heapq.heappop(loads)
+      self.assignments[key] = index
+      heapq.heappush(loads, (load + durations[key], index))
+
+  def includes(self, run_context: RunContext) -> bool:
+    index = self.assignments.get(shard_key(run_context)) if self.assignments else None
+    if index is None:
+      index = run_hash(run_context) % self.count + 1
+    return index == self.index
+
+
+def make_shard(value: str, strategy: str, qa_context: Dict[str, Any], reference: str, reference_commit: Optional[str] = None) -> Shard:
+  """
+  With the cost strategy, all shards must balance runs with the same results.
+  Unless they are given the same reference commit, each uses the latest results on the reference branch.
+  """
+  shard = Shard.parse(value)
+  if strategy == 'cost':
+    from .ordering import reference_batch
+    batch = reference_batch(qa_context, reference_commit or reference, is_branch=not reference_commit)
+    if not batch:
+      click.secho(f'WARNING: No results from {reference_commit or reference} to balance shards, runs are assigned by hash.', fg='yellow', err=True)
+      return shard
+    if not reference_commit:
+      click.secho(f'WARNING: Shards are balanced with the results of {reference} at {batch["commit_id"]}. If it gets new results before all shards start, they will disagree: pass the same --shard-reference to all shards.', fg='yellow', err=True)
+    shard.balance(list(batch['outputs'].values()))
+  return shard
+
+
+def merge_shards(jobs: JobGroup, qa_context: Dict[str, Any]) -> bool:
+  """Waits for the runs of all shards, and returns whether some failed or never started."""
+  from ..config import is_ci
+  from ..api import get_outputs, wait_for_outputs, url_to_dir, status_fields
+  deadline = time.time() + merge_timeout
+  online = (is_ci or qa_context['share']) and not qa_context['offline']
+  if not online:
+    # we rely on shared storage
+    while not all(job.run_context.ran() for job in jobs) and time.time() < deadline:
+      time.sleep(merge_poll_interval)
+    return any(job.run_context.is_failed(verbose=True) for job in jobs)
+
+  while True:
+    outputs = get_outputs(qa_context, fields=status_fields)
+    outputs_by_dir = {url_to_dir(o['output_dir_url']): o for o in outputs.values()}
+    missing = [job for job in jobs if job.run_context.output_dir not in outputs_by_dir]
+    if not missing or time.time() > deadline:
+      break
+    click.secho(f'...waiting for the shards to start {len(missing)} runs', dim=True, err=True)
+    time.sleep(merge_poll_interval)
+  for job in missing:
+    click.secho(f'ERROR: No shard started the run at {job.run_context.output_dir}', fg='red', err=True)
+
+  output_ids = [outputs_by_dir[job.run_context.output_dir]['id'] for job in jobs if job.run_context.output_dir in outputs_by_dir]
+  statuses = wait_for_outputs(output_ids) if output_ids else {}
+  failed = 0
+  for job in jobs:
+    output = outputs_by_dir.get(job.run_context.output_dir)
+    if not output:
+      continue
+    status = statuses.get(str(output['id']))
+    if not status or status['is_failed']:
+      failed += 1
+      click.secho(f'ERROR: Failed run! More info in QA-Board or at: {job.run_context.output_dir}', fg='red', err=True)
+  click.secho(f'{len(jobs)} runs: {failed} failed, {len(missing)} not started.', fg='red' if failed or missing else 'green', err=True)
+  return bool(failed or missing)
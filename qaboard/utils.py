@@ -4,19 +4,25 @@ Misc utilities
 import os
 import sys
 import json
+import mmap
 import shutil
 import traceback
 import hashlib
+import threading
 from pathlib import Path
 from itertools import chain
+from collections import OrderedDict
 from fnmatch import fnmatch
 from contextlib import contextmanager
-from typing import Optional, Dict, Iterable, Tuple, Union
+from typing import Any, Optional, Dict, Iterable, Iterator, List, Tuple, Union
 
 import yaml
 import click
 from click._compat import isatty #, strip_ansi
 
+# The C implementation of the YAML parser is much faster, when available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 
 def merge(src: Dict, dest: Dict) -> Dict:
@@ -87,6 +93,22 @@ class RedirectStream():
     self.stream.flush()
 
 
+@contextmanager
+def environment(**variables: Optional[str]):
+  """Sets environment variables, e.g. for the processes we start, and restores them on exit. None values are ignored."""
+  variables = {k: v for k, v in variables.items() if v is not None}
+  previous = {k: os.environ.get(k) for k in variables}
+  os.environ.update(variables)
+  try:
+    yield
+  finally:
+    for k, v in previous.items():
+      if v is None:
+        del os.environ[k]
+      else:
+        os.environ[k] = v
+
+
 @contextmanager
 def redirect_std_streams(file, color=None):
   if os.environ.get('QA_NO_STREAM_REDIRECT'):
@@ -109,10 +131,17 @@ class FailingEntrypoint:
     return {"is_failed": True}
 
 
+# Entrypoints imported by this process, by path. Long-lived processes (e.g. the backend) load many of them.
+_entrypoint_modules: "OrderedDict[str, Tuple[Optional[int], Any]]" = OrderedDict()
+_entrypoint_modules_max = 32
+_entrypoint_modules_lock = threading.RLock()
+
 # FIXME: pass a path to the entrypoint, not a full config
 def entrypoint_module(config):
-  """Lazily returns the entrypoint module defined in a qaboard config"""
-  import importlib.util
+  """
+  Lazily returns the entrypoint module defined in a qaboard config.
+  The module is imported once per process, and again only if the file's mtime changes.
+  """
   entrypoint = config.get('project', {}).get('entrypoint')
   if not entrypoint:
     click.secho(f'ERROR: Could not find the entrypoint', fg='red', err=True, bold=True)
@@ -120,19 +149,53 @@ def entrypoint_module(config):
     return FailingEntrypoint()
   else:
     entrypoint = Path(entrypoint)
+  try:
+    mtime_ns: Optional[int] = entrypoint.stat().st_mtime_ns
+  except OSError:
+    mtime_ns = None # the import will fail and report the error
+  key = os.path.abspath(entrypoint)
+  with _entrypoint_modules_lock:
+    if key in _entrypoint_modules and _entrypoint_modules[key][0] == mtime_ns:
+      _entrypoint_modules.move_to_end(key)
+      return _entrypoint_modules[key][1]
+    module = _import_entrypoint(entrypoint)
+    _entrypoint_modules[key] = (mtime_ns, module)
+    while len(_entrypoint_modules) > _entrypoint_modules_max:
+      _entrypoint_modules.popitem(last=False)
+    return module
+
+
+def reload_entrypoint_module(config=None):
+  """
+  Imports again the entrypoint module for this config, or forgets all of them if no config is given.
+  Useful in long-lived processes when the modules imported by the entrypoint changed.
+  """
+  with _entrypoint_modules_lock:
+    if config is None:
+      _entrypoint_modules.clear()
+      return None
+    entrypoint = config.get('project', {}).get('entrypoint')
+    if entrypoint:
+      _entrypoint_modules.pop(os.path.abspath(entrypoint), None)
+    return entrypoint_module(config)
+
+
+def _import_entrypoint(entrypoint: Path):
+  import importlib.util
   try:
       name = f'qaboard-entrypoint'
       # https://docs.python.org/3/library/importlib.html#importing-a-source-file-directly
       spec = importlib.util.spec_from_file_location(name, entrypoint)
       assert spec
       module = importlib.util.module_from_spec(spec)
+      if str(entrypoint.parent) in sys.path:
+        sys.path.remove(str(entrypoint.parent))
       sys.path.insert(0, str(entrypoint.parent))
       spec.loader.exec_module(module)
       # sys.path.pop(0)
 
       # spec = importlib.util.spec_from_loader(name, importlib.machinery.SourceFileLoader(name, str(entrypoint)))
       # spec.submodule_search_locations = [str(entrypoint.parent)]
-      # with cached versions of the entrypoint.... An option could be importlib.reload(module)
       # FIXME: at some points I had issues with sys.path, but no more (?)
   except Exception as e:
       exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -146,16 +209,29 @@ def entrypoint_module(config):
   return module
 
 
-# TODO: consider using @lru_cache since it's called twice within qa batch
-# from functools import lru_cache
-# @lru_cache() # but config not hashable.. we'd need to pass a path to the entrypoint
-def input_metadata(absolute_input_path, database, input_path, config):
-  entrypoint_module_ = entrypoint_module(config)
+def input_metadata(absolute_input_path, database, input_path, config, metadata_cache=None, entrypoint_module_=None):
+  """
+  Returns the metadata of an input, from the `metadata` function in the entrypoint.
+  If given a `metadata_cache`, inputs that did not change since their metadata was computed are not read again.
+  """
+  if entrypoint_module_ is None:
+    entrypoint_module_ = entrypoint_module(config)
   if hasattr(entrypoint_module_, 'metadata'):
+    stat = None
+    if metadata_cache is not None:
+      try:
+        stat = metadata_cache.stat(absolute_input_path)
+        metadata = metadata_cache.get(absolute_input_path, stat)
+        if metadata is not None:
+          return metadata
+      except OSError:
+        pass
     try:
       metadata = entrypoint_module_.metadata(absolute_input_path, database, input_path)
       if metadata is None:
       	metadata = {}
+      if stat is not None:
+        metadata_cache.put(absolute_input_path, stat, metadata)
     except Exception as e:
       exc_type, exc_value, exc_traceback = sys.exc_info()
       click.secho(f'[ERROR] The `metadata` function in your raised an exception:', fg='red', bold=True)
@@ -180,6 +256,18 @@ def input_metadata(absolute_input_path, database, input_path, config):
   return metadata
 
 
+def inputs_metadata(absolute_input_paths: List[Path], database: Path, config, metadata_cache=None) -> List[Dict]:
+  """
+  Like input_metadata, but for many inputs at once.
+  `metadata` functions are user code that may not be thread-safe: they are only called in parallel
+  if you opt-in with `inputs.metadata_workers` in qaboard.yaml, or QA_METADATA_WORKERS.
+  """
+  entrypoint_module_ = entrypoint_module(config)
+  def metadata(absolute_input_path):
+    return input_metadata(absolute_input_path, database, absolute_input_path.relative_to(database), config, metadata_cache, entrypoint_module_)
+  return parallel_map(metadata, absolute_input_paths, workers('QA_METADATA_WORKERS', 'inputs.metadata_workers', config))
+
+
 
 
 def _copy(src, destination):
@@ -227,9 +315,23 @@ def is_plaintext(path, config=None):
   exit(1)
 
 
-def file_info(path, normalize_eof=True, config=None, compute_hashes=True, has_footer=False):
-  """Return metadata about a file."""
+def file_info(path, normalize_eof=True, config=None, compute_hashes=True, has_footer=False, stat=None, hash_cache=None, algorithm=None):
+  """
+  Return metadata about a file. If you already know it, you can give the file's `stat` to save a syscall.
+  If given a `hash_cache`, files that did not change since they were last hashed are not read again.
+  The hash is stored under the name of the `algorithm` used, by default the one from `manifest_hash(config)`.
+  """
   path = Path(path)
+  if algorithm is None:
+    algorithm = manifest_hash(config)
+  if compute_hashes and hash_cache is not None:
+    if stat is None:
+      stat = os.stat(path)
+    info = hash_cache.get(path, stat, algorithm)
+    if info is None:
+      info = file_info(path, normalize_eof, config, compute_hashes, has_footer, stat, algorithm=algorithm)
+      hash_cache.put(path, stat, info, algorithm)
+    return info
 
   # For bit-accuracy checks to work on text files between UNIX/windows,
   # we need to convert end-of-lines on Windows
@@ -252,65 +354,227 @@ def file_info(path, normalize_eof=True, config=None, compute_hashes=True, has_fo
     with open(normalized_file_name, 'w+', newline='\n', encoding="utf-8", errors='ignore') as normalized_file:
       normalized_file.write(text)
 
-    normalized_file_info = file_info(normalized_file_name, normalize_eof=False, has_footer=has_footer)
+    normalized_file_info = file_info(normalized_file_name, normalize_eof=False, has_footer=has_footer, algorithm=algorithm)
     Path(normalized_file_name).unlink()
     return normalized_file_info
 
-  return _file_info(path, compute_hashes=compute_hashes)
+  return _file_info(path, compute_hashes=compute_hashes, stat=stat, algorithm=algorithm)
 
 
-def md5_hex(path, length=None):
-  md5 = hashlib.md5()
+# Hash algorithms that can be used in manifests. The web application knows the same (`file_hash` in webapp/src/utils.js)
+manifest_hash_algorithms = ('md5', 'blake2b', 'blake2s', 'sha1', 'sha256', 'sha512')
+
+
+def manifest_hash(config=None) -> str:
+  """
+  The hash algorithm used for manifests. Defaults to md5, blake2b is much faster on modern CPUs and without known collisions.
+  Raises ValueError for algorithms we don't support.
+  """
+  algorithm = os.environ.get('QA_MANIFEST_HASH', (config or {}).get('manifests', {}).get('hash', 'md5'))
+  algorithm = str(algorithm).lower().replace('-', '')
+  if algorithm not in manifest_hash_algorithms:
+    raise ValueError(f'Unknown hash algorithm "{algorithm}" for manifests. Use one of: {", ".join(manifest_hash_algorithms)}')
+  return algorithm
+
+
+def hash_hex(path, algorithm='md5', length=None):
+  """Hex digest of a file, or of its first `length` bytes."""
+  hasher = hashlib.new(algorithm)
   block_size = 4**10
   bytes_read = 0
 
-  # for some reason st_size return None sometimes
-  file_size = os.stat(path).st_size or 0
-  end_byte = length if length else file_size
-
-  with path.open('rb') as f:
-    while bytes_read < end_byte:
-      pos_after_read = bytes_read + block_size
-      if pos_after_read >= end_byte:            # if we exceed read limit we will read until end_byte and not further
-          block_size = end_byte - bytes_read
-          bytes_read = end_byte                 # setting bytes read to a value which will make the loop break in the next iter
-      data = f.read(block_size)
+  if not length:
+    length = None
+  with Path(path).open('rb') as f:
+    if length is None:
+      # Memory-mapping the file lets hashlib read directly from the page cache, without copies
+      try:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+          hasher.update(mapped)
+        return hasher.hexdigest()
+      except (ValueError, OSError): # empty files can't be mapped, and some filesystems don't support it
+        pass
+    # without a length we read until the end of the file, no need to stat it
+    while length is None or bytes_read < length:
+      to_read = block_size if length is None else min(block_size, length - bytes_read)
+      data = f.read(to_read)
       if not data: break
-      md5.update(data)
-      bytes_read += block_size
-  return md5.hexdigest()
+      hasher.update(data)
+      bytes_read += len(data)
+  return hasher.hexdigest()
+
+
+def md5_hex(path, length=None):
+  return hash_hex(path, 'md5', length)
 
 
-def _file_info(path : Path, compute_hashes=True):
+def _file_info(path : Path, compute_hashes=True, stat=None, algorithm='md5'):
+    if stat is None:
+        stat = os.stat(path)
     info: Dict[str, Union[int, str]] = {
-      "st_size": os.stat(path).st_size
+      "st_size": stat.st_size
     }
 
     if compute_hashes:
-        info['md5'] = md5_hex(path)
+        info[algorithm] = hash_hex(path, algorithm)
     return info
 
 
-def outputs_manifest(output_directory: Path, config=None, compute_hashes=True) -> Dict:
+def iter_files(directory: Path) -> Iterator[Tuple[Path, os.stat_result]]:
+  """
+  Yields all the files under a directory, with their stat.
+  Compared to Path.rglob it does a single pass, and each file is stat'ed only once (os.scandir caches the result).
+  Like Path.rglob, we don't follow symbolic links to directories.
+  """
+  directories = [str(directory)]
+  while directories:
+    current = directories.pop()
+    try:
+      with os.scandir(current) as entries:
+        for entry in entries:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              directories.append(entry.path)
+            elif entry.is_file():
+              yield Path(entry.path), entry.stat()
+          except OSError: # e.g. files removed while we walk the directory
+            continue
+    except OSError:
+      continue
+
+
+def workers(env_var: str, config_path: str, config=None, default: int = 1) -> int:
+  """How many threads to use for a task, from an environment variable or a setting in qaboard.yaml (e.g. "inputs.metadata_workers")."""
+  if env_var in os.environ:
+    return int(os.environ[env_var])
+  value = config or {}
+  for key in config_path.split('.'):
+    value = value.get(key) if isinstance(value, dict) else None
+  return int(value) if value else default
+
+
+def parallel_map(function, items: List, max_workers: int) -> List:
+  """Like map, using a pool of threads if there are many workers."""
+  if max_workers <= 1 or len(items) <= 1:
+    return [function(i) for i in items]
+  from concurrent.futures import ThreadPoolExecutor
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+    return list(executor.map(function, items))
+
+
+def files_info(files: List[Tuple[Path, os.stat_result]], config=None, compute_hashes=True, hash_cache=None) -> List[Dict]:
+  """Like file_info, but for many files at once, hashing files in parallel (`manifests.workers` in qaboard.yaml, or QA_MANIFEST_WORKERS)."""
+  algorithm = manifest_hash(config)
+  def info(path_stat):
+    path, stat = path_stat
+    return file_info(path, config=config, compute_hashes=compute_hashes, stat=stat, hash_cache=hash_cache, algorithm=algorithm)
+  if not compute_hashes:
+    return [info(f) for f in files]
+  # hashing is I/O bound on network storage, and hashlib releases the GIL
+  return parallel_map(info, files, workers('QA_MANIFEST_WORKERS', 'manifests.workers', config, default=min(8, os.cpu_count() or 1)))
+
+
+def input_files_info(input_path: Path, config=None, hash_cache=None) -> Dict[Path, Dict]:
+  """Returns metadata about the files of an input, a file or a directory, in the order iter_files finds them."""
+  if input_path.is_dir():
+    files = list(iter_files(input_path))
+  elif input_path.is_file():
+    files = [(input_path, None)]
+  else:
+    return {}
+  infos = files_info(files, config=config, hash_cache=hash_cache)
+  return {path: info for (path, _), info in zip(files, infos)}
+
+
+# We remember when files were hashed next to the manifest, to keep its format unchanged
+manifest_mtimes_name = '.manifest.outputs.mtimes.json'
+
+
+def outputs_manifest(output_directory: Path, config=None, compute_hashes=True, previous: Optional[Dict] = None, previous_mtimes: Optional[Dict[str, int]] = None, previous_mtime_ns: Optional[int] = None, mtimes: Optional[Dict[str, int]] = None) -> Dict:
+  """
+  Lists all the files from the directory, with their size and hash.
+  Given the `previous` manifest and the files' mtimes when it was computed (`previous_mtimes`), only files whose size or mtime changed are hashed again.
+  Files modified after the previous manifest was written (`previous_mtime_ns`) are always hashed again,
+  since on filesystems with a coarse mtime resolution they could have changed after we hashed them.
+  If given a `mtimes` dict, it is filled with the mtimes of the files in the manifest.
+  """
+  if config is None:
+    config = {}
+  if previous is None:
+    previous = {}
+  if previous_mtimes is None:
+    previous_mtimes = {}
+  algorithm = manifest_hash(config)
   def should_be_in_manifest(path):
     # backward-compat with manifests created by run_tv.py,
     # which doesn't copy the TV folder in the output directory
     if config.get("project", {}).get("name", "").startswith("CDE-Users/HW_ALG"):
       if path.name in ("run.json", "metrics.json", "manifest.ouputs.json", "runme_csg.bat") or "Config" in path.parts:
         return False
+    if path.parent == output_directory and path.name in ('manifest.outputs.json', manifest_mtimes_name):
+      return False
     # avoid logs with timestamps and temporary NFS files
-    return path.is_file() and path.name != 'log.txt' and not path.name.startswith('.nfs00000')
-  return {
-    path.relative_to(output_directory).as_posix(): file_info(path, config=config, compute_hashes=compute_hashes)
-    for path in output_directory.rglob('*')
-    if should_be_in_manifest(path)
-  }
-
-def save_outputs_manifest(output_directory: Path, config=None, compute_hashes=True) -> Dict:
-  """Save a manifest of all the files from the directory. It helps QA-Board list them quickly."""
-  manifest = outputs_manifest(output_directory, config, compute_hashes)
+    return path.name != 'log.txt' and not path.name.startswith('.nfs00000')
+  def previous_info(rel_path, stat):
+    info = previous.get(rel_path)
+    if not info or info.get('st_size') != stat.st_size or previous_mtimes.get(rel_path) != stat.st_mtime_ns:
+      return None
+    if previous_mtime_ns is not None and stat.st_mtime_ns >= previous_mtime_ns:
+      return None
+    if compute_hashes and algorithm not in info:
+      return None
+    return info
+
+  manifest = {}
+  to_hash = []
+  for path, stat in iter_files(output_directory):
+    if not should_be_in_manifest(path):
+      continue
+    rel_path = path.relative_to(output_directory).as_posix()
+    if mtimes is not None:
+      mtimes[rel_path] = stat.st_mtime_ns
+    info = previous_info(rel_path, stat)
+    if info is not None:
+      manifest[rel_path] = info
+    else:
+      to_hash.append((rel_path, path, stat))
+  infos = files_info([(path, stat) for _, path, stat in to_hash], config=config, compute_hashes=compute_hashes)
+  for (rel_path, _, _), info in zip(to_hash, infos):
+    manifest[rel_path] = info
+  return manifest
+
+
+def load_outputs_manifest(output_directory: Path) -> Tuple[Optional[Dict], Dict[str, int], Optional[int]]:
+  """Returns the manifest saved in a directory, the files' mtimes when it was computed and when it was written, or (None, {}, None)."""
+  try:
+    with (output_directory / 'manifest.outputs.json').open() as f:
+      manifest = json.load(f)
+  except (OSError, ValueError): # missing or corrupted
+    return None, {}, None
+  mtimes_path = output_directory / manifest_mtimes_name
+  try:
+    mtime_ns = mtimes_path.stat().st_mtime_ns
+    with mtimes_path.open() as f:
+      return manifest, json.load(f), mtime_ns
+  except (OSError, ValueError): # e.g. manifests written by older versions: we'll hash all files again
+    return manifest, {}, None
+
+
+def save_outputs_manifest(output_directory: Path, config=None, compute_hashes=True, incremental=False) -> Dict:
+  """
+  Save a manifest of all the files from the directory. It helps QA-Board list them quickly.
+  If `incremental`, we reuse the hashes from the existing manifest for files that did not change.
+  """
+  previous, previous_mtimes, previous_mtime_ns = load_outputs_manifest(output_directory) if incremental else (None, {}, None)
+  mtimes: Dict[str, int] = {}
+  manifest = outputs_manifest(output_directory, config, compute_hashes, previous, previous_mtimes, previous_mtime_ns, mtimes=mtimes)
   with (output_directory / 'manifest.outputs.json').open('w') as f:
     json.dump(manifest, f, sort_keys=True, indent=2)
+  try:
+    with (output_directory / manifest_mtimes_name).open('w') as f:
+      json.dump(mtimes, f)
+  except OSError: # it only makes the next update faster
+    pass
   return manifest
 
 
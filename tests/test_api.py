@@ -0,0 +1,113 @@
+import unittest
+from unittest import mock
+
+import requests
+
+
+def response(status_code, content=b'{}'):
+  r = requests.Response()
+  r.status_code = status_code
+  r._content = content
+  return r
+
+
+class TestApi(unittest.TestCase):
+  def test_notify_outputs_chunks(self):
+    from qaboard import api
+    calls = []
+    def post(url, data, raise_not_found=False):
+      calls.append(data['outputs'])
+      return [{"id": o['input_path']} for o in data['outputs']]
+    outputs = [{"input_path": str(index)} for index in range(5)]
+    with mock.patch.object(api, 'notify_chunk_size', 2), mock.patch.object(api, 'post_to_qa_database', post):
+      db_outputs = api.notify_qa_database_outputs(outputs, share=True, offline=False)
+    self.assertEqual([len(c) for c in calls], [2, 2, 1])
+    self.assertEqual([o['id'] for o in db_outputs], ['0', '1', '2', '3', '4'])
+
+  def test_notify_outputs_old_servers(self):
+    from qaboard import api
+    def post(url, data, raise_not_found=False):
+      raise NotImplementedError(url)
+    notified = []
+    with mock.patch.object(api, 'post_to_qa_database', post), mock.patch.object(api, 'notify_qa_database', lambda **kwargs: notified.append(kwargs) or {"id": 1}):
+      db_outputs = api.notify_qa_database_outputs([{"input_path": "a"}, {"input_path": "b"}], share=True, offline=False)
+    self.assertEqual(len(notified), 2)
+    self.assertEqual(db_outputs, [{"id": 1}, {"id": 1}])
+
+  def test_notify_outputs_unknown_commit(self):
+    from qaboard import api
+    session = mock.Mock()
+    session.post.return_value = response(422, b'{"error": "Could not find your commit", "commit_not_found": true}')
+    with mock.patch.object(api, 'api_session', lambda: session), mock.patch.object(api, 'notify_qa_database') as notify:
+      db_outputs = api.notify_qa_database_outputs([{"input_path": "a"}, {"input_path": "b"}], share=True, offline=False)
+    # we don't retry output by output
+    notify.assert_not_called()
+    self.assertEqual(session.post.call_count, 1)
+    self.assertEqual(db_outputs, [None, None])
+
+  def test_post_retries(self):
+    from qaboard import api
+    session = mock.Mock()
+    session.post.side_effect = [requests.exceptions.ConnectionError(), response(500), response(200, b'{"id": 1}')]
+    with mock.patch.object(api, 'api_session', lambda: session), mock.patch('time.sleep'):
+      self.assertEqual(api.post_to_qa_database('http://qaboard/api/v1/output/', {}, retries=2), {"id": 1})
+    self.assertEqual(session.post.call_count, 3)
+    # client errors are not retried
+    session = mock.Mock()
+    session.post.return_value = response(400)
+    with mock.patch.object(api, 'api_session', lambda: session), mock.patch('time.sleep'):
+      self.assertIsNone(api.post_to_qa_database('http://qaboard/api/v1/output/', {}, retries=2))
+    self.assertEqual(session.post.call_count, 1)
+
+  def test_flush_notifications(self):
+    import threading
+    from qaboard import api
+    sent = threading.Event()
+    release = threading.Event()
+    def post(url, data, **kwargs):
+      sent.set()
+      release.wait(10)
+    with mock.patch.object(api, 'post_to_qa_database', post):
+      api._notifications_queue().put(('http://qaboard/api/v1/output/', {}))
+      sent.wait(10)
+      # we don't wait forever for QA-Board
+      self.assertFalse(api.flush_notifications(timeout=0.1))
+      release.set()
+      self.assertTrue(api.flush_notifications())
+
+  def test_session_per_thread(self):
+    import threading
+    from qaboard import api
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(api.api_session()))
+    thread.start()
+    thread.join()
+    self.assertIs(api.api_session(), api.api_session())
+    self.assertIsNot(api.api_session(), sessions[0])
+
+  def test_wait_for_outputs(self):
+    from qaboard import api
+    session = mock.Mock()
+    session.post.side_effect = [
+      # the server is busy
+      response(200, b'{"outputs": {}, "done": false, "retry_after": 10}'),
+      response(200, b'{"outputs": {"1": {"is_pending": false, "is_failed": false}}, "done": true}'),
+    ]
+    ids = list(range(1, 5000))
+    with mock.patch.object(api, 'api_session', lambda: session), mock.patch('time.sleep') as sleep:
+      self.assertEqual(api.wait_for_outputs(ids), {"1": {"is_pending": False, "is_failed": False}})
+    sleep.assert_called_once_with(10)
+    # many IDs don't fit in a URL
+    self.assertEqual(session.post.call_args[1]['json']['ids'], ids)
+
+  def test_wait_for_outputs_old_servers(self):
+    from qaboard import api
+    session = mock.Mock()
+    session.post.return_value = response(405)
+    with mock.patch.object(api, 'api_session', lambda: session), mock.patch.object(api, 'get_output', lambda id: {"is_pending": False, "is_failed": False}):
+      self.assertEqual(set(api.wait_for_outputs([1, 2])), {"1", "2"})
+    self.assertEqual(session.post.call_count, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
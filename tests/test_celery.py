@@ -0,0 +1,148 @@
+"""
+Tests the Celery runner with a mocked app, without a broker or workers.
+"""
+import os
+import tempfile
+import unittest
+import importlib.util
+from pathlib import Path
+from unittest import mock
+
+
+@unittest.skipUnless(importlib.util.find_spec('celery'), "celery is not installed")
+class TestCeleryRunner(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.tmp = Path(self.tmp_dir.name)
+    self.job_options = {"type": "celery", "command_id": "12345678-abcd", "cwd": str(self.tmp), "qaboard_envs_dir": str(self.tmp / 'envs')}
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def make_jobs(self, count, **options):
+    from qaboard.run import RunContext
+    from qaboard.runners.job import Job
+    return [Job(RunContext(
+      type='slam',
+      input_path=Path(f'input-{index}'),
+      database=Path(),
+      platform='linux',
+      configurations=[],
+      job_options={**self.job_options, **options},
+      output_dir=self.tmp / 'output' / f'run-{index}',
+      command=f"echo {index}",
+    )) for index in range(count)]
+
+  def start_jobs(self, jobs, result, backend=None, **options):
+    """Starts the jobs with a mocked app and task, and returns the signatures sent, and the signal handler."""
+    from qaboard.runners.celery import CeleryRunner
+    from qaboard.runners import celery_app
+    signatures = []
+    def make_group(tasks):
+      signatures.extend(tasks)
+      return mock.MagicMock(return_value=result)
+    with mock.patch.object(celery_app, 'app') as app, \
+         mock.patch.object(celery_app, 'start') as start, \
+         mock.patch('celery.group', side_effect=make_group), \
+         mock.patch('signal.signal') as signal:
+      if backend:
+        app.backend = backend
+      start.s.side_effect = lambda **kwargs: mock.MagicMock(kwargs=kwargs)
+      CeleryRunner.start_jobs(jobs, {**self.job_options, **options}, blocking=True)
+    handler = signal.call_args[0][1]
+    return [(s.kwargs, s.set.call_args[1]['task_id']) for s in signatures], handler
+
+  def test_task_signature(self):
+    from qaboard.runners.celery import decode_env
+    from qaboard.runners import celery_app
+    result = mock.MagicMock(supports_native_join=True)
+    jobs = [*self.make_jobs(1), *self.make_jobs(1, env={"QA_TEST_VARIABLE": 1})]
+    signatures, _ = self.start_jobs(jobs, result)
+    self.assertEqual([id for _, id in signatures], ['12345678-abcd-0', '12345678-abcd-1'])
+    # tasks don't carry the environment, only a reference to the batch's...
+    kwargs = [k for k, _ in signatures]
+    self.assertEqual(set(kwargs[0]), {'command', 'cwd', 'env_path'})
+    self.assertEqual(kwargs[0]['command'], 'echo 0')
+    self.assertEqual(kwargs[0]['env_path'], kwargs[1]['env_path'])
+    env = decode_env(Path(kwargs[0]['env_path']).read_text())
+    self.assertEqual(env['PATH'], os.environ['PATH'])
+    # ...and how theirs differs
+    self.assertEqual(kwargs[1]['env_diff'], {"QA_TEST_VARIABLE": "1"})
+
+    # workers start runs in the right environment
+    environ = dict(os.environ)
+    # runs don't get the workers' environment
+    os.environ['QA_TEST_WORKER_ONLY'] = 'worker'
+    try:
+      command = 'test "$QA_TEST_VARIABLE" = "1" && test -z "$QA_TEST_WORKER_ONLY"'
+      self.assertEqual(celery_app.start(command=command, cwd=str(self.tmp), env_path=kwargs[1]['env_path'], env_diff=kwargs[1]['env_diff']), 0)
+      self.assertNotEqual(celery_app.start(command=command, cwd=str(self.tmp), env_path=kwargs[0]['env_path']), 0)
+    finally:
+      os.environ.clear()
+      os.environ.update(environ)
+
+  def test_env_in_result_backend(self):
+    from celery.backends.base import KeyValueStoreBackend
+    result = mock.MagicMock(supports_native_join=True)
+    backend = mock.MagicMock(spec=KeyValueStoreBackend)
+    backend.get_key_for_task.side_effect = lambda key: f'celery-task-meta-{key}'
+    signatures, _ = self.start_jobs(self.make_jobs(2), result, backend=backend, qaboard_env_expires=60)
+    key = signatures[0][0]['env_key']
+    self.assertTrue(all(kwargs['env_key'] == key for kwargs, _ in signatures))
+    # the environment is stored once, and expires
+    backend.set.assert_called_once()
+    backend.expire.assert_called_once_with(f'celery-task-meta-{key}', 60)
+    self.assertFalse((self.tmp / 'envs').exists())
+
+  def test_envs_dir_required(self):
+    result = mock.MagicMock(supports_native_join=True)
+    # the result backend can't store the environment, and we don't know where to save it
+    self.job_options.pop('qaboard_envs_dir')
+    with self.assertRaises(ValueError):
+      self.start_jobs(self.make_jobs(1), result)
+    self.assertFalse(any(self.tmp.rglob('*.env')))
+
+  def test_join_native(self):
+    result = mock.MagicMock(supports_native_join=True)
+    result.join_native.side_effect = lambda callback, propagate: [callback(f'12345678-abcd-{index}', index) for index in range(2)]
+    done = []
+    jobs = self.make_jobs(2)
+    self.start_jobs(jobs, result, on_job_done=lambda job, is_failed: done.append((job, is_failed)))
+    self.assertEqual(done, [(jobs[0], False), (jobs[1], True)])
+
+  def test_polling(self):
+    task_results = [mock.MagicMock(**{'ready.return_value': True, 'successful.return_value': successful, 'result': 0}) for successful in (True, False)]
+    result = mock.MagicMock(supports_native_join=False, results=task_results)
+    done = []
+    jobs = self.make_jobs(2)
+    self.start_jobs(jobs, result, on_job_done=lambda job, is_failed: done.append((job, is_failed)))
+    self.assertEqual(done, [(jobs[0], False), (jobs[1], True)])
+
+  def test_revoke(self):
+    from qaboard.runners.celery import CeleryRunner
+    from qaboard.runners import celery_app
+    result = mock.MagicMock(supports_native_join=True)
+    jobs = self.make_jobs(2)
+    _, handler = self.start_jobs(jobs, result)
+    # interrupting `qa batch` cancels the runs
+    with self.assertRaises(SystemExit):
+      handler(None, None)
+    result.revoke.assert_called_once_with(terminate=True)
+    with mock.patch.object(celery_app, 'app') as app:
+      CeleryRunner.stop_jobs(jobs, self.job_options)
+    app.control.revoke.assert_called_once_with(['12345678-abcd-0', '12345678-abcd-1'], terminate=True)
+
+
+class TestEnvDiff(unittest.TestCase):
+  def test_env_diff(self):
+    from qaboard.runners.celery import env_diff, apply_env_diff
+    base = {"A": "1", "B": "2", "C": "3"}
+    env = {"A": "1", "B": "changed", "D": "4"}
+    diff = env_diff(base, env)
+    self.assertEqual(diff, {"B": "changed", "C": None, "D": "4"})
+    self.assertEqual(apply_env_diff(base, diff), env)
+    self.assertEqual(env_diff(base, base), {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,4 +1,7 @@
 import os
+import sys
+import re
+import time
 import json
 from pathlib import Path
 
@@ -29,12 +32,16 @@ class TestQaCli(unittest.TestCase):
       "database": {"linux": database, "windows": database} 
       }
     }
+    images['images-packed'] = {**images['images'], "local": {"threads": 2, "memory": 100}}
     # TODO: use a temp file?
     with Path('image.batches.yaml').open('w') as f:
       f.write(yaml.dump(images))
     os.environ['QA_DATABASE'] = database
     os.environ['QA_OFFLINE'] = 'true'
     os.environ['QA_STORAGE'] = str(root_repo.resolve())
+    # qaboard reads the project's configuration when it is imported, maybe by other tests from another directory
+    for module in [m for m in sys.modules if m == 'qaboard' or m.startswith('qaboard.')]:
+      del sys.modules[module]
 
   @classmethod
   def TearDownClass(self):
@@ -81,6 +88,41 @@ class TestQaCli(unittest.TestCase):
     assert '/dev/null =>' in result.output
     assert "'is_failed': False" in result.output
 
+  def test_run_cache(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      tmp = Path(tmp_dir)
+      os.environ['QA_RUN_CACHE'] = str(tmp / 'cache')
+      os.environ['QA_RUN_CACHE_KEY'] = 'v1'
+      try:
+        result = self.qa('run', '-i', 'cli_tests/a.jpg', '-o', str(tmp / 'first'), 'echo "{input_path}" > result.txt')
+        assert result.exit_code == 0
+        result = self.qa('run', '-i', 'cli_tests/a.jpg', '-o', str(tmp / 'second'), 'echo "{input_path}" > result.txt')
+        assert result.exit_code == 0
+        assert 'Results from the run cache' in result.stderr
+        self.assertEqual((tmp / 'first' / 'result.txt').stat().st_ino, (tmp / 'second' / 'result.txt').stat().st_ino)
+        self.assertFalse(json.loads((tmp / 'second' / 'metrics.json').read_text())['is_failed'])
+        self.assertEqual((tmp / 'first' / 'manifest.inputs.json').read_text(), (tmp / 'second' / 'manifest.inputs.json').read_text())
+        # cache hits don't update the cache
+        entries = list((tmp / 'cache').rglob('*.json'))
+        self.assertEqual(len(entries), 1)
+        self.assertIn(str(tmp / 'first'), entries[0].read_text())
+        # other artifacts give other results
+        os.environ['QA_RUN_CACHE_KEY'] = 'v2'
+        result = self.qa('run', '-i', 'cli_tests/a.jpg', '-o', str(tmp / 'third'), 'echo "{input_path}" > result.txt')
+        assert 'Results from the run cache' not in result.stderr
+        # `qa batch` gives runs the artifacts' hash
+        from qaboard.config import config
+        from qaboard.run_cache import RunCache
+        os.environ['QA_RUN_CACHE_ARTIFACTS_HASH'] = RunCache.hash_artifacts(config)
+        os.environ['QA_RUN_CACHE_KEY'] = 'v3'
+        result = self.qa('run', '-i', 'cli_tests/a.jpg', '-o', str(tmp / 'fourth'), 'echo "{input_path}" > result.txt')
+        assert 'Results from the run cache' in result.stderr
+      finally:
+        del os.environ['QA_RUN_CACHE']
+        del os.environ['QA_RUN_CACHE_KEY']
+        os.environ.pop('QA_RUN_CACHE_ARTIFACTS_HASH', None)
+
   def test_get(self):
     result = self.qa('get', 'commit_id')
     assert result.exit_code == 0
@@ -121,6 +163,155 @@ class TestQaCli(unittest.TestCase):
     assert result.exit_code == 0
 
 
+  def test_runner_local_warm(self):
+    # runs are done in-process by worker processes
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--runner=local', '--local-warm', '--local-concurrency=2')
+    assert result.exit_code == 0
+    # commands that are not "qa ..." are started as usual
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--runner=local', '--local-warm', 'echo "{input_path} => {output_dir}"')
+    assert result.exit_code == 0
+
+  def test_runner_local_resources(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      # where the state of batches running in the background is saved
+      os.environ['QA_CACHE_DIR'] = tmp_dir
+      try:
+        # runs that declare their cost are packed on the host
+        result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images-packed', '--runner=local', '--local-threads=4', 'echo "{input_path} => {output_dir}"')
+        assert result.exit_code == 0
+        # they can run in the background
+        result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images-packed', '--runner=local', '--no-wait', 'echo "{input_path} => {output_dir}"')
+        assert result.exit_code == 0
+        command_id = re.search(r'qa wait --command-id ([\w-]+)', result.stderr).group(1)
+        result = self.qa('wait', '--command-id', command_id)
+        assert result.exit_code == 0
+        assert Path(tmp_dir, 'local-batches', f'{command_id}.json').exists()
+      finally:
+        del os.environ['QA_CACHE_DIR']
+
+  def test_runner_local_fail_fast(self):
+    # runs are done one after the other, we stop after the first failure
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--fail-fast', '--runner=local', 'exit 1')
+    assert result.exit_code != 0
+    assert 'Cancelled 2 runs' in result.stderr
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--max-failures=2', '--runner=local', 'exit 1')
+    assert 'Cancelled 1 runs' in result.stderr
+
+  def test_local_scheduler(self):
+    from qaboard.runners.local_scheduler import LocalScheduler
+    jobs = [
+      {"command": "exit 0", "cwd": ".", "threads": 3, "memory": 0, "status": "pending", "returncode": None},
+      {"command": "exit 1", "cwd": ".", "threads": 2, "memory": 0, "status": "pending", "returncode": None},
+      {"command": "exit 0", "cwd": ".", "threads": 1, "memory": 0, "status": "pending", "returncode": None},
+    ]
+    scheduler = LocalScheduler({"threads": 4, "memory": 0, "max_jobs": 0, "jobs": jobs})
+    # the 2nd run waits, the 3rd uses the free thread
+    scheduler.start(0)
+    self.assertFalse(scheduler.fits(jobs[1]))
+    self.assertTrue(scheduler.fits(jobs[2]))
+    scheduler.running[0].wait()
+    self.assertEqual(scheduler.run(), 1)
+    self.assertEqual([j['status'] for j in jobs], ['done', 'done', 'done'])
+
+    # runs can be stopped
+    jobs = [
+      {"command": "sleep 1 && exit 1", "cwd": ".", "threads": 1, "memory": 0, "status": "pending", "returncode": None},
+      {"command": "sleep 60", "cwd": ".", "threads": 1, "memory": 0, "status": "pending", "returncode": None},
+      {"command": "exit 0", "cwd": ".", "threads": 2, "memory": 0, "status": "pending", "returncode": None},
+    ]
+    scheduler = LocalScheduler({"threads": 2, "memory": 0, "max_jobs": 0, "jobs": jobs}, on_done=lambda index, returncode: scheduler.stop())
+    start = time.time()
+    self.assertEqual(scheduler.run(), 3)
+    self.assertLess(time.time() - start, 30)
+    self.assertEqual([j['status'] for j in jobs], ['done', 'cancelled', 'cancelled'])
+
+  def test_batch_order(self):
+    from qaboard.runners.ordering import longest_first, makespan
+    jobs, durations = longest_first(['a', 'b', 'c', 'd'], [1, None, 10, 3])
+    self.assertEqual(jobs, ['c', 'b', 'd', 'a'])
+    self.assertEqual(durations, [10, 3, 3, 1])
+    self.assertEqual(makespan([10, 3, 3, 1], slots=2), 10)
+    self.assertEqual(makespan([1, 3, 3, 10], slots=2), 13)
+    # we know how long runs took from their metrics
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--runner=local', 'echo "{input_path} => {output_dir}"')
+    assert result.exit_code == 0
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--order=longest-first', '--list')
+    assert result.exit_code == 0
+    assert '3/3 runs took' in result.stderr
+    assert len(json.loads(result.stdout)) == 3
+
+  def test_batch_shard(self):
+    runs = []
+    for shard in ('1/2', '2/2'):
+      result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', f'--shard={shard}', '--list')
+      assert result.exit_code == 0
+      runs.append([r['output_dir'] for r in json.loads(result.stdout)])
+    # shards split all the runs
+    self.assertEqual(sorted(runs[0] + runs[1]), sorted(set(runs[0] + runs[1])))
+    self.assertEqual(len(runs[0] + runs[1]), 3)
+    for shard in ('1/2', '2/2'):
+      result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', f'--shard={shard}', '--runner=local', 'echo "{input_path} => {output_dir}"')
+      assert result.exit_code == 0
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--shard-merge')
+    assert result.exit_code == 0
+    result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--shard=3/2', '--list')
+    assert result.exit_code != 0
+
+  def test_batch_shard_cost(self):
+    from qaboard.run import RunContext
+    from qaboard.runners.sharding import Shard
+    outputs = [{
+      "is_pending": False,
+      "test_input_database": "/reference/database",
+      "test_input_path": f"input-{index}",
+      "platform": "linux",
+      "configurations": [],
+      "extra_parameters": {},
+      "output_type": "slam",
+      "output_dir_url": f"/outputs/input-{index}",
+      "metrics": {"compute_time": compute_time},
+    } for index, compute_time in enumerate([10, 1, 1])]
+    shards = [Shard(index=index, count=2) for index in (1, 2)]
+    for shard in shards:
+      shard.balance(outputs)
+    # shards don't need the database at the same location as the reference runs
+    database = Path('/shard/database')
+    runs = [RunContext(type='slam', input_path=database / f'input-{index}', database=database, platform='linux', configurations=[], output_dir=Path(f'output-{index}')) for index in range(3)]
+    self.assertEqual([shards[0].includes(run) for run in runs], [True, False, False])
+    self.assertEqual([shards[1].includes(run) for run in runs], [False, True, True])
+
+  def test_batch_journal(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      os.environ['QA_CACHE_DIR'] = tmp_dir
+      try:
+        result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--runner=local', 'echo "{input_path} => {output_dir}"')
+        assert result.exit_code == 0
+        journal_path = next(Path(tmp_dir, 'batch-journals').iterdir())
+        statuses = [json.loads(line) for line in journal_path.read_text().splitlines()]
+        self.assertEqual({s['status'] for s in statuses[:3]}, {'planned'})
+        self.assertEqual({s['status'] for s in statuses[3:]}, {'done'})
+        # the batch was interrupted before a run finished
+        output_dir = statuses[0]['output_dir']
+        with journal_path.open('a') as f:
+          print(json.dumps({"output_dir": output_dir, "status": "planned"}), file=f)
+        (Path(output_dir) / 'metrics.json').unlink()
+        result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--runner=local', '--action-on-existing=skip', 'echo "{input_path} => {output_dir}"')
+        assert result.exit_code == 0
+        self.assertEqual(result.stderr.count(' run --input'), 1)
+        assert output_dir in result.stderr
+      finally:
+        del os.environ['QA_CACHE_DIR']
+
+  def test_qa_cli_args(self):
+    from qaboard.runners.local import qa_cli_args
+    self.assertEqual(qa_cli_args("cd sub && qa --share run -i 'a b.jpg'"), ('sub', ['--share', 'run', '-i', 'a b.jpg']))
+    self.assertEqual(qa_cli_args("qa run -i a.jpg"), ('.', ['run', '-i', 'a.jpg']))
+    self.assertIsNone(qa_cli_args("qa wait --output-id 1 || qa run -i a.jpg"))
+    self.assertIsNone(qa_cli_args("echo qa run"))
+
+
   @unittest.skip("Not tested in the OSS version yet")
   def test_runner_lsf(self):
     result = self.qa('batch', '--batches-file', 'image.batches.yaml', 'images', '--runner=lsf', 'echo "{input_path} => {output_dir}"')
@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 from pathlib import Path
 
@@ -35,6 +36,9 @@ class TestQaCliSubproject(unittest.TestCase):
     os.environ['QA_DATABASE'] = database
     os.environ['QA_OFFLINE'] = 'true'
     os.environ['QA_STORAGE'] = str(root_repo.resolve())
+    # qaboard reads the project's configuration when it is imported, maybe by other tests from another directory
+    for module in [m for m in sys.modules if m == 'qaboard' or m.startswith('qaboard.')]:
+      del sys.modules[module]
 
   @classmethod
   def TearDownClass(self):
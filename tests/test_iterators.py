@@ -2,6 +2,7 @@
 TODO: Write more tests.
 https://docs.python.org/3/library/unittest.html
 """
+import os
 import unittest
 from pathlib import Path
 import yaml
@@ -208,6 +209,62 @@ class TestIterators(unittest.TestCase):
     batches = get_batch('matrix-interpolate-2')
     self.assertEqual(len(batches), 4)
 
+  def test_iter_inputs_with_index(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as index_dir:
+      os.environ['QA_INPUTS_INDEX'] = index_dir
+      try:
+        self.test_iter_inputs()
+        self.test_iter_inputs() # warm index
+      finally:
+        del os.environ['QA_INPUTS_INDEX']
+
+  def test_inputs_index(self):
+    import tempfile
+    from qaboard.inputs_index import InputsIndex
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      database = Path(tmp_dir) / 'database'
+      for path in ['a/x.jpg', 'a/b/y.jpg', 'a/b/c/z.jpg', 'a/b/c/z.txt', 'd/x.jpg']:
+        (database / path).parent.mkdir(parents=True, exist_ok=True)
+        (database / path).write_text(path)
+      for path in [database, *database.rglob('*')]:
+        if path.is_dir():
+          os.utime(path, ns=(0, 0))
+      index_dir = Path(tmp_dir) / 'index'
+      patterns = [('glob', '*'), ('glob', 'a/*'), ('glob', 'a/b'), ('glob', 'a/**/*.txt'), ('glob', '*/x.jpg'), ('rglob', '*.jpg'), ('rglob', 'c/*')]
+      for _ in range(2): # once to index, once using the index
+        index = InputsIndex.for_database(database, {"inputs": {"index": str(index_dir)}})
+        for method, pattern in patterns:
+          self.assertEqual(set(getattr(index, method)(database, pattern)), set(getattr(database, method)(pattern)), pattern)
+        index.close()
+      self.assertEqual(index.stats()['misses'], 0)
+      # directories that changed are listed again
+      (database / 'a' / 'b' / 'new.jpg').write_text('new')
+      index = InputsIndex.for_database(database, {"inputs": {"index": str(index_dir)}})
+      self.assertIn(database / 'a' / 'b' / 'new.jpg', set(index.rglob(database, '*.jpg')))
+      self.assertEqual(index.stats()['misses'], 1)
+      index.close()
+
+  @unittest.skipIf(os.name == 'nt', "needs symlinks")
+  def test_inputs_index_symlinks(self):
+    import tempfile
+    from qaboard.inputs_index import InputsIndex
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      database = Path(tmp_dir) / 'database'
+      (database / 'a' / 'b').mkdir(parents=True)
+      (database / 'a' / 'b' / 'x.jpg').write_text('x')
+      (database / 'a' / 'loop').symlink_to(database)
+      (database / 'linked').symlink_to(database / 'a')
+      (database / 'linked.jpg').symlink_to(database / 'a' / 'b' / 'x.jpg')
+      index_dir = Path(tmp_dir) / 'index'
+      patterns = [('glob', '*'), ('glob', '*/b/*.jpg'), ('rglob', '*.jpg'), ('rglob', '*')]
+      for _ in range(2): # once to index, once using the index
+        index = InputsIndex.for_database(database, {"inputs": {"index": str(index_dir)}})
+        for method, pattern in patterns:
+          # like pathlib, "**" does not follow symbolic links to directories
+          self.assertEqual(set(getattr(index, method)(database, pattern)), set(getattr(database, method)(pattern)), pattern)
+        index.close()
+
 
 
 sample_batches_yaml = """
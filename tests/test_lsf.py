@@ -0,0 +1,134 @@
+"""
+Tests the LSF runner with a fake `bsub` that runs jobs locally.
+"""
+import os
+import sys
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+
+
+# Runs the script from stdin, for each element of job arrays, and saves their status for bjobs
+fake_bsub = f"""#!{sys.executable}
+import os, re, sys, subprocess
+args = sys.argv[1:]
+name = args[args.index('-J') + 1]
+log_file = args[args.index('-o') + 1] if '-o' in args else None
+script = sys.stdin.read()
+with open(os.environ['FAKE_BSUB_CALLS'], 'a') as f:
+  print(name, file=f)
+with open(os.environ['FAKE_BSUB_CALLS']) as f:
+  job_id = 100 + len(f.readlines())
+array = re.match(r'.*\\[(\\d+)-(\\d+)\\]$', name)
+for index in range(int(array[1]), int(array[2]) + 1) if array else [0]:
+  if log_file: os.makedirs(os.path.dirname(log_file), exist_ok=True)
+  log = open(log_file.replace('%I', str(index)), 'w') if log_file else None
+  process = subprocess.run(script, shell=True, env={{**os.environ, 'LSB_JOBINDEX': str(index)}}, stdout=log, stderr=subprocess.STDOUT)
+  with open(os.environ['FAKE_BJOBS_STATUSES'], 'a') as f:
+    print(job_id, index, 'DONE' if not process.returncode else 'EXIT', process.returncode or '-', sep='|', file=f)
+print(f'Job <{{job_id}}> is submitted to queue <normal>.')
+"""
+
+# Prints the statuses of the jobs given as arguments
+fake_bjobs = f"""#!{sys.executable}
+import os, sys
+job_ids = [a for a in sys.argv[1:] if a.isdigit()]
+with open(os.environ['FAKE_BJOBS_STATUSES']) as f:
+  for line in f:
+    if line.split('|')[0] in job_ids:
+      print(line, end='')
+"""
+
+
+class TestLsfRunner(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.tmp = Path(self.tmp_dir.name)
+    bin_dir = self.tmp / 'bin'
+    bin_dir.mkdir()
+    for name, script in [('bsub', fake_bsub), ('bjobs', fake_bjobs)]:
+      path = bin_dir / name
+      path.write_text(script)
+      path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    self.calls = self.tmp / 'calls.txt'
+    self.environ = dict(os.environ)
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ['FAKE_BSUB_CALLS'] = str(self.calls)
+    os.environ['FAKE_BJOBS_STATUSES'] = str(self.tmp / 'statuses.txt')
+    # where the job arrays' commands are saved
+    os.environ['QA_CACHE_DIR'] = str(self.tmp / 'cache')
+
+  def tearDown(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+    self.tmp_dir.cleanup()
+
+  def make_jobs(self, job_options, count, name='run', **options):
+    from qaboard.run import RunContext
+    from qaboard.runners.job import Job
+    jobs = []
+    for index in range(count):
+      run_context = RunContext(
+        type='slam',
+        input_path=Path(f'input-{index}'),
+        database=Path(),
+        platform='linux',
+        configurations=[],
+        job_options={**job_options, **options},
+        output_dir=self.tmp / 'output' / f'{name}-{index}',
+        command=f"echo '{name} {index}' > '{self.tmp}/done-{name}-{index}.txt'; echo 'log {index}'",
+      )
+      jobs.append(Job(run_context))
+    return jobs
+
+  def test_job_arrays(self):
+    from qaboard.runners.lsf import LsfRunner
+    job_options = {"type": "lsf", "command_id": "12345678-abcd", "project": "test", "arrays": True, "chunk_size": 2}
+    # jobs with different LSF options are sent in different arrays
+    jobs = [*self.make_jobs(job_options, 5), *self.make_jobs(job_options, 1, name='big', max_memory=1000)]
+    done = []
+    LsfRunner.start_jobs(jobs, {**job_options, "on_job_done": lambda job, is_failed: done.append(job)}, blocking=True)
+
+    calls = self.calls.read_text().splitlines()
+    # two arrays
+    self.assertEqual(len(calls), 2)
+    self.assertTrue(calls[0].startswith('12345678_') and calls[0].endswith('[1-3]'))
+    self.assertTrue(calls[1].endswith('[1-1]'))
+    # we know when each job finished
+    self.assertEqual(len(done), 6)
+    for index in range(5):
+      self.assertEqual((self.tmp / f'done-run-{index}.txt').read_text().strip(), f'run {index}')
+      # each run keeps its own logs
+      self.assertEqual((self.tmp / 'output' / f'run-{index}' / 'log.lsf.txt').read_text().strip(), f'log {index}')
+    self.assertTrue((self.tmp / 'done-big-0.txt').exists())
+    # the commands are removed once the jobs are done
+    self.assertEqual(list((self.tmp / 'cache' / 'lsf-arrays').iterdir()), [])
+
+  def test_no_job_arrays(self):
+    from qaboard.runners.lsf import LsfRunner
+    job_options = {"type": "lsf", "command_id": "12345678-abcd", "project": "test"}
+    jobs = self.make_jobs(job_options, 2)
+    LsfRunner.start_jobs(jobs, job_options, blocking=True)
+    calls = self.calls.read_text().splitlines()
+    self.assertEqual(len(calls), 2)
+    self.assertNotIn('[', calls[0])
+    for index in range(2):
+      self.assertTrue((self.tmp / f'done-run-{index}.txt').exists())
+
+  def test_tracking(self):
+    from qaboard.runners.lsf import LsfRunner
+    job_options = {"type": "lsf", "command_id": "12345678-abcd", "project": "test"}
+    jobs = self.make_jobs(job_options, 2)
+    jobs[1].runner.command = 'exit 1'
+    done = {}
+    LsfRunner.start_jobs(jobs, {**job_options, "on_job_done": lambda job, is_failed: done.update({job.run_context.output_dir.name: is_failed})}, blocking=True)
+    self.assertEqual(done, {'run-0': False, 'run-1': True})
+    # we can still wait for all jobs with a job that depends on the others
+    self.calls.unlink()
+    LsfRunner.start_jobs(jobs, {**job_options, "tracking": "wait"}, blocking=True)
+    self.assertEqual(self.calls.read_text().splitlines()[-1], '12345678_WAIT')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,50 @@
+import time
+import threading
+import unittest
+
+try:
+  import skopt
+except ImportError:
+  skopt = None
+
+
+@unittest.skipIf(skopt is None, "needs scikit-optimize")
+class TestOptimize(unittest.TestCase):
+  def test_ask_with_pending(self):
+    from skopt import Optimizer
+    from qaboard.optimize import ask_with_pending
+    optimizer = Optimizer([(-2.0, 2.0)], n_initial_points=2, random_state=1)
+    optimizer.tell([[-1.0], [1.5]], [4.0, 0.25])
+    pending = [optimizer.ask()]
+    # we don't suggest again the point that is being evaluated
+    self.assertNotEqual(ask_with_pending(optimizer, pending), pending[0])
+    # the optimizer only knows about real results
+    self.assertEqual(len(optimizer.yi), 2)
+
+  def test_optimize_async(self):
+    from skopt import Optimizer
+    from qaboard.optimize import optimize_async
+    optimizer = Optimizer([(-2.0, 2.0)], n_initial_points=3, random_state=1)
+    lock = threading.Lock()
+    running, max_running = [0], [0]
+    def objective(params):
+      x, iteration = params
+      with lock:
+        running[0] += 1
+        max_running[0] = max(max_running[0], running[0])
+      # some evaluations are much slower
+      time.sleep(0.2 if iteration == 0 else 0.01)
+      with lock:
+        running[0] -= 1
+      return (x - 1) ** 2
+    reported = []
+    results = optimize_async(objective, optimizer, {"evaluations": 8}, 3, lambda iteration, x, y, results: reported.append(iteration))
+    self.assertEqual(sorted(reported), list(range(8)))
+    # other evaluations finished while the slow one was running
+    self.assertNotEqual(reported[0], 0)
+    self.assertEqual(max_running[0], 3)
+    self.assertEqual(len(results.func_vals), 8)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,93 @@
+"""
+Guards against regressions in the startup time of the CLI.
+`qa batch` starts one `qa run` process per input, so every millisecond spent importing counts.
+"""
+import os
+import sys
+import json
+import subprocess
+import unittest
+from pathlib import Path
+
+
+sample_project = Path(__file__).resolve().parent.parent / 'qaboard/sample_project'
+
+# only loaded by the commands that need them
+heavy_modules = ('requests', 'joblib', 'rich', 'numpy', 'sklearn', 'skopt', 'matplotlib')
+
+
+def python(code, *args):
+  process = subprocess.run(
+    [sys.executable, '-c', code, *args],
+    cwd=sample_project,
+    env={**os.environ, 'QA_OFFLINE': 'true'},
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    encoding='utf-8',
+    check=True,
+  )
+  return process.stdout
+
+
+def loaded_heavy_modules(*args):
+  """Runs the CLI with the given arguments, and returns the heavy modules it imported."""
+  stdout = python(
+    "import sys\n"
+    "from qaboard.qa import main\n"
+    "try:\n"
+    "  main()\n"
+    "except SystemExit:\n"
+    "  pass\n"
+    f"print([m for m in {heavy_modules!r} if m in sys.modules])",
+    *args,
+  )
+  return stdout.strip().split('\n')[-1]
+
+
+class TestStartup(unittest.TestCase):
+  def test_no_heavy_imports(self):
+    stdout = python(
+      "import sys; import qaboard.qa;"
+      f"print([m for m in {heavy_modules!r} if m in sys.modules]);"
+      # details about the commit call git, they are computed lazily
+      "print('commit_message' in vars(sys.modules['qaboard.config']))"
+    )
+    self.assertEqual(stdout.split('\n')[:2], ['[]', 'False'])
+
+  def test_help_imports(self):
+    self.assertEqual(loaded_heavy_modules("--help"), '[]')
+
+  def test_run_imports(self):
+    self.assertEqual(loaded_heavy_modules("run", "--help"), '[]')
+
+  def test_config_snapshot(self):
+    snapshot = python("from qaboard.config import config_snapshot; print(config_snapshot())")
+    snapshot = json.loads(snapshot)
+    # children use the snapshot instead of reading qaboard.yaml
+    snapshot['configs'][-1][0]['project']['description'] = 'from the snapshot'
+    snapshot['commit_details']['commit_message'] = 'from the snapshot'
+    code = "from qaboard.config import config, commit_message; print(config['project'].get('description'), '|', commit_message)"
+    os.environ['QA_CONFIG_SNAPSHOT'] = json.dumps(snapshot)
+    try:
+      stdout = python(code)
+      self.assertEqual(stdout.strip(), 'from the snapshot | from the snapshot')
+      # but only if they would have found the same qaboard.yaml files
+      snapshot['cwds'] = ['/some/other/project']
+      os.environ['QA_CONFIG_SNAPSHOT'] = json.dumps(snapshot)
+      stdout = python(code)
+      self.assertNotIn('from the snapshot', stdout)
+      # ...and only if they were not edited since
+      snapshot = json.loads(os.environ['QA_CONFIG_SNAPSHOT'])
+      snapshot['cwds'] = [str(sample_project)]
+      os.environ['QA_CONFIG_SNAPSHOT'] = json.dumps(snapshot)
+      self.assertIn('from the snapshot', python(code))
+      path = next(iter(snapshot['mtimes']))
+      snapshot['mtimes'][path] -= 1
+      os.environ['QA_CONFIG_SNAPSHOT'] = json.dumps(snapshot)
+      self.assertNotIn('from the snapshot', python(code))
+    finally:
+      del os.environ['QA_CONFIG_SNAPSHOT']
+
+
+if __name__ == '__main__':
+  unittest.main()
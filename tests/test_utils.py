@@ -0,0 +1,302 @@
+"""
+TODO: Write more tests.
+https://docs.python.org/3/library/unittest.html
+"""
+import os
+import json
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+
+class TestManifests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    self.dir = Path(self.tmp_dir.name)
+    (self.dir / 'dir').mkdir()
+    (self.dir / 'a.txt').write_text('hello')
+    (self.dir / 'dir' / 'b.bin').write_bytes(b'\x00' * 3 * 4**10)
+    (self.dir / 'log.txt').write_text('ignored')
+
+  def tearDown(self):
+    self.tmp_dir.cleanup()
+
+  def test_md5_hex(self):
+    from qaboard.utils import md5_hex
+    self.assertEqual(md5_hex(self.dir / 'a.txt'), hashlib.md5(b'hello').hexdigest())
+    self.assertEqual(md5_hex(self.dir / 'a.txt', length=2), hashlib.md5(b'he').hexdigest())
+
+  @unittest.skipIf(os.name == 'nt', "needs symlinks")
+  def test_iter_files_symlinks(self):
+    from qaboard.utils import iter_files
+    (self.dir / 'dir' / 'loop').symlink_to(self.dir, target_is_directory=True)
+    (self.dir / 'link.txt').symlink_to(self.dir / 'a.txt')
+    files = sorted(p.relative_to(self.dir).as_posix() for p, _ in iter_files(self.dir))
+    self.assertEqual(files, ['a.txt', 'dir/b.bin', 'link.txt', 'log.txt'])
+
+  def test_outputs_manifest(self):
+    from qaboard.utils import outputs_manifest
+    with mock.patch.dict(os.environ, {'QA_MANIFEST_WORKERS': '4'}):
+      manifest = outputs_manifest(self.dir, config={})
+    self.assertEqual(set(manifest.keys()), {'a.txt', 'dir/b.bin'})
+    self.assertEqual(manifest['a.txt']['st_size'], 5)
+    self.assertEqual(manifest['a.txt']['md5'], hashlib.md5(b'hello').hexdigest())
+    # the manifest's format doesn't change, we don't store mtimes
+    self.assertEqual(set(manifest['a.txt'].keys()), {'st_size', 'md5'})
+    self.assertEqual(manifest['dir/b.bin']['st_size'], 3 * 4**10)
+    with mock.patch.dict(os.environ, {'QA_MANIFEST_WORKERS': '1'}):
+      self.assertEqual(outputs_manifest(self.dir, config={}), manifest)
+    self.assertNotIn('md5', outputs_manifest(self.dir, config={}, compute_hashes=False)['a.txt'])
+
+  def test_incremental_manifest(self):
+    from qaboard.utils import save_outputs_manifest, outputs_manifest, load_outputs_manifest
+    for path in [self.dir / 'a.txt', self.dir / 'dir' / 'b.bin']:
+      os.utime(path, ns=(0, 0)) # before the manifest was written
+    manifest = save_outputs_manifest(self.dir, config={})
+    _, mtimes, _ = load_outputs_manifest(self.dir)
+    self.assertEqual(mtimes['dir/b.bin'], 0)
+    # we pretend a file changed without rehashing it: its hash is reused as long as size and mtime are the same
+    manifest['dir/b.bin']['md5'] = 'unchanged'
+    self.assertEqual(outputs_manifest(self.dir, config={}, previous=manifest, previous_mtimes=mtimes)['dir/b.bin']['md5'], 'unchanged')
+    self.assertNotEqual(outputs_manifest(self.dir, config={}, previous=manifest)['dir/b.bin']['md5'], 'unchanged')
+    (self.dir / 'a.txt').write_text('hello world')
+    (self.dir / 'dir' / 'c.txt').write_text('new')
+    (self.dir / 'manifest.outputs.json').write_text(json.dumps({**manifest, 'removed.txt': {'st_size': 0}}))
+    manifest = save_outputs_manifest(self.dir, config={}, incremental=True)
+    # the manifest doesn't list itself
+    self.assertEqual(set(manifest.keys()), {'a.txt', 'dir/b.bin', 'dir/c.txt'})
+    self.assertEqual(json.loads((self.dir / 'manifest.outputs.json').read_text()), manifest)
+    self.assertEqual(manifest['a.txt']['md5'], hashlib.md5(b'hello world').hexdigest())
+    self.assertEqual(manifest['dir/b.bin']['md5'], 'unchanged')
+    # files modified after the manifest was written are always hashed again
+    os.utime(self.dir / 'dir' / 'b.bin')
+    mtimes = {'dir/b.bin': (self.dir / 'dir' / 'b.bin').stat().st_mtime_ns}
+    manifest = outputs_manifest(self.dir, config={}, previous=manifest, previous_mtimes=mtimes, previous_mtime_ns=0)
+    self.assertEqual(manifest['dir/b.bin']['md5'], hashlib.md5(b'\x00' * 3 * 4**10).hexdigest())
+
+  def test_hash_algorithm(self):
+    from qaboard.utils import outputs_manifest, hash_hex
+    big = self.dir / 'dir' / 'b.bin'
+    self.assertEqual(hash_hex(big, 'blake2b'), hashlib.blake2b(big.read_bytes()).hexdigest())
+    empty = self.dir / 'empty'
+    empty.write_bytes(b'')
+    self.assertEqual(hash_hex(empty, 'blake2b'), hashlib.blake2b().hexdigest())
+    manifest = outputs_manifest(self.dir, config={"manifests": {"hash": "blake2b"}})
+    self.assertEqual(manifest['a.txt']['blake2b'], hashlib.blake2b(b'hello').hexdigest())
+    self.assertNotIn('md5', manifest['a.txt'])
+    # only algorithms the web application knows, that don't need a digest length
+    from qaboard.utils import manifest_hash
+    self.assertEqual(manifest_hash({"manifests": {"hash": "SHA-256"}}), 'sha256')
+    for algorithm in ('shake_128', 'unknown'):
+      with self.assertRaises(ValueError):
+        manifest_hash({"manifests": {"hash": algorithm}})
+
+  def test_cmpmanifests(self):
+    import json
+    from qaboard.bit_accuracy import cmpmanifests
+    manifests = {
+      'md5': {'a': {'st_size': 1, 'md5': 'x'}, 'b': {'st_size': 1, 'md5': 'y'}, 'c': {'st_size': 1, 'md5': 'z'}},
+      'mixed': {'a': {'st_size': 1, 'md5': 'x'}, 'b': {'st_size': 1, 'md5': 'o'}, 'c': {'st_size': 1, 'blake2b': 'z'}},
+    }
+    for name, manifest in manifests.items():
+      (self.dir / f'{name}.json').write_text(json.dumps(manifest))
+    comparaison = cmpmanifests(self.dir / 'md5.json', self.dir / 'mixed.json')
+    self.assertEqual(comparaison['match'], {Path('a')})
+    self.assertEqual(comparaison['mismatch'], {Path('b')})
+    self.assertEqual(comparaison['errors'], {Path('c')})
+
+
+class TestHashCache(unittest.TestCase):
+  def test_hash_cache(self):
+    from qaboard.utils import file_info
+    from qaboard.hash_cache import HashCache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      tmp_dir = Path(tmp_dir)
+      path = tmp_dir / 'input.txt'
+      path.write_text('hello')
+      config = {"manifests": {"cache": str(tmp_dir / 'cache')}}
+
+      hash_cache = HashCache.for_database(tmp_dir, config)
+      info = file_info(path, hash_cache=hash_cache)
+      self.assertEqual(info, file_info(path, hash_cache=hash_cache))
+      self.assertEqual(hash_cache.stats()['misses'], 2) # not saved until we close the cache
+      hash_cache.close()
+
+      hash_cache = HashCache.for_database(tmp_dir, config)
+      self.assertEqual(file_info(path, hash_cache=hash_cache), info)
+      self.assertEqual(hash_cache.stats()['hits'], 1)
+      # when files change they are hashed again
+      path.write_text('hello world')
+      os.utime(path, ns=(0, 0))
+      self.assertEqual(file_info(path, hash_cache=hash_cache)['md5'], hashlib.md5(b'hello world').hexdigest())
+      self.assertEqual(hash_cache.stats()['total_misses'], 3)
+      hash_cache.close()
+
+  def test_hash_cache_read_only(self):
+    from qaboard.utils import file_info
+    from qaboard.hash_cache import HashCache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      tmp_dir = Path(tmp_dir)
+      paths = [tmp_dir / f'input-{index}.txt' for index in range(3)]
+      for path in paths:
+        path.write_text(path.name)
+      config = {"manifests": {"cache": str(tmp_dir / 'cache'), "cache_max_entries": 2}}
+      hash_cache = HashCache.for_database(tmp_dir, config)
+      for path in paths:
+        file_info(path, hash_cache=hash_cache)
+      hash_cache.close()
+      # the least recently used entries were evicted
+      hash_cache = HashCache.for_database(tmp_dir, config)
+      self.assertEqual(hash_cache.connection.execute("SELECT COUNT(*) FROM hashes").fetchone()[0], 2)
+      total_misses = hash_cache.stats()['total_misses']
+      file_info(paths[-1], hash_cache=hash_cache)
+      self.assertEqual(hash_cache.stats()['hits'], 1)
+      hash_cache.close()
+      # when nothing changed, runs don't write to the cache
+      hash_cache = HashCache.for_database(tmp_dir, config)
+      self.assertEqual(hash_cache.stats()['total_misses'], total_misses)
+      self.assertEqual(hash_cache.stats()['total_hits'], 0)
+      hash_cache.close()
+
+  def test_hash_cache_disabled(self):
+    from qaboard.hash_cache import HashCache
+    self.assertIsNone(HashCache.for_database(Path('.'), {}))
+
+  def test_hash_cache_network_filesystem(self):
+    from qaboard import hash_cache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      cache_dir = Path(tmp_dir) / 'cache'
+      on_nfs = lambda path: Path(path) == cache_dir or cache_dir in Path(path).parents
+      with mock.patch.object(hash_cache, 'is_network_filesystem', on_nfs), mock.patch.dict(os.environ, {'QA_CACHE_DIR': str(cache_dir)}):
+        # by default each host uses its own cache...
+        default_dir = hash_cache.sqlite_cache_dir(True, 'hashes', 'hash cache')
+        self.assertFalse(on_nfs(default_dir))
+        self.assertEqual(default_dir.name, 'hashes')
+        self.assertEqual(hash_cache.sqlite_cache_dir(True, 'hashes', 'hash cache'), default_dir)
+        # ...and we refuse to share one over the network
+        self.assertIsNone(hash_cache.HashCache.for_database(Path(tmp_dir), {"manifests": {"cache": str(cache_dir / 'shared')}}))
+
+
+class TestEntrypointModule(unittest.TestCase):
+  def test_entrypoint_module(self):
+    from qaboard.utils import entrypoint_module, reload_entrypoint_module
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      entrypoint = Path(tmp_dir) / 'main.py'
+      entrypoint.write_text("import random\nimported = random.random()\n")
+      config = {"project": {"entrypoint": str(entrypoint)}}
+      module = entrypoint_module(config)
+      self.assertIs(entrypoint_module(config), module)
+      self.assertIsNot(reload_entrypoint_module(config), module)
+      # modules are imported again when the file changes
+      module = entrypoint_module(config)
+      entrypoint.write_text("imported = 'new'\n")
+      os.utime(entrypoint, ns=(0, 0))
+      self.assertEqual(entrypoint_module(config).imported, 'new')
+
+
+class TestEnvironment(unittest.TestCase):
+  def test_environment(self):
+    from qaboard.utils import environment
+    with mock.patch.dict(os.environ, {"QA_TEST_A": "a"}):
+      os.environ.pop("QA_TEST_B", None)
+      with environment(QA_TEST_A="new", QA_TEST_B="b", QA_TEST_C=None):
+        self.assertEqual((os.environ["QA_TEST_A"], os.environ["QA_TEST_B"]), ("new", "b"))
+        self.assertNotIn("QA_TEST_C", os.environ)
+      self.assertEqual(os.environ["QA_TEST_A"], "a")
+      self.assertNotIn("QA_TEST_B", os.environ)
+
+
+class TestMetadataCache(unittest.TestCase):
+  def test_metadata_cache(self):
+    from qaboard.utils import inputs_metadata
+    from qaboard.metadata_cache import MetadataCache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      tmp_dir = Path(tmp_dir)
+      calls = tmp_dir / 'calls.txt'
+      entrypoint = tmp_dir / 'main.py'
+      entrypoint.write_text(
+        "def metadata(absolute_input_path, database, input_path):\n"
+        f"  with open({str(calls)!r}, 'a') as f: f.write('.')\n"
+        "  return {'name': input_path.stem}\n"
+      )
+      database = tmp_dir / 'database'
+      database.mkdir()
+      inputs = []
+      for name in ['a', 'b', 'c']:
+        (database / f'{name}.txt').write_text(name)
+        inputs.append(database / f'{name}.txt')
+      config = {"project": {"entrypoint": str(entrypoint)}, "inputs": {"metadata_cache": str(tmp_dir / 'cache')}}
+
+      for _ in range(2):
+        metadata_cache = MetadataCache.for_database(database, config)
+        self.assertEqual(inputs_metadata(inputs, database, config, metadata_cache), [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}])
+        metadata_cache.close()
+      self.assertEqual(calls.read_text(), '...')
+      # the metadata is computed again when the entrypoint changes
+      entrypoint.write_text(entrypoint.read_text().replace('input_path.stem', 'input_path.name'))
+      metadata_cache = MetadataCache.for_database(database, config)
+      self.assertEqual(inputs_metadata(inputs, database, config, metadata_cache)[0], {'name': 'a.txt'})
+      metadata_cache.close()
+      self.assertEqual(calls.read_text(), '......')
+
+  def test_metadata_cache_directories(self):
+    from qaboard.utils import input_metadata
+    from qaboard.metadata_cache import MetadataCache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      tmp_dir = Path(tmp_dir)
+      entrypoint = tmp_dir / 'main.py'
+      entrypoint.write_text(
+        "def metadata(absolute_input_path, database, input_path):\n"
+        "  return {'frames': sorted(p.read_text() for p in absolute_input_path.rglob('*.txt'))}\n"
+      )
+      database = tmp_dir / 'database'
+      (database / 'input' / 'sub').mkdir(parents=True)
+      frame = database / 'input' / 'sub' / 'frame.txt'
+      frame.write_text('a')
+      config = {"project": {"entrypoint": str(entrypoint)}, "inputs": {"metadata_cache": str(tmp_dir / 'cache')}}
+      for expected in ['a', 'b']:
+        if expected == 'b':
+          # modifying a file doesn't change the mtime of its directories
+          frame.write_text('b')
+          os.utime(frame, ns=(frame.stat().st_mtime_ns + 10**9, frame.stat().st_mtime_ns + 10**9))
+        metadata_cache = MetadataCache.for_database(database, config)
+        metadata = input_metadata(database / 'input', database, Path('input'), config, metadata_cache)
+        self.assertEqual(metadata, {'frames': [expected]})
+        metadata_cache.close()
+
+  def test_workers(self):
+    from qaboard.utils import workers, parallel_map
+    config = {"inputs": {"metadata_workers": 4}}
+    self.assertEqual(workers('QA_METADATA_WORKERS', 'inputs.metadata_workers', {}), 1)
+    self.assertEqual(workers('QA_METADATA_WORKERS', 'inputs.metadata_workers', config), 4)
+    with mock.patch.dict(os.environ, {"QA_METADATA_WORKERS": "2"}):
+      self.assertEqual(workers('QA_METADATA_WORKERS', 'inputs.metadata_workers', config), 2)
+    self.assertEqual(parallel_map(lambda x: 2 * x, [1, 2, 3], 2), [2, 4, 6])
+
+
+class TestMatchingOutput(unittest.TestCase):
+  def test_matching_output(self):
+    from qaboard.api import matching_output, index_outputs
+    from qaboard.run import RunContext
+    def api_output(id, configurations, is_pending=False):
+      return {
+        "id": id, "is_pending": is_pending, "platform": "linux", "output_type": "slam",
+        "test_input_database": "/db", "test_input_path": "a.jpg",
+        "configurations": configurations, "extra_parameters": {"x": 1},
+        "output_dir_url": f"/s/output/{id}",
+      }
+    outputs = [api_output(1, ['base']), api_output(2, ['base', {"b": 1, "a": 2}]), api_output(3, ['other'], is_pending=True)]
+    index = index_outputs(outputs)
+    def reference(configurations):
+      return RunContext(input_path=Path('/db/a.jpg'), database=Path('/db'), platform='linux', type='slam', configurations=configurations, extra_parameters={"x": 1})
+    # the key does not depend on the order of the keys
+    self.assertEqual(matching_output(reference(['base', {"a": 2, "b": 1}]), [], index=index)['id'], 2)
+    self.assertEqual(matching_output(reference(['base']), outputs)['id'], 1)
+    # pending outputs are never matched
+    self.assertIsNone(matching_output(reference(['other']), [], index=index))
+
+
+if __name__ == '__main__':
+  unittest.main()
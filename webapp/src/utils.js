@@ -405,6 +405,16 @@ const metrics_fill_defaults = available_metrics => {
   return available_metrics || {}
 }
 
+// Manifests store each file's digest under the name of the hash algorithm (md5 by default).
+// We return a "algorithm:digest" key, so that only files hashed the same way compare as equal.
+const hash_algorithms = ["md5", "blake2b", "blake2s", "sha1", "sha256", "sha512"]
+const file_hash = info => {
+  if (!info) return undefined
+  const algorithm = hash_algorithms.find(algorithm => info[algorithm] !== undefined)
+  if (algorithm === undefined) return undefined
+  return `${algorithm}:${info[algorithm]}`
+}
+
 
 export {
   average,
@@ -427,4 +437,5 @@ export {
   linux_to_windows,
   make_eval_templates_recursively,
   metrics_fill_defaults,
+  file_hash,
 };
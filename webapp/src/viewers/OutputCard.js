@@ -33,7 +33,7 @@ import { OutputTags, ExtraParametersTags, StatusTag, RunBadges, style_skeleton }
 import { humanFileSize } from "./bit_accuracy/utils";
 
 import { updateSelected } from "../actions/selected";
-import { linux_to_windows } from '../utils'
+import { linux_to_windows, file_hash } from '../utils'
 
 export const toaster = Toaster.create();
 
@@ -500,8 +500,8 @@ class OutputCard extends React.Component {
               return <span/>
             let ref_available = path === undefined || (!!this.state.manifests.reference && !!this.state.manifests.reference[path])
             const hash = {
-              new: this.state.manifests?.new?.[path]?.md5,
-              reference: this.state.manifests?.reference?.[path]?.md5,
+              new: file_hash(this.state.manifests?.new?.[path]),
+              reference: file_hash(this.state.manifests?.reference?.[path]),
             }
             const has_same_data = !!hash.new && !!hash.reference && hash.new === hash.reference
             return <div key={`${idx}-${path_idx}`} id={`${idx}-${path_idx}`}>
@@ -3,7 +3,7 @@ import React from "react";
 import { Tree, Classes, Colors, Tag, Icon, Tooltip } from "@blueprintjs/core";
 import { OutputViewer } from "../OutputViewer"
 import { getNodeById, forEachNode, visitDepthFirst, copyNodeData, filterNodes, updateMissingFrom, humanFileSize } from "./utils"
-import { match_query } from "../../utils"
+import { match_query, file_hash } from "../../utils"
 
 
 // Turns a flat file manifest into a proper tree
@@ -55,7 +55,7 @@ const updateMatch = tree_reference => node => {
     if (node_reference === undefined)
       node.nodeData.match = true;
     else
-      node.nodeData.match = node.nodeData.md5 === node_reference.nodeData.md5;
+      node.nodeData.match = file_hash(node.nodeData) === file_hash(node_reference.nodeData);
 }
 
 
@@ -183,8 +183,8 @@ class BitAccuracyViewer extends React.Component {
       />
       {selected.map( filename => {
         const hash = {
-          new: this.props.manifests?.new?.[filename]?.md5,
-          reference: this.props.manifests?.reference?.[filename]?.md5,
+          new: file_hash(this.props.manifests?.new?.[filename]),
+          reference: file_hash(this.props.manifests?.reference?.[filename]),
         }
         const has_same_data = !!hash.new && hash.new === hash.reference
         return <>
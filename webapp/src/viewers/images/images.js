@@ -20,6 +20,7 @@ import "./image-canvas.css";
 import { histogram_traces } from './histogram';
 import { CropSelection } from "./crops";
 import { iiif_url } from "./utils";
+import { file_hash } from "../../utils";
 import MultiSelectTags from './MultiselectCrops'
 
 import { unregister_filter_sync } from "./filters"
@@ -575,7 +576,7 @@ class ImgViewer extends React.PureComponent {
     const { output_new, output_ref, diff, label, path, manifests } = this.props;
     const { first_image, width, image_height, image_width, error, hide_labels, has_reference } = this.state;
 
-    const is_same_data = manifests?.new?.[path]?.md5 === manifests?.reference?.[path]?.md5
+    const is_same_data = file_hash(manifests?.new?.[path]) === file_hash(manifests?.reference?.[path])
 
     const has_error = !!error && Object.keys(error).length > 0;
     const error_messages = !has_error ? <span/> : <>
@@ -4,6 +4,8 @@ import {
   Tag,
 } from "@blueprintjs/core";
 
+import { file_hash } from "../utils";
+
 class SyncedVideos extends React.Component {
   constructor(props) {
     super(props);
@@ -38,8 +40,8 @@ class SyncedVideos extends React.Component {
   }
 
   componentDidUpdate(prevProps, prevState) {
-    const is_same_data = this.props.manifests?.new?.[this.props.path]?.md5 === this.props.manifests?.reference?.[this.props.path]?.md5
-    const was_same_data = prevProps.manifests?.new?.[prevProps.path]?.md5 === prevProps.manifests?.reference?.[prevProps.path]?.md5
+    const is_same_data = file_hash(this.props.manifests?.new?.[this.props.path]) === file_hash(this.props.manifests?.reference?.[this.props.path])
+    const was_same_data = file_hash(prevProps.manifests?.new?.[prevProps.path]) === file_hash(prevProps.manifests?.reference?.[prevProps.path])
     if(was_same_data && !is_same_data && !!this.viewRefR.current)
       this.viewRefR.current.addEventListener("canplay", this.canplay_ref);
   }
@@ -79,7 +81,7 @@ class SyncedVideos extends React.Component {
 
   render() {
     const { output_new, output_ref, path, poster='poster.jpg', type, manifests } = this.props;
-    const is_same_data = manifests?.new?.[path]?.md5 === manifests?.reference?.[path]?.md5
+    const is_same_data = file_hash(manifests?.new?.[path]) === file_hash(manifests?.reference?.[path])
     let width = parseFloat(((this.props.style || {}).width || '390px').replace(/[^\d]+/, ''))
     const single_video_width = (width - 10) / 2
 